@@ -0,0 +1,215 @@
+# ======================================================
+# G-TASK MANAGER: STRUCTURED LOGGING
+# Records are an event name plus key=value fields:
+#     log = get_logger('gtask.telegram')
+#     log.info('telegram.message.sent', chat_id=chat_id, status=200)
+#
+# - Levels are per logger ("gtask=INFO,gtask.telegram=DEBUG") and can be
+#   changed at runtime with configure_logging(levels=...).
+# - High-volume events can be sampled ("webhook.enqueued=0.01").
+# - Records go through a bounded queue; one listener thread formats and writes
+#   them, so a request never waits on stderr. When the queue is full, records
+#   are dropped and counted instead of blocking.
+# - Secrets are redacted at format time: fields named like token/hash/password
+#   and anything shaped like a bot token or a hex digest.
+# A disabled level costs one isEnabledFor() check: pass raw values as fields
+# (never pre-formatted strings) and nothing is formatted unless it is written.
+# ======================================================
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+
+ROOT_LOGGER = 'gtask'
+QUEUE_SIZE = 10000
+MAX_VALUE_LENGTH = 300
+
+DEFAULT_LEVELS = 'gtask=INFO'
+DEFAULT_SAMPLE_RATES = 'webhook.enqueued=0.01,telegram.update.payload=0.01'
+
+_SECRET_FIELD_PARTS = ('token', 'hash', 'password', 'secret', 'signature', 'initdata')
+_SECRET_PATTERNS = [
+    (re.compile(r'(?<!\d)\d{6,12}:[A-Za-z0-9_-]{30,}'), '<bot-token>'),
+    (re.compile(r'(?i)\b(hash|signature|token)=[^&\s\'"]+'), r'\1=***'),
+    (re.compile(r'\b[0-9a-fA-F]{40,}\b'), '<digest>'),
+]
+
+_sample_rates = {}
+
+
+def redact(text):
+    """Mask bot tokens, hex digests and hash=/token= query parameters in text."""
+    for pattern, replacement in _SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _format_value(key, value):
+    if any(part in key.lower() for part in _SECRET_FIELD_PARTS):
+        return '***'
+    text = value if isinstance(value, str) else repr(value)
+    text = redact(text)
+    if len(text) > MAX_VALUE_LENGTH:
+        text = text[:MAX_VALUE_LENGTH] + '...'
+    if not text or any(c in text for c in ' ="\n'):
+        text = json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """`<time> <LEVEL> <logger> <event> key=value ...`, redacted."""
+
+    def format(self, record):
+        parts = [
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+            record.levelname,
+            record.name,
+            redact(record.getMessage()),
+        ]
+        for key, value in getattr(record, 'fields', {}).items():
+            parts.append(f"{key}={_format_value(key, value)}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + redact(self.formatException(record.exc_info))
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting (and redaction) happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+class EventLogger:
+    """Thin wrapper over logging.Logger taking an event name and fields."""
+
+    __slots__ = ('logger',)
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def is_enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields, exc_info=None):
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = _sample_rates.get(event)
+        if rate is not None:
+            if random.random() >= rate:
+                return
+            fields['sample_rate'] = rate
+        self.logger.log(level, event, exc_info=exc_info, extra={'fields': fields}, stacklevel=3)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """ERROR with the current exception's traceback."""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name):
+    return EventLogger(name)
+
+
+def _parse_spec(spec):
+    pairs = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+def configure_logging(levels=None, sample_rates=None):
+    """Apply "logger=LEVEL,..." and "event=rate,..." specs (runtime-safe).
+
+    Raises ValueError on an unknown level or a rate outside 0..1.
+    """
+    parsed_levels = {name: value.upper() for name, value in _parse_spec(levels).items()}
+    for name, level in parsed_levels.items():
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Unknown log level for {name}: {level}")
+    parsed_rates = {event: float(rate) for event, rate in _parse_spec(sample_rates).items()}
+    if any(not 0 <= rate <= 1 for rate in parsed_rates.values()):
+        raise ValueError("Sample rates must be between 0 and 1")
+
+    for name, level in parsed_levels.items():
+        logging.getLogger(name).setLevel(level)
+    for event, rate in parsed_rates.items():
+        if rate >= 1:
+            _sample_rates.pop(event, None)
+        else:
+            _sample_rates[event] = rate
+
+
+def logging_config():
+    """Explicitly set levels under ROOT_LOGGER, sample rates and dropped-record count."""
+    levels = {
+        name: logging.getLevelName(logger.level)
+        for name, logger in logging.root.manager.loggerDict.items()
+        if isinstance(logger, logging.Logger) and logger.level
+        and (name == ROOT_LOGGER or name.startswith(ROOT_LOGGER + '.'))
+    }
+    return {'levels': levels, 'sample_rates': dict(_sample_rates), 'dropped': _DroppingQueueHandler.dropped}
+
+
+_handler = None
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(KeyValueFormatter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup_logging():
+    """Install the queue handler on ROOT_LOGGER. Safe to call more than once."""
+    global _handler
+    if _handler is not None:
+        return
+    _handler = _DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.addHandler(_handler)
+    root.propagate = False
+    configure_logging(os.environ.get('LOG_LEVELS', DEFAULT_LEVELS),
+                      os.environ.get('LOG_SAMPLE', DEFAULT_SAMPLE_RATES))
+    _start_listener()
+    # The listener thread does not survive fork (gunicorn preload): each child
+    # gets a fresh queue and listener.
+    os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(_stop_listener)
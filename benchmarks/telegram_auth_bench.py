@@ -0,0 +1,83 @@
+# ======================================================
+# G-TASK MANAGER: telegram_auth MICRO-BENCHMARKS
+# Per-call cost of Mini App initData validation and signed login links.
+# Run from the repository root:
+#     python -m benchmarks.telegram_auth_bench [--number N]
+# "uncached" is the old validator: key derivation, parsing and HMAC on every
+# call. "cold" is the new one for a payload it has not seen; "repeat" is the
+# same payload again (served from the accepted cache).
+# ======================================================
+
+import argparse
+import hashlib
+import hmac
+import json
+import time
+import timeit
+from urllib.parse import quote, unquote
+
+from telegram_auth import InitDataValidator, LoginLinkSigner, ReplayCache
+
+BOT_TOKEN = '123456789:AAbbCCddEEffGGhhIIjjKKllMMnnOOppQQr'
+
+
+def make_init_data(bot_token, user_id, auth_date=None):
+    """initData signed the way Telegram signs it."""
+    fields = {
+        'query_id': f'AAHdF6IQAAAAAN0XohDhrOrc{user_id}',
+        'user': json.dumps({'id': user_id, 'first_name': 'Abebe', 'username': f'abebe{user_id}',
+                            'language_code': 'am'}, separators=(',', ':')),
+        'auth_date': str(int(time.time()) if auth_date is None else auth_date),
+    }
+    data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return '&'.join(f"{k}={quote(v, safe='')}" for k, v in fields.items())
+
+
+def uncached_validate(init_data, bot_token):
+    """The pre-telegram_auth validator, for comparison."""
+    parts = {}
+    for item in init_data.split('&'):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            parts[key] = unquote(value)
+    received_hash = parts['hash']
+    data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(parts.items()) if k != 'hash')
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return calculated_hash == received_hash
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{name:<34} {seconds / number * 1e6:8.2f} us/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='telegram_auth micro-benchmarks')
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+    number = args.number
+
+    payload = make_init_data(BOT_TOKEN, 1)
+    cold_payloads = [make_init_data(BOT_TOKEN, user_id) for user_id in range(number * 5 + 5)]
+    cold = iter(cold_payloads)
+    validator = InitDataValidator(BOT_TOKEN, cache_size=len(cold_payloads))
+    validator.validate(payload)
+
+    bench('initData uncached (old)', lambda: uncached_validate(payload, BOT_TOKEN), number)
+    bench('initData cold (new)', lambda: validator.validate(next(cold)), number)
+    bench('initData repeat (accepted cache)', lambda: validator.validate(payload), number)
+
+    signer = LoginLinkSigner([('k1', 'bench-secret')])
+    token = signer.sign(42)
+    replay_signer = LoginLinkSigner([('k1', 'bench-secret')], replay_cache=ReplayCache(1024))
+    tokens = iter([replay_signer.sign(42) for _ in range(number * 5)])
+    bench('login link sign', lambda: signer.sign(42), number)
+    bench('login link verify', lambda: signer.verify(token), number)
+    bench('login link verify + replay cache', lambda: replay_signer.verify(next(tokens)), number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+# ======================================================
+# G-TASK MANAGER: GUNICORN SETTINGS (gunicorn -c gunicorn.conf.py main:app)
+# The app is imported once in the master (preload_app), so init_db() and the
+# template warm-up run once per deploy instead of once per worker; workers are
+# forked from the ready app.
+# ======================================================
+
+import os
+import shutil
+import tempfile
+
+# Workers share metrics through files in this directory (see metrics.py). It
+# must be set before the app is imported and is emptied on every start.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'g-task-metrics'))
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Connections opened by the master during init_db must not be shared with
+    # the children; each worker opens its own on first use.
+    from main import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
@@ -4,24 +4,60 @@
 # Author: Gemini (AI)
 # ======================================================
 
-import os
 import time
+_BOOT_STARTED = time.perf_counter() # BOOT_TIMINGS['imports'] starts here, before the heavy imports
+
+import io
+import csv
+import os
+import random
+import tempfile
 import hashlib
 import hmac
-import secrets
+import json
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
-from urllib.parse import unquote
-from flask import Flask, render_template, request, session, redirect, url_for, flash, jsonify
+from zoneinfo import ZoneInfo
+import click
+from flask import Flask, render_template, request, session, redirect, url_for, flash, jsonify, g, has_request_context, stream_with_context
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import event, func, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from dotenv import load_dotenv # ሚስጥሮችን ከአካባቢ ተለዋዋጮች (Secrets) ለመጫን
+from migrations import run_migrations, check_hot_queries
+from applog import setup_logging, get_logger, configure_logging, logging_config
+import metrics
+import screenshots
+from telegram_auth import InitDataValidator, InvalidInitData, InvalidLoginLink, login_link_signer_from_env
+
+# Boot breakdown in seconds (imports, init_db, templates, module, first_request);
+# printed at startup and returned by /health.
+BOOT_TIMINGS = {'imports': round(time.perf_counter() - _BOOT_STARTED, 3)}
 
 # --- 0. ENV SETUP & CONFIGURATION ---
 load_dotenv() # በ Replit ላይ አውቶማቲክ ይሰራል
 app = Flask(__name__)
 
+# Structured logging (applog.py). Levels: LOG_LEVELS="gtask=INFO,gtask.telegram=DEBUG";
+# sampling: LOG_SAMPLE="webhook.enqueued=0.01"; both adjustable at /admin/logging.
+setup_logging()
+log = get_logger('gtask.web')
+tg_log = get_logger('gtask.telegram')
+queue_log = get_logger('gtask.queue')
+
+# Compiled templates are cached on disk, so a fresh process skips Jinja's compile step
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'g-task-jinja'))
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
 # PRODUCTION MODE - Render only (disable debug on production)
 ENV = os.environ.get('ENV', 'production')
 app.debug = (ENV == 'development')
@@ -63,13 +99,22 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True,
     'pool_recycle': 3600,
-    'connect_args': {'connect_timeout': 10}
 }
+# connect_timeout is a libpq option; sqlite3.connect() rejects it
+if database_url.startswith('postgresql://'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'connect_timeout': 10}
 
 db = SQLAlchemy(app)
 
 MIN_PAYOUT = 40.00
 PAYOUT_AMOUNT_PER_TASK = 10.00
+DAILY_CHECKIN_REWARD = 0.20
+
+# "Today" for check-ins is the workers' local day, not the database server's
+BUSINESS_TIMEZONE = ZoneInfo(os.environ.get('BUSINESS_TIMEZONE', 'Africa/Addis_Ababa'))
+
+def business_today():
+    return datetime.now(BUSINESS_TIMEZONE).date()
 
 # ===== STARTUP DIAGNOSTICS =====
 print(f"🚀 Flask App Starting on {'Render' if ENV == 'production' else 'Development'}...")
@@ -88,11 +133,14 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    role_version = db.Column(db.Integer, nullable=False, default=0, server_default='0') # bumped on every role change
     total_earned = db.Column(db.Float, default=0.0)
     pending_payout = db.Column(db.Float, default=0.0)
     telegram_id = db.Column(db.String(50), unique=True, nullable=True)
+    # Legacy stored login tokens: unused (links are signed, telegram_auth.py), cleared by migration 011
     telegram_login_token = db.Column(db.String(256), nullable=True)
     telegram_token_expires = db.Column(db.DateTime, nullable=True)
+    telegram_blocked = db.Column(db.Boolean, default=False) # Bot blocked by the user (Telegram 403)
     
     # Relationships
     tasks = db.relationship('Task', backref='worker', lazy='dynamic')
@@ -104,21 +152,39 @@ class Inventory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     gmail_username = db.Column(db.String(120), unique=True, nullable=False)
     gmail_password = db.Column(db.String(120), nullable=False)
+    recovery_email = db.Column(db.String(120), nullable=True)
     status = db.Column(db.String(20), default='AVAILABLE') # AVAILABLE, ASSIGNED, COMPLETED
     date_added = db.Column(db.DateTime, default=func.now())
     
     # Relationship
     task = db.relationship('Task', backref='inventory_item', uselist=False)
+    
+    # FIFO claim order for take_task: WHERE status = 'AVAILABLE' ORDER BY date_added, id
+    __table_args__ = (db.Index('ix_inventory_status_date_added', 'status', 'date_added', 'id'),)
 
 class Task(db.Model):
     __tablename__ = 'tasks'
     id = db.Column(db.Integer, primary_key=True)
-    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), unique=True, nullable=False)
+    # NULL once rejected: the account went back to the inventory for someone else
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), unique=True, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     completion_code = db.Column(db.String(100))
     status = db.Column(db.String(20), default='PENDING') # PENDING, SUBMITTED, VERIFIED, REJECTED
     date_assigned = db.Column(db.DateTime, default=func.now())
     date_completed = db.Column(db.DateTime)
+    
+    # At most one PENDING task per worker (enforced by the claim engine and this partial index)
+    # plus the keyset order of the worker's task history
+    __table_args__ = (
+        db.Index('ix_tasks_user_date_assigned', 'user_id', 'date_assigned', 'id'),
+        db.Index('ix_tasks_user_status', 'user_id', 'status'),
+        db.Index('ix_tasks_submitted_queue', 'date_completed', 'id',
+                 postgresql_where=text("status = 'SUBMITTED'"),
+                 sqlite_where=text("status = 'SUBMITTED'")),
+        db.Index('uq_tasks_one_pending_per_user', 'user_id', unique=True,
+                 postgresql_where=text("status = 'PENDING'"),
+                 sqlite_where=text("status = 'PENDING'")),
+    )
 
 class Payout(db.Model):
     __tablename__ = 'payouts'
@@ -131,6 +197,24 @@ class Payout(db.Model):
     payment_details = db.Column(db.String(255), nullable=False)
     date_requested = db.Column(db.DateTime, default=func.now())
     date_paid = db.Column(db.DateTime)
+    export_batch_id = db.Column(db.Integer, db.ForeignKey('payout_export_batches.id'), nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_payouts_requested_queue', 'date_requested', 'id',
+                 postgresql_where=text("status = 'REQUESTED'"),
+                 sqlite_where=text("status = 'REQUESTED'")),
+        db.Index('ix_payouts_user_id', 'user_id'),
+        db.Index('ix_payouts_export_batch_id', 'export_batch_id', 'id'),
+    )
+
+# የክፍያ ኤክስፖርት ስብስብ (one disbursement export: the payouts it froze for finance)
+class PayoutExportBatch(db.Model):
+    __tablename__ = 'payout_export_batches'
+    id = db.Column(db.Integer, primary_key=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    payout_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    date_created = db.Column(db.DateTime, default=datetime.now)
 
 # ማስታወቂያ ሞዴሎች (Ad Models)
 class Ad(db.Model):
@@ -150,75 +234,152 @@ class AdView(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     status = db.Column(db.String(20), default='PENDING') # PENDING, REWARDED
     date_viewed = db.Column(db.DateTime, default=func.now())
+    view_day = db.Column(db.Date, default=business_today) # business day bucket of date_viewed
+    
+    # One reward per user, ad and day: register_ad_reward is an idempotent insert
+    __table_args__ = (db.Index('uq_ad_views_user_ad_day', 'user_id', 'ad_id', 'view_day', unique=True),)
 
 class DailyCheckIn(db.Model):
     __tablename__ = 'daily_check_ins'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    check_in_date = db.Column(db.Date, default=func.current_date())
+    check_in_date = db.Column(db.Date, default=business_today)
     date_checked_in = db.Column(db.DateTime, default=func.now())
     
     # Unique constraint: one check-in per user per day
     __table_args__ = (db.UniqueConstraint('user_id', 'check_in_date', name='unique_daily_checkin'),)
 
+# የመግቢያ ተከታታይነት (Check-in streak per user, maintained by daily_checkin)
+class CheckInStreak(db.Model):
+    __tablename__ = 'check_in_streaks'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    current_streak = db.Column(db.Integer, nullable=False, default=0)
+    longest_streak = db.Column(db.Integer, nullable=False, default=0)
+    last_check_in_date = db.Column(db.Date, nullable=False)
+    
+    __table_args__ = (db.Index('ix_check_in_streaks_last_date_streak', 'last_check_in_date', 'current_streak'),)
+
+class Broadcast(db.Model):
+    __tablename__ = 'broadcasts'
+    id = db.Column(db.Integer, primary_key=True)
+    message = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='QUEUED') # QUEUED, RUNNING, DONE, FAILED
+    total = db.Column(db.Integer, default=0)
+    sent = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    blocked = db.Column(db.Integer, default=0)
+    date_created = db.Column(db.DateTime, default=func.now())
+    date_finished = db.Column(db.DateTime)
+
+# የስታቲስቲክስ ቆጣሪዎች (Incrementally maintained global counters, sharded to avoid a hot row)
+class StatCounter(db.Model):
+    __tablename__ = 'stat_counters'
+    name = db.Column(db.String(50), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value = db.Column(db.BigInteger, default=0, nullable=False)
+    date_reconciled = db.Column(db.DateTime)
+
+# ቴሌግራም ዌብሁክ ወረፋ (Incoming Telegram updates, deduplicated on update_id)
+class TelegramUpdate(db.Model):
+    __tablename__ = 'telegram_updates'
+    update_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='PENDING') # PENDING, PROCESSING, DONE, FAILED
+    attempts = db.Column(db.Integer, default=0)
+    date_received = db.Column(db.DateTime, default=datetime.now)
+    locked_at = db.Column(db.DateTime)
+    next_attempt_at = db.Column(db.DateTime) # after a failure: not claimed again before this
+    date_processed = db.Column(db.DateTime)
+    
+    __table_args__ = (db.Index('ix_telegram_updates_status_update_id', 'status', 'update_id'),)
+
+# የቴሌግራም ማውረጃ ቦታ (getUpdates offset of the long-polling runner, one row per bot)
+class TelegramPollState(db.Model):
+    __tablename__ = 'telegram_poll_state'
+    name = db.Column(db.String(50), primary_key=True)
+    next_offset = db.Column(db.BigInteger, nullable=False)
+    date_updated = db.Column(db.DateTime, nullable=False)
+
+# ቴሌግራም መውጫ ሳጥን (Outbound Bot API calls, written in the same transaction as the change they announce)
+class TelegramOutbox(db.Model):
+    __tablename__ = 'telegram_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    method = db.Column(db.String(50), nullable=False) # sendMessage, setMyCommands
+    chat_id = db.Column(db.String(50)) # calls to one chat are delivered one at a time, in id order
+    user_id = db.Column(db.Integer) # marked telegram_blocked when the chat answers 403
+    broadcast_id = db.Column(db.Integer) # progress counted on the broadcast
+    priority = db.Column(db.SmallInteger, nullable=False, default=0) # OUTBOX_PRIORITY_*: lower is sent first
+    payload = db.Column(db.Text, nullable=False) # JSON parameters; chat_id is added at send time
+    status = db.Column(db.String(20), nullable=False, default='PENDING') # PENDING, SENDING, SENT, DEAD
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False) # SENDING: lease expiry
+    last_error = db.Column(db.String(255))
+    date_created = db.Column(db.DateTime, default=datetime.now)
+    date_sent = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_telegram_outbox_due_priority', 'priority', 'next_attempt_at', 'id',
+                 postgresql_where=text("status IN ('PENDING', 'SENDING')"),
+                 sqlite_where=text("status IN ('PENDING', 'SENDING')")),
+        db.Index('ix_telegram_outbox_chat_open', 'chat_id', 'id',
+                 postgresql_where=text("status IN ('PENDING', 'SENDING')"),
+                 sqlite_where=text("status IN ('PENDING', 'SENDING')")),
+        db.Index('ix_telegram_outbox_status_date_created', 'status', 'date_created'),
+    )
+
+# የካሽ ስሪቶች (Version numbers of cached data, bumped on every change)
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_versions'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+# የገቢ መዝገብ (Append-only earnings ledger: one row per balance change)
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    amount = db.Column(db.Float, nullable=False) # positive = credit, negative = debit
+    kind = db.Column(db.String(30), nullable=False) # TASK_REWARD, AD_REWARD, CHECKIN_REWARD, PAYOUT_REQUEST, PAYOUT_REFUND, OPENING_BALANCE
+    reference = db.Column(db.String(50)) # e.g. 'task:12', 'payout:7'
+    balance_after = db.Column(db.Float, nullable=False)
+    date_created = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (db.Index('ix_ledger_entries_user_id_id', 'user_id', 'id'),)
+
+# A user's balance as of one ledger entry; verification only sums the entries after it
+class BalanceSnapshot(db.Model):
+    __tablename__ = 'balance_snapshots'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    ledger_entry_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    balance = db.Column(db.Float, nullable=False)
+    date_created = db.Column(db.DateTime, default=datetime.now)
+
 
 # --- 2. DATABASE INIT & HELPER FUNCTIONS ---
 
-def init_db():
-    """የዳታቤዝ ሠንጠረዦችን ይፈጥራል እና ነባሪ አድሚን ያስገባል።"""
+def init_db(strict=False):
+    """የዳታቤዝ ሠንጠረዦችን ይፈጥራል እና ነባሪ አድሚን ያስገባል።
+
+    strict=True (the db-init release command) re-raises a failed migration so the
+    deploy stops; at boot the error is only printed.
+    """
     with app.app_context():
         try:
-            # ሁሉንም ሞዴሎች በመጠቀም ሠንጠረዦችን ይፈጥራል
-            db.create_all()
-            print("✅ Database tables created successfully")
+            # ሁሉንም ሞዴሎች በመጠቀም ሠንጠረዦችን ይፈጥራል, then applies versioned
+            # schema changes (columns and indexes on existing tables) under one lock
+            schema_version = run_migrations(db.engine, metadata=db.metadata)
+            print(f"✅ Database tables ready (schema version {schema_version})")
         except Exception as e:
-            print(f"⚠️ Error creating tables: {str(e)}")
+            print(f"⚠️ Error creating tables / applying migrations: {str(e)[:200]}")
+            if strict:
+                raise
             return
         
-        # Add missing columns to existing tables
-        from sqlalchemy import text, inspect
         try:
-            inspector = inspect(db.engine)
-            
-            # Check and add missing columns to users table
-            if 'users' in inspector.get_table_names():
-                users_columns = [col['name'] for col in inspector.get_columns('users')]
-                users_columns_to_add = [
-                    ('telegram_login_token', "VARCHAR(256)"),
-                    ('telegram_token_expires', "TIMESTAMP"),
-                ]
-                
-                for col_name, col_def in users_columns_to_add:
-                    if col_name not in users_columns:
-                        try:
-                            db.session.execute(text(f'ALTER TABLE users ADD COLUMN {col_name} {col_def}'))
-                            db.session.commit()
-                            print(f"✅ Added {col_name} column to users table")
-                        except Exception as e:
-                            db.session.rollback()
-                            print(f"⚠️ {col_name} already exists or error: {str(e)[:80]}")
-            
-            # Check and add missing columns to payouts table
-            if 'payouts' in inspector.get_table_names():
-                payouts_columns = [col['name'] for col in inspector.get_columns('payouts')]
-                
-                payouts_columns_to_add = [
-                    ('payment_method', "VARCHAR(50) DEFAULT 'Telebirr'"),
-                    ('recipient_name', "VARCHAR(255) DEFAULT ''"),
-                    ('payment_details', "VARCHAR(255) DEFAULT ''"),
-                ]
-                
-                for col_name, col_def in payouts_columns_to_add:
-                    if col_name not in payouts_columns:
-                        try:
-                            db.session.execute(text(f'ALTER TABLE payouts ADD COLUMN {col_name} {col_def}'))
-                            db.session.commit()
-                            print(f"✅ Added {col_name} column to payouts table")
-                        except Exception as e:
-                            db.session.rollback()
-                            print(f"⚠️ {col_name} already exists or error: {str(e)[:80]}")
+            reconcile_stat_counters()
         except Exception as e:
-            print(f"⚠️ Error checking/adding columns: {str(e)[:100]}")
+            db.session.rollback()
+            print(f"⚠️ Could not reconcile stat counters: {str(e)[:80]}")
         
         # ነባሪ የአድሚን አካውንት - only if ADMIN_USERNAME and ADMIN_PASSWORD are set
         admin_username = os.environ.get('ADMIN_USERNAME')
@@ -237,100 +398,1761 @@ def init_db():
         else:
             print("ማስጠንቀቂያ: ADMIN_USERNAME እና ADMIN_PASSWORD secrets አልተገኙም። የአድሚን account ለመፍጠር እነዚህን በSecrets ውስጥ ያስገቡ።")
 
-init_db()
-
 
 def is_logged_in():
     return 'user_id' in session
 
+# Request-scoped identity: the logged-in User is loaded at most once per
+# request (cached on flask.g). Templates read the admin flag from a short-lived
+# role claim kept in the signed session cookie, so rendering the nav costs no
+# query; admin routes still re-check against the database once per request.
+# The claim carries users.role_version: set_user_admin() bumps it, and any
+# request that loads the user (every admin route, most pages) drops a claim of
+# another version, so a role change reaches every session, not only its own.
+# The cookie is rewritten only when the claim changes or expires.
+ROLE_CLAIM_TTL = 300 # seconds
+
+def get_current_user():
+    """The logged-in User for this request, or None."""
+    if 'current_user' not in g:
+        g.current_user = db.session.get(User, session['user_id']) if is_logged_in() else None
+    return g.current_user
+
+def _role_claim_matches(claim, user):
+    """The claim is fresh, for this user, and of their current role version (if loaded)."""
+    return bool(claim) and claim.get('uid') == session.get('user_id') \
+        and claim.get('exp', 0) > time.time() \
+        and (user is None or (claim.get('ver') == user.role_version and claim.get('admin') == bool(user.is_admin)))
+
+def _store_role_claim(user):
+    if _role_claim_matches(session.get('role_claim'), user):
+        return # unchanged: no Set-Cookie
+    session['role_claim'] = {
+        'uid': user.id,
+        'admin': bool(user.is_admin),
+        'ver': user.role_version,
+        'exp': int(time.time()) + ROLE_CLAIM_TTL,
+    }
+
+def invalidate_role_claim():
+    """Drop the cached role for this session (call after its user's role changes)."""
+    session.pop('role_claim', None)
+    g.pop('is_admin', None)
+    g.pop('current_user', None)
+
 def check_admin_access():
-    if not is_logged_in(): return False
-    with app.app_context():
-        user = User.query.filter_by(id=session['user_id']).with_entities(User.is_admin).first()
-        return user and user.is_admin
-
-def generate_telegram_login_token(user):
-    """Generate a temporary login token for Telegram user (24 hours expiry)."""
-    token = secrets.token_urlsafe(32)
-    expires = datetime.now() + timedelta(hours=24)
-    user.telegram_login_token = token
-    user.telegram_token_expires = expires
-    db.session.commit()
-    print(f"✅ Generated login token for {user.username}")
-    return token
+    """Authoritative admin check (database-backed), memoized for the request."""
+    if 'is_admin' not in g:
+        user = get_current_user()
+        g.is_admin = bool(user and user.is_admin)
+        if user is not None:
+            _store_role_claim(user)
+    return g.is_admin
+
+def has_admin_role():
+    """Cheap admin flag for rendering: the session role claim while it is fresh."""
+    if not is_logged_in():
+        return False
+    if 'is_admin' in g:
+        return g.is_admin
+    claim = session.get('role_claim')
+    # Compared with the user's role version when the request loaded the user anyway
+    if _role_claim_matches(claim, g.get('current_user')):
+        return claim['admin']
+    return check_admin_access()
+
+def set_user_admin(user_id, is_admin):
+    """Grant or revoke admin (the caller commits). Bumps role_version, so the role
+    claims cached in the user's other sessions are dropped on their next check."""
+    return db.session.execute(
+        db.update(User).where(User.id == user_id)
+        .values(is_admin=is_admin, role_version=User.role_version + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+# Signed, stateless auto-login links (see telegram_auth.py). Keys come from
+# LOGIN_LINK_KEYS, falling back to SECRET_KEY.
+login_links = login_link_signer_from_env(app.secret_key)
+
+def telegram_login_link(user):
+    """Auto-login URL for bot replies (24 hours, nothing stored)."""
+    return f"https://g-task.onrender.com/telegram_auto_login/{login_links.sign(user.id)}"
 
 def send_notification_to_all_telegram_users(message):
-    TELEGRAM_BOT_TOKEN = BOT_TOKEN
-    
-    if not TELEGRAM_BOT_TOKEN:
-        print("Warning: TELEGRAM_BOT_TOKEN not configured. Skipping notification.")
+    """Queue a broadcast to every reachable Telegram user. Returns the broadcast id."""
+    if not BOT_TOKEN:
+        tg_log.warning('telegram.broadcast.skipped', reason='bot token not configured')
+        return None
+    broadcast_id = start_broadcast(message)
+    db.session.commit()
+    return broadcast_id
+
+# 2.1. የሥራ መውሰጃ ሞተር (Task Claim Engine)
+# Hands out inventory atomically: one round trip per claim on PostgreSQL, a
+# conditional-update fallback everywhere else (SQLite dev database).
+
+CLAIM_OK = 'CLAIMED'
+CLAIM_HAS_PENDING = 'HAS_PENDING'
+CLAIM_EMPTY = 'EMPTY'
+CLAIM_BUSY = 'BUSY'
+
+TASK_CLAIM_MAX_RETRIES = 5
+
+# Concurrent claimers skip rows another transaction has already locked, so a
+# burst of workers fans out over the FIFO head instead of queueing on one row.
+_PG_CLAIM_SQL = text("""
+    WITH picked AS (
+        SELECT id FROM inventory
+        WHERE status = 'AVAILABLE'
+          AND NOT EXISTS (
+              SELECT 1 FROM tasks WHERE user_id = :user_id AND status = 'PENDING'
+          )
+        ORDER BY date_added, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), claimed AS (
+        UPDATE inventory SET status = 'ASSIGNED'
+        FROM picked
+        WHERE inventory.id = picked.id
+        RETURNING inventory.id
+    ), counted AS (
+        UPDATE stat_counters SET value = value - 1
+        WHERE name = 'inventory_available' AND shard = :shard
+          AND EXISTS (SELECT 1 FROM claimed)
+    )
+    INSERT INTO tasks (inventory_id, user_id, status, date_assigned)
+    SELECT id, :user_id, 'PENDING', now() FROM claimed
+    RETURNING id
+""")
+
+def _user_has_pending_task(user_id):
+    return db.session.query(
+        Task.query.filter_by(user_id=user_id, status='PENDING').exists()
+    ).scalar()
+
+def _inventory_available():
+    return db.session.execute(
+        db.select(db.exists().where(Inventory.status == 'AVAILABLE'))
+    ).scalar()
+
+def _claim_task_postgresql(user_id):
+    for attempt in range(TASK_CLAIM_MAX_RETRIES):
+        task_id = db.session.execute(_PG_CLAIM_SQL, {
+            'user_id': user_id,
+            'shard': random.randrange(STAT_COUNTER_SHARDS)
+        }).scalar()
+        if task_id is not None:
+            db.session.commit()
+            return CLAIM_OK, task_id
+
+        db.session.rollback()
+        if _user_has_pending_task(user_id):
+            return CLAIM_HAS_PENDING, None
+        # SKIP LOCKED found nothing: empty queue, or every AVAILABLE row is locked
+        # by another claimer (this probe does not lock, so it still sees them)
+        if not _inventory_available():
+            return CLAIM_EMPTY, None
+
+    return CLAIM_BUSY, None
+
+def _claim_task_generic(user_id):
+    for attempt in range(TASK_CLAIM_MAX_RETRIES):
+        candidate_id = db.session.execute(text("""
+            SELECT id FROM inventory
+            WHERE status = 'AVAILABLE'
+              AND NOT EXISTS (
+                  SELECT 1 FROM tasks WHERE user_id = :user_id AND status = 'PENDING'
+              )
+            ORDER BY date_added, id
+            LIMIT 1
+        """), {'user_id': user_id}).scalar()
+
+        if candidate_id is None:
+            db.session.rollback()
+            if _user_has_pending_task(user_id):
+                return CLAIM_HAS_PENDING, None
+            return CLAIM_EMPTY, None
+
+        # Only flips the row if nobody else got there first
+        result = db.session.execute(
+            text("UPDATE inventory SET status = 'ASSIGNED' WHERE id = :id AND status = 'AVAILABLE'"),
+            {'id': candidate_id}
+        )
+        if result.rowcount != 1:
+            db.session.rollback()
+            continue
+
+        new_task = Task(inventory_id=candidate_id, user_id=user_id, status='PENDING')
+        db.session.add(new_task)
+        bump_stat_counters(inventory_available=-1)
+        db.session.commit()
+        return CLAIM_OK, new_task.id
+
+    return CLAIM_BUSY, None
+
+def _is_one_pending_violation(error):
+    """Whether an IntegrityError comes from uq_tasks_one_pending_per_user."""
+    constraint = getattr(getattr(error.orig, 'diag', None), 'constraint_name', None)
+    if constraint is not None: # psycopg2
+        return constraint == 'uq_tasks_one_pending_per_user'
+    return 'tasks.user_id' in str(error.orig) # SQLite: UNIQUE constraint failed: tasks.user_id
+
+def claim_task_for_user(user_id):
+    """Atomically assign the oldest AVAILABLE inventory row to a worker.
+
+    Returns (outcome, task_id) where outcome is one of CLAIM_OK,
+    CLAIM_HAS_PENDING, CLAIM_EMPTY or CLAIM_BUSY.
+    """
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            return _claim_task_postgresql(user_id)
+        return _claim_task_generic(user_id)
+    except IntegrityError as e:
+        db.session.rollback()
+        if _is_one_pending_violation(e):
+            # A concurrent claim by the same worker won
+            return CLAIM_HAS_PENDING, None
+        raise
+    except Exception:
+        db.session.rollback()
+        raise
+
+# 2.2. የቴሌግራም መልእክት መውጫ (Telegram Outbox)
+# Every outbound Bot API call is a telegram_outbox row written in the caller's
+# transaction, so a payout marked PAID and its notice commit together or not at
+# all, and no request waits on Telegram. One process at a time dispatches (the
+# holder of a PostgreSQL advisory lock; another worker or the poller takes over
+# when it dies), so TELEGRAM_RATE_PER_SEC is the bot's whole budget. Its
+# dispatcher threads claim due rows in batches (FOR UPDATE SKIP LOCKED) and
+# send them over one keep-alive session:
+#   - two lanes: replies, login links and payment notices (OUTBOX_PRIORITY_INTERACTIVE)
+#     go before broadcast rows (OUTBOX_PRIORITY_BULK), so they never wait behind one;
+#   - per chat, calls go out one at a time in id order, except that an
+#     interactive call skips ahead of the chat's queued broadcast message;
+#   - network errors and 5xx retry with exponential backoff, a 429 waits out
+#     retry_after (without using up an attempt);
+#   - 403 (bot blocked), other 4xx and exhausted attempts end DEAD, with the
+#     error kept (`flask --app main outbox-requeue` sends them again).
+# A broadcast is one INSERT ... SELECT of a row per reachable user.
+
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org').rstrip('/') # or a local stand-in Bot API
+TELEGRAM_API_TIMEOUT = 10
+OUTBOX_DISPATCHERS = int(os.environ.get('OUTBOX_DISPATCHERS', '1'))
+OUTBOX_SENDERS = int(os.environ.get('OUTBOX_SENDERS', '8'))
+TELEGRAM_RATE_PER_SEC = float(os.environ.get('TELEGRAM_RATE_PER_SEC', '25')) # whole bot; Telegram allows ~30/s
+TELEGRAM_PER_CHAT_INTERVAL = 1.0 # Telegram allows ~1 message/s per chat
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 0.5 # seconds; picks up rows committed by other workers
+OUTBOX_LEADER_LOCK_KEY = 74_201_102 # advisory lock held by the dispatching process
+OUTBOX_LEADER_CHECK_INTERVAL = 15.0 # seconds between lock attempts / liveness checks
+OUTBOX_LEASE = timedelta(minutes=5) # SENDING rows older than this were orphaned by a dead worker
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 2.0 # seconds: 2, 4, 8, ... between attempts
+OUTBOX_BACKOFF_MAX = 3600.0
+OUTBOX_RETENTION = timedelta(days=2)
+OUTBOX_DEAD_RETENTION = timedelta(days=14)
+OUTBOX_PRIORITY_INTERACTIVE = 0
+OUTBOX_PRIORITY_BULK = 1
+
+_telegram_session = None
+_telegram_senders = None
+_telegram_limiter = None
+_chat_throttle = None
+_executors_pid = None
+_executors_lock = threading.Lock()
+_outbox_wakeup = threading.Event()
+_outbox_leader = threading.Event()
+_outbox_dispatchers_pid = None
+_outbox_dispatchers_lock = threading.Lock()
+_last_outbox_prune = 0.0
+
+def telegram_api_url(method):
+    return f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/{method}"
+
+def _ensure_executors():
+    """Create the HTTP session, sender pool and rate limits lazily, once per worker process."""
+    global _telegram_session, _telegram_senders, _telegram_limiter, _chat_throttle, _executors_pid
+    with _executors_lock:
+        if _executors_pid != os.getpid():
+            session_ = requests.Session()
+            adapter = metrics.TelegramMetricsAdapter(pool_connections=1, pool_maxsize=OUTBOX_SENDERS + 2)
+            session_.mount('https://', adapter)
+            session_.mount('http://', adapter)
+            _telegram_session = session_
+            _telegram_senders = ThreadPoolExecutor(max_workers=OUTBOX_SENDERS, thread_name_prefix='telegram-send')
+            _telegram_limiter = RateLimiter(TELEGRAM_RATE_PER_SEC)
+            _chat_throttle = ChatThrottle(TELEGRAM_PER_CHAT_INTERVAL)
+            _executors_pid = os.getpid()
+
+def get_telegram_session():
+    _ensure_executors()
+    return _telegram_session
+
+def _retry_after(response, default=1):
+    try:
+        return int(response.json().get('parameters', {}).get('retry_after', default))
+    except Exception:
+        return default
+
+class RateLimiter:
+    """Thread-safe token bucket shared by all sender threads of a process."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds` (Telegram 429 retry_after)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ChatThrottle:
+    """Keeps at least `interval` seconds between two sends to the same chat."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(chat_id, 0.0))
+            self.next_slot[chat_id] = slot + self.interval
+            if len(self.next_slot) > 10000:
+                # Forget chats whose slot has passed; they no longer constrain anything
+                self.next_slot = {chat: due for chat, due in self.next_slot.items() if due > now}
+        if slot > now:
+            time.sleep(slot - now)
+
+def enqueue_telegram_call(method, params, chat_id=None, user_id=None):
+    """Add one Bot API call to the outbox in the current transaction; it is sent after commit."""
+    db.session.add(TelegramOutbox(
+        method=method,
+        chat_id=str(chat_id) if chat_id is not None else None,
+        user_id=user_id,
+        payload=json.dumps(params),
+        status='PENDING',
+        attempts=0,
+        priority=OUTBOX_PRIORITY_INTERACTIVE,
+        next_attempt_at=datetime.now(),
+    ))
+    db.session.info['outbox_wakeup'] = True
+
+def enqueue_telegram_message(chat_id, message, user_id=None, **params):
+    """Outbox a sendMessage to `chat_id` (extra Bot API parameters as keywords)."""
+    enqueue_telegram_call('sendMessage', dict(params, text=message), chat_id=chat_id, user_id=user_id)
+
+def start_broadcast(message):
+    """Outbox `message` for every reachable user in the current transaction. Returns the broadcast id."""
+    now = datetime.now()
+    broadcast = Broadcast(message=message, status='RUNNING')
+    db.session.add(broadcast)
+    db.session.flush()
+
+    result = db.session.execute(
+        db.insert(TelegramOutbox).from_select(
+            ['method', 'chat_id', 'user_id', 'broadcast_id', 'payload', 'status', 'attempts',
+             'priority', 'next_attempt_at', 'date_created'],
+            db.select(db.literal('sendMessage'), User.telegram_id, User.id, db.literal(broadcast.id),
+                      db.literal(json.dumps({'text': message})), db.literal('PENDING'), db.literal(0),
+                      db.literal(OUTBOX_PRIORITY_BULK), db.literal(now), db.literal(now))
+            .where(User.telegram_id.isnot(None), User.telegram_blocked.isnot(True))
+        )
+    )
+    broadcast.total = result.rowcount
+    if not broadcast.total:
+        broadcast.status = 'DONE'
+        broadcast.date_finished = now
+    db.session.info['outbox_wakeup'] = True
+    return broadcast.id
+
+PAYMENT_NOTICE = "💰 እንኳን ደስ አልዎት! ደሞዝህ ብር {amount:.2f} ወደ ዋሌትህ ተልኳል - እባክዎን ዋሌትዎን ቼክ ያድርጉ"
+
+def enqueue_payment_notifications(payments):
+    """Outbox one notice per reachable user for paid payouts [(user_id, amount)], in the current transaction."""
+    amounts = {}
+    for user_id, amount in payments:
+        amounts[user_id] = amounts.get(user_id, 0.0) + amount
+    if not amounts:
         return
-    
+    if not BOT_TOKEN:
+        tg_log.warning('telegram.payment_notice.skipped', reason='bot token not configured', users=len(amounts))
+        return
+    now = datetime.now()
+    user_ids = sorted(amounts)
+    for start in range(0, len(user_ids), OUTBOX_BATCH_SIZE * 5):
+        rows = db.session.execute(
+            db.select(User.id, User.telegram_id)
+            .where(User.id.in_(user_ids[start:start + OUTBOX_BATCH_SIZE * 5]),
+                   User.telegram_id.isnot(None), User.telegram_blocked.isnot(True))
+        ).all()
+        if rows:
+            db.session.execute(db.insert(TelegramOutbox), [
+                dict(method='sendMessage', chat_id=row.telegram_id, user_id=row.id,
+                     payload=json.dumps({'text': PAYMENT_NOTICE.format(amount=amounts[row.id])}),
+                     status='PENDING', attempts=0, priority=OUTBOX_PRIORITY_INTERACTIVE,
+                     next_attempt_at=now, date_created=now)
+                for row in rows
+            ])
+    db.session.info['outbox_wakeup'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_outbox_after_commit(session_):
+    if session_.info.pop('outbox_wakeup', False):
+        _ensure_outbox_dispatchers()
+        _outbox_wakeup.set()
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_outbox_wakeup(session_):
+    session_.info.pop('outbox_wakeup', None)
+
+def _claim_outbox_batch():
+    """Lease the due calls that are next in line for their chat, interactive lane first. Returns their rows."""
+    now = datetime.now()
+    lock = 'FOR UPDATE SKIP LOCKED' if db.engine.dialect.name == 'postgresql' else ''
+    rows = db.session.execute(text(f"""
+        UPDATE telegram_outbox
+        SET status = 'SENDING', attempts = attempts + 1, next_attempt_at = :lease_until
+        WHERE id IN (
+            SELECT id FROM telegram_outbox o
+            WHERE o.status IN ('PENDING', 'SENDING') AND o.next_attempt_at <= :now
+              AND NOT EXISTS (
+                  SELECT 1 FROM telegram_outbox e
+                  WHERE e.chat_id = o.chat_id AND e.status IN ('PENDING', 'SENDING') AND e.id < o.id
+                    AND e.priority <= o.priority
+              )
+            ORDER BY o.priority, o.next_attempt_at, o.id
+            LIMIT :limit
+            {lock}
+        )
+        RETURNING id, method, chat_id, user_id, broadcast_id, payload, attempts, priority
+    """), {'now': now, 'lease_until': now + OUTBOX_LEASE, 'limit': OUTBOX_BATCH_SIZE}).all()
+    db.session.commit()
+    # RETURNING order is unspecified; hand them to the senders lane by lane
+    return sorted(rows, key=lambda row: (row.priority, row.id))
+
+def _deliver_outbox_call(row):
+    """Send one claimed call. Returns (outcome, retry_in, error); outcome is
+    'sent', 'blocked', 'dead', 'retry' or 'throttled' (429)."""
+    if row.attempts > OUTBOX_MAX_ATTEMPTS:
+        return 'dead', None, 'attempts exhausted'
+    params = json.loads(row.payload)
+    if row.chat_id is not None:
+        params['chat_id'] = row.chat_id
+        _chat_throttle.wait(row.chat_id)
+    _telegram_limiter.acquire()
+    try:
+        response = get_telegram_session().post(telegram_api_url(row.method), json=params,
+                                               timeout=TELEGRAM_API_TIMEOUT)
+    except requests.RequestException as e:
+        return 'retry', None, type(e).__name__
+
+    if response.status_code == 200:
+        return 'sent', None, None
+    if response.status_code == 403:
+        return 'blocked', None, 'blocked'
+    if response.status_code == 429:
+        retry_in = _retry_after(response)
+        _telegram_limiter.pause(retry_in)
+        return 'throttled', retry_in, 'HTTP 429'
+    if response.status_code >= 500:
+        return 'retry', None, f'HTTP {response.status_code}'
+    return 'dead', None, f'HTTP {response.status_code}: {response.text}'[:255]
+
+def _finish_outbox_batch(results):
+    """Record the outcome of every delivered call, and broadcast progress, in one transaction."""
+    now = datetime.now()
+    changes = []
+    blocked_user_ids = []
+    broadcast_counts = {}
+    for row, outcome, retry_in, error in results:
+        metrics.TELEGRAM_OUTBOX.labels(outcome).inc()
+        if outcome in ('retry', 'throttled'):
+            attempts = row.attempts - 1 if outcome == 'throttled' else row.attempts
+            if attempts < OUTBOX_MAX_ATTEMPTS:
+                if retry_in is None:
+                    retry_in = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                    retry_in *= random.uniform(0.8, 1.2) # spread retries of one outage
+                changes.append({'id': row.id, 'status': 'PENDING', 'attempts': attempts, 'last_error': error,
+                                'next_attempt_at': now + timedelta(seconds=retry_in)})
+                continue
+            outcome = 'dead'
+
+        if outcome == 'sent':
+            changes.append({'id': row.id, 'status': 'SENT', 'date_sent': now, 'last_error': None})
+        else:
+            changes.append({'id': row.id, 'status': 'DEAD', 'last_error': error})
+            tg_log.warning('telegram.outbox.dead', outbox_id=row.id, method=row.method,
+                           chat_id=row.chat_id, error=error)
+            if outcome == 'blocked' and row.user_id is not None:
+                blocked_user_ids.append(row.user_id)
+        if row.broadcast_id is not None:
+            counts = broadcast_counts.setdefault(row.broadcast_id, {'sent': 0, 'failed': 0, 'blocked': 0})
+            counts['sent' if outcome == 'sent' else 'blocked' if outcome == 'blocked' else 'failed'] += 1
+
+    db.session.execute(db.update(TelegramOutbox), changes)
+    if blocked_user_ids:
+        db.session.execute(
+            db.update(User).where(User.id.in_(blocked_user_ids)).values(telegram_blocked=True)
+        )
+    for broadcast_id, counts in sorted(broadcast_counts.items()):
+        done = Broadcast.sent + Broadcast.failed + Broadcast.blocked + sum(counts.values()) >= Broadcast.total
+        db.session.execute(
+            db.update(Broadcast).where(Broadcast.id == broadcast_id).values(
+                sent=Broadcast.sent + counts['sent'],
+                failed=Broadcast.failed + counts['failed'],
+                blocked=Broadcast.blocked + counts['blocked'],
+                status=db.case((done, 'DONE'), else_=Broadcast.status),
+                date_finished=db.case((done, now), else_=Broadcast.date_finished),
+            )
+        )
+    db.session.commit()
+
+def _prune_outbox():
+    global _last_outbox_prune
+    if time.monotonic() - _last_outbox_prune < 3600:
+        return
+    _last_outbox_prune = time.monotonic()
+    now = datetime.now()
+    for status, retention in (('SENT', OUTBOX_RETENTION), ('DEAD', OUTBOX_DEAD_RETENTION)):
+        db.session.execute(
+            db.delete(TelegramOutbox).where(TelegramOutbox.status == status,
+                                            TelegramOutbox.date_created < now - retention)
+        )
+    db.session.commit()
+
+def _outbox_leader_loop():
+    """Become (and stay) the one dispatching process: hold the advisory lock on a
+    dedicated connection, checking it every OUTBOX_LEADER_CHECK_INTERVAL."""
     with app.app_context():
-        users_with_telegram = User.query.filter(User.telegram_id.isnot(None)).all()
-        
-        if not users_with_telegram:
-            print("No users with Telegram ID found.")
-            return
-        
-        api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        
-        success_count = 0
-        failed_count = 0
-        
-        for user in users_with_telegram:
+        engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        _outbox_leader.set() # SQLite: one development host
+        return
+    while True:
+        conn = None
+        try:
+            conn = engine.connect()
+            if conn.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': OUTBOX_LEADER_LOCK_KEY}).scalar():
+                conn.commit()
+                _outbox_leader.set()
+                tg_log.info('telegram.outbox.leader', pid=os.getpid())
+                while True:
+                    time.sleep(OUTBOX_LEADER_CHECK_INTERVAL)
+                    # Raises once the connection, and with it the lock, is gone
+                    conn.execute(text('SELECT 1'))
+                    conn.commit()
+            conn.rollback()
+            conn.close()
+        except Exception as e:
+            tg_log.exception('telegram.outbox.leader_lost' if _outbox_leader.is_set() else 'telegram.outbox.leader_error')
+            if conn is not None:
+                conn.invalidate() # closes the DBAPI connection, releasing the lock if we still had it
+        _outbox_leader.clear()
+        time.sleep(OUTBOX_LEADER_CHECK_INTERVAL)
+
+def _outbox_dispatcher_loop():
+    _ensure_executors()
+    while True:
+        if not _outbox_leader.is_set():
+            _outbox_leader.wait(OUTBOX_LEADER_CHECK_INTERVAL)
+            continue
+        _outbox_wakeup.clear()
+        claimed = []
+        try:
+            with app.app_context():
+                claimed = _claim_outbox_batch()
+                if not claimed:
+                    _prune_outbox()
+        except Exception as e:
+            tg_log.exception('telegram.outbox.claim_failed')
+
+        if not claimed:
+            _outbox_wakeup.wait(OUTBOX_POLL_INTERVAL)
+            continue
+
+        futures = [(row, _telegram_senders.submit(_deliver_outbox_call, row)) for row in claimed]
+        results = []
+        for row, future in futures:
             try:
-                response = requests.post(api_url, data={
-                    'chat_id': user.telegram_id,
-                    'text': message
-                })
-                if response.status_code == 200:
-                    success_count += 1
-                else:
-                    failed_count += 1
-                    print(f"Failed to send to user {user.username}: {response.text}")
+                results.append((row, *future.result()))
             except Exception as e:
-                failed_count += 1
-                print(f"Error sending to user {user.username}: {str(e)}")
-        
-        print(f"Telegram notifications sent: {success_count} successful, {failed_count} failed")
+                tg_log.exception('telegram.outbox.send_failed', outbox_id=row.id)
+                results.append((row, 'retry', None, type(e).__name__))
 
-def send_payment_notification(user_id, amount):
-    """Send payment approval notification to Telegram user"""
-    import requests
-    
-    TELEGRAM_BOT_TOKEN = BOT_TOKEN
-    
-    if not TELEGRAM_BOT_TOKEN:
-        print("Warning: TELEGRAM_BOT_TOKEN not configured. Skipping payment notification.")
+        try:
+            with app.app_context():
+                _finish_outbox_batch(results)
+        except Exception as e:
+            # The leases expire and the calls are retried (at least once delivery)
+            tg_log.exception('telegram.outbox.finish_failed', batch=len(results))
+
+def _ensure_outbox_dispatchers():
+    """Start this worker's leader and dispatcher threads (once per process, only with a bot token)."""
+    global _outbox_dispatchers_pid
+    if _outbox_dispatchers_pid == os.getpid() or not BOT_TOKEN:
         return
-    
-    with app.app_context():
-        user = User.query.filter_by(id=user_id).first()
-        
-        if not user or not user.telegram_id:
-            print(f"User {user_id} not found or has no Telegram ID.")
+    with _outbox_dispatchers_lock:
+        if _outbox_dispatchers_pid == os.getpid():
             return
-        
-        message = f"💰 እንኳን ደስ አልዎት! ደሞዝህ ብር {amount:.2f} ወደ ዋሌትህ ተልኳል - እባክዎን ዋሌትዎን ቼክ ያድርጉ"
-        
-        api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        
+        threading.Thread(target=_outbox_leader_loop, name='outbox-leader', daemon=True).start()
+        for i in range(OUTBOX_DISPATCHERS):
+            threading.Thread(target=_outbox_dispatcher_loop, name=f'outbox-dispatcher-{i}', daemon=True).start()
+        _outbox_dispatchers_pid = os.getpid()
+
+@app.before_request
+def _start_outbox_dispatchers():
+    # Also drains calls left behind by a previous process, before anything new is queued
+    _ensure_outbox_dispatchers()
+
+# 2.3. የዌብሁክ ወረፋ (Webhook Ingestion Queue)
+# The webhook only persists the update (INSERT ... ON CONFLICT DO NOTHING on
+# update_id) and answers Telegram. A bounded pool of consumer threads in every
+# worker claims PENDING rows from the shared table and processes them, so
+# several gunicorn workers or instances can drain the same queue safely.
+
+WEBHOOK_CONSUMERS = int(os.environ.get('WEBHOOK_CONSUMERS', '4'))
+UPDATE_POLL_INTERVAL = 2.0 # seconds; picks up rows enqueued by other workers
+UPDATE_STALE_AFTER = timedelta(minutes=5) # PROCESSING rows older than this were orphaned by a dead worker
+UPDATE_MAX_ATTEMPTS = 3
+UPDATE_BACKOFF_BASE = 5.0 # seconds before the first retry, doubled after each failure
+UPDATE_RETENTION = timedelta(days=2)
+
+_update_wakeup = threading.Event()
+_update_consumers_pid = None
+_update_consumers_lock = threading.Lock()
+_last_update_prune = 0.0
+
+def insert_ignore(model):
+    """INSERT ... ON CONFLICT DO NOTHING for the active database dialect."""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model).on_conflict_do_nothing()
+
+def enqueue_telegram_update(update_data):
+    """Persist an incoming update. Returns False if update_id was already queued."""
+    update_id = update_data.get('update_id')
+    if update_id is None:
+        return False
+
+    result = db.session.execute(
+        insert_ignore(TelegramUpdate).values(
+            update_id=update_id,
+            payload=json.dumps(update_data),
+            status='PENDING',
+            attempts=0,
+            date_received=datetime.now()
+        )
+    )
+    db.session.commit()
+
+    _ensure_update_consumers()
+    _update_wakeup.set()
+    return result.rowcount == 1
+
+def _claim_next_update():
+    """Mark the oldest claimable update PROCESSING. Returns (update_id, payload, attempts) or None."""
+    now = datetime.now()
+    params = {'stale_before': now - UPDATE_STALE_AFTER, 'now': now, 'max_attempts': UPDATE_MAX_ATTEMPTS}
+    claimable = """
+        ((status = 'PENDING' AND (next_attempt_at IS NULL OR next_attempt_at <= :now))
+         OR (status = 'PROCESSING' AND locked_at < :stale_before))
+        AND attempts < :max_attempts
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(text(f"""
+            UPDATE telegram_updates
+            SET status = 'PROCESSING', locked_at = :now, attempts = attempts + 1
+            WHERE update_id = (
+                SELECT update_id FROM telegram_updates
+                WHERE {claimable}
+                ORDER BY update_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING update_id, payload, attempts
+        """), params).first()
+        db.session.commit()
+        return (row.update_id, row.payload, row.attempts) if row else None
+
+    candidate_id = db.session.execute(text(f"""
+        SELECT update_id FROM telegram_updates
+        WHERE {claimable}
+        ORDER BY update_id
+        LIMIT 1
+    """), params).scalar()
+    if candidate_id is None:
+        db.session.rollback()
+        return None
+
+    result = db.session.execute(text(f"""
+        UPDATE telegram_updates
+        SET status = 'PROCESSING', locked_at = :now, attempts = attempts + 1
+        WHERE update_id = :update_id AND {claimable}
+    """), dict(params, update_id=candidate_id))
+    if result.rowcount != 1:
+        db.session.rollback()
+        return None
+    row = db.session.execute(
+        db.select(TelegramUpdate.payload, TelegramUpdate.attempts)
+        .where(TelegramUpdate.update_id == candidate_id)
+    ).first()
+    db.session.commit()
+    return candidate_id, row.payload, row.attempts
+
+def _finish_update(update_id, succeeded, attempts):
+    now = datetime.now()
+    if succeeded:
+        values = {'status': 'DONE'}
+    elif attempts >= UPDATE_MAX_ATTEMPTS:
+        values = {'status': 'FAILED'}
+    else:
+        # Back to the queue, after a backoff: 5s, 10s, ...
+        values = {'status': 'PENDING',
+                  'next_attempt_at': now + timedelta(seconds=UPDATE_BACKOFF_BASE * 2 ** (attempts - 1))}
+    db.session.execute(
+        db.update(TelegramUpdate).where(TelegramUpdate.update_id == update_id)
+        .values(date_processed=now, **values)
+    )
+    db.session.commit()
+
+def _prune_processed_updates():
+    global _last_update_prune
+    if time.monotonic() - _last_update_prune < 3600:
+        return
+    _last_update_prune = time.monotonic()
+    # Orphaned by a dead worker on their last attempt: nothing will claim them again
+    db.session.execute(
+        db.update(TelegramUpdate).where(
+            TelegramUpdate.status == 'PROCESSING',
+            TelegramUpdate.locked_at < datetime.now() - UPDATE_STALE_AFTER,
+            TelegramUpdate.attempts >= UPDATE_MAX_ATTEMPTS
+        ).values(status='FAILED', date_processed=datetime.now())
+    )
+    db.session.execute(
+        db.delete(TelegramUpdate).where(
+            TelegramUpdate.status.in_(['DONE', 'FAILED']),
+            TelegramUpdate.date_received < datetime.now() - UPDATE_RETENTION
+        )
+    )
+    db.session.commit()
+
+def _update_consumer_loop():
+    while True:
+        claimed = None
         try:
-            response = requests.post(api_url, data={
-                'chat_id': user.telegram_id,
-                'text': message
-            })
-            if response.status_code == 200:
-                print(f"✅ Payment notification sent to {user.username}")
-            else:
-                print(f"Failed to send payment notification: {response.text}")
+            with app.app_context():
+                claimed = _claim_next_update()
+                if claimed is None:
+                    _prune_processed_updates()
+        except Exception as e:
+            queue_log.exception('update_queue.error')
+
+        if claimed is None:
+            _update_wakeup.clear()
+            _update_wakeup.wait(UPDATE_POLL_INTERVAL)
+            continue
+
+        update_id, payload, attempts = claimed
+        try:
+            # False means skipped on purpose (nothing to retry); errors raise
+            process_telegram_message(json.loads(payload))
+            succeeded = True
+        except Exception as e:
+            queue_log.exception('update_queue.process_failed', update_id=update_id, attempts=attempts)
+            succeeded = False
+        metrics.UPDATES_PROCESSED.labels('ok' if succeeded else 'error').inc()
+
+        try:
+            with app.app_context():
+                _finish_update(update_id, succeeded, attempts)
+        except Exception as e:
+            queue_log.exception('update_queue.finish_failed', update_id=update_id)
+
+def _ensure_update_consumers():
+    """Start this worker's consumer threads (once per process)."""
+    global _update_consumers_pid
+    if _update_consumers_pid == os.getpid():
+        return
+    with _update_consumers_lock:
+        if _update_consumers_pid == os.getpid():
+            return
+        for i in range(WEBHOOK_CONSUMERS):
+            threading.Thread(target=_update_consumer_loop, name=f'update-consumer-{i}', daemon=True).start()
+        _update_consumers_pid = os.getpid()
+
+# 2.3.1. የቴሌግራም ሎንግ ፖሊንግ (getUpdates Long Polling, the alternative to /webhook)
+# `flask --app main telegram-poll` pulls updates in batches with getUpdates and
+# feeds them to the same queue and consumer pool as the webhook, so the bot can
+# run as its own process (bot load isolated from web traffic) or against a
+# local stand-in Bot API (TELEGRAM_API_BASE) without a public URL. A batch and
+# the offset after it commit in one transaction: after a crash polling resumes
+# at the first update that was not stored, and Telegram delivers it again.
+
+TELEGRAM_POLL_TIMEOUT = int(os.environ.get('TELEGRAM_POLL_TIMEOUT', '25')) # seconds Telegram holds an empty getUpdates
+TELEGRAM_POLL_LIMIT = 100 # Bot API maximum per getUpdates
+TELEGRAM_POLL_OFFSET_MAX_AGE = timedelta(days=6) # after a week without updates Telegram restarts update ids at random
+TELEGRAM_POLL_RETRY_MAX = 60.0
+
+def _load_poll_offset():
+    """The stored next offset, or None when there is none (or it is too old to trust)."""
+    row = db.session.execute(
+        db.select(TelegramPollState.next_offset, TelegramPollState.date_updated)
+        .where(TelegramPollState.name == 'getUpdates')
+    ).first()
+    db.session.rollback()
+    if row is None or row.date_updated < datetime.now() - TELEGRAM_POLL_OFFSET_MAX_AGE:
+        return None
+    return row.next_offset
+
+def _store_polled_updates(updates):
+    """Queue a getUpdates batch and move the offset past it, in one transaction. Returns the next offset."""
+    now = datetime.now()
+    next_offset = max(update['update_id'] for update in updates) + 1
+    db.session.execute(insert_ignore(TelegramUpdate), [
+        dict(update_id=update['update_id'], payload=json.dumps(update), status='PENDING',
+             attempts=0, date_received=now)
+        for update in updates
+    ])
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    db.session.execute(
+        dialect.insert(TelegramPollState)
+        .values(name='getUpdates', next_offset=next_offset, date_updated=now)
+        .on_conflict_do_update(index_elements=[TelegramPollState.name],
+                               set_={'next_offset': next_offset, 'date_updated': now})
+    )
+    db.session.commit()
+    return next_offset
+
+def run_telegram_poller(stop=None):
+    """Long-poll getUpdates until `stop` (a threading.Event) is set. Runs in the calling thread."""
+    stop = stop or threading.Event()
+    session_ = get_telegram_session()
+    _ensure_update_consumers()
+    
+    started = False
+    offset = None
+    failures = 0
+    while not stop.is_set():
+        try:
+            if not started:
+                # getUpdates is refused (409) while a webhook is set; pending updates
+                # stay queued at Telegram. Retried with the same backoff as getUpdates.
+                response = session_.post(telegram_api_url('deleteWebhook'), json={'drop_pending_updates': False},
+                                         timeout=TELEGRAM_API_TIMEOUT)
+                if response.status_code != 200:
+                    raise RuntimeError(f"deleteWebhook HTTP {response.status_code}: {response.text[:200]}")
+                with app.app_context():
+                    offset = _load_poll_offset()
+                started = True
+                tg_log.info('telegram.poll.started', offset=offset, api_base=TELEGRAM_API_BASE)
+            
+            params = {'timeout': TELEGRAM_POLL_TIMEOUT, 'limit': TELEGRAM_POLL_LIMIT, 'allowed_updates': ['message']}
+            if offset is not None:
+                params['offset'] = offset
+            response = session_.post(telegram_api_url('getUpdates'), json=params,
+                                     timeout=TELEGRAM_POLL_TIMEOUT + TELEGRAM_API_TIMEOUT)
+            if response.status_code == 429:
+                retry_in = _retry_after(response)
+                tg_log.warning('telegram.poll.throttled', retry_after=retry_in)
+                stop.wait(retry_in)
+                continue
+            if response.status_code != 200:
+                raise RuntimeError(f"getUpdates HTTP {response.status_code}: {response.text[:200]}")
+            updates = response.json().get('result', [])
+            if updates:
+                with app.app_context():
+                    offset = _store_polled_updates(updates)
+                metrics.WEBHOOK_UPDATES.labels('polled').inc(len(updates))
+                _update_wakeup.set()
+                tg_log.debug('telegram.poll.batch', updates=len(updates), next_offset=offset)
+            failures = 0
         except Exception as e:
-            print(f"Error sending payment notification: {str(e)}")
+            failures += 1
+            retry_in = min(2.0 ** failures, TELEGRAM_POLL_RETRY_MAX)
+            tg_log.exception('telegram.poll.failed', failures=failures, retry_in=retry_in)
+            stop.wait(retry_in)
+    tg_log.info('telegram.poll.stopped', offset=offset)
+
+# 2.4. የክምችት በብዛት ማስገቢያ (Bulk Inventory Import)
+# Parses `username:password[:recovery_email]` lines as a stream and inserts
+# them in chunks: one set-based duplicate lookup plus one multi-row
+# INSERT ... ON CONFLICT DO NOTHING per chunk instead of a commit per line.
+
+INVENTORY_IMPORT_CHUNK = 5000
+INVENTORY_FIELD_MAX_LENGTH = 120
+IMPORT_REPORT_MAX_ERRORS = 500
+
+class ImportReport:
+    """Outcome of one bulk import: counters plus a capped per-line error list."""
+
+    def __init__(self):
+        self.total_lines = 0
+        self.inserted = 0
+        self.error_count = 0
+        self.errors = [] # (line_no, reason, entry)
+
+    def add_error(self, line_no, reason, entry):
+        self.error_count += 1
+        if len(self.errors) < IMPORT_REPORT_MAX_ERRORS:
+            self.errors.append((line_no, reason, entry[:80]))
+
+def _parse_inventory_line(line):
+    """Returns (row, None) or (None, reason)."""
+    if ':' not in line:
+        return None, 'Missing separator'
+    
+    parts = line.split(':')
+    username = parts[0].strip()
+    password = parts[1].strip()
+    recovery_email = parts[2].strip() if len(parts) > 2 else ''
+    
+    if not username or not password:
+        return None, 'Invalid format'
+    if max(len(username), len(password), len(recovery_email)) > INVENTORY_FIELD_MAX_LENGTH:
+        return None, 'Value too long'
+    
+    return {
+        'gmail_username': username,
+        'gmail_password': password,
+        'recovery_email': recovery_email or None,
+        'status': 'AVAILABLE',
+    }, None
+
+def _import_inventory_chunk(chunk, report):
+    """chunk: list of (line_no, row). Inserts new usernames, reports the rest."""
+    usernames = [row['gmail_username'] for _, row in chunk]
+    existing = set(db.session.execute(
+        db.select(Inventory.gmail_username).where(Inventory.gmail_username.in_(usernames))
+    ).scalars())
+    
+    fresh = []
+    for line_no, row in chunk:
+        if row['gmail_username'] in existing:
+            report.add_error(line_no, 'Duplicate', row['gmail_username'])
+        else:
+            fresh.append((line_no, row))
+    
+    if fresh:
+        # ON CONFLICT covers rows another import committed after our lookup
+        inserted = set(db.session.execute(
+            insert_ignore(Inventory).returning(Inventory.gmail_username),
+            [row for _, row in fresh]
+        ).scalars())
+        for line_no, row in fresh:
+            if row['gmail_username'] not in inserted:
+                report.add_error(line_no, 'Duplicate', row['gmail_username'])
+        report.inserted += len(inserted)
+        bump_stat_counters(inventory_available=len(inserted))
+    
+    db.session.commit()
+    if fresh:
+        metrics.INVENTORY_IMPORTED.inc(len(inserted))
+
+def import_inventory(lines):
+    """Bulk-import inventory from an iterable of text lines. Returns an ImportReport."""
+    report = ImportReport()
+    seen = set()
+    chunk = []
+    
+    try:
+        for line_no, line in enumerate(lines, start=1):
+            report.total_lines = line_no
+            line = line.strip()
+            if not line:
+                continue
+            
+            row, reason = _parse_inventory_line(line)
+            if reason:
+                report.add_error(line_no, reason, line)
+                continue
+            if row['gmail_username'] in seen:
+                report.add_error(line_no, 'Duplicate in upload', row['gmail_username'])
+                continue
+            seen.add(row['gmail_username'])
+            
+            chunk.append((line_no, row))
+            if len(chunk) >= INVENTORY_IMPORT_CHUNK:
+                _import_inventory_chunk(chunk, report)
+                chunk = []
+        
+        if chunk:
+            _import_inventory_chunk(chunk, report)
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    report.errors.sort()
+    return report
+
+# 2.5. የሰራተኛ ዳሽቦርድ መጠይቆች (Worker Dashboard Queries)
+# The dashboard costs the same no matter how long a worker's history is: one
+# statement for the header (user, open task + its inventory row, status
+# counts, "is anything available") and one keyset page of history.
+
+DASHBOARD_HISTORY_PAGE_SIZE = 20
+
+class DashboardHeader:
+    def __init__(self, user, current_task, inventory_available, task_counts, checkin_streak, checked_in_today):
+        self.user = user
+        self.current_task = current_task
+        self.inventory_available = inventory_available
+        self.task_counts = task_counts
+        self.checkin_streak = checkin_streak
+        self.checked_in_today = checked_in_today
+
+def encode_cursor(date_value, row_id):
+    """Keyset cursor for (date, id) ordered listings."""
+    return f"{date_value.isoformat() if date_value else ''}_{row_id}"
+
+def decode_cursor(cursor):
+    """Returns (date, id) or None for a missing/garbled cursor."""
+    try:
+        date_part, id_part = cursor.rsplit('_', 1)
+        return (datetime.fromisoformat(date_part) if date_part else None), int(id_part)
+    except (AttributeError, ValueError):
+        return None
+
+def keyset_position(position):
+    """(date, id) from decode_cursor() as bind values for a row comparison."""
+    date_value, row_id = position
+    # SQLite stores func.now() as 'YYYY-MM-DD HH:MM:SS' text but binds a datetime
+    # with '.000000' appended, which sorts after it: compare in the stored format
+    if db.engine.dialect.name == 'sqlite' and not date_value.microsecond:
+        date_value = date_value.strftime('%Y-%m-%d %H:%M:%S')
+    return date_value, row_id
+
+def _task_count(user_id, status=None):
+    query = db.select(func.count(Task.id)).where(Task.user_id == user_id)
+    if status:
+        query = query.where(Task.status == status)
+    return query.scalar_subquery()
+
+def task_status_counts(user_id):
+    """{status: count} for one worker: a single GROUP BY on ix_tasks_user_status."""
+    return dict(db.session.execute(
+        db.select(Task.status, func.count()).where(Task.user_id == user_id).group_by(Task.status)
+    ).all())
+
+def load_dashboard_header(user_id):
+    """User, open task, counts and inventory availability in one round trip."""
+    inventory_available = db.exists().where(Inventory.status == 'AVAILABLE')
+    row = db.session.execute(
+        db.select(
+            User, Task, Inventory,
+            inventory_available.label('inventory_available'),
+            _task_count(user_id).label('total'),
+            _task_count(user_id, 'VERIFIED').label('verified'),
+            _task_count(user_id, 'SUBMITTED').label('submitted'),
+            CheckInStreak.current_streak, CheckInStreak.last_check_in_date,
+        )
+        .outerjoin(Task, db.and_(Task.user_id == User.id, Task.status == 'PENDING'))
+        .outerjoin(Inventory, Inventory.id == Task.inventory_id)
+        .outerjoin(CheckInStreak, CheckInStreak.user_id == User.id)
+        .where(User.id == user_id)
+        .limit(1)
+    ).first()
+    
+    if row is None:
+        return None
+    
+    user, current_task, inventory = row[0], row[1], row[2]
+    if current_task is not None:
+        # Attach the outer-joined inventory row so the template doesn't lazy-load it
+        set_committed_value(current_task, 'inventory_item', inventory)
+    task_counts = {'total': row.total, 'verified': row.verified, 'submitted': row.submitted}
+    streak = effective_streak(row.current_streak, row.last_check_in_date)
+    return DashboardHeader(user, current_task, bool(row.inventory_available), task_counts,
+                           streak, row.last_check_in_date == business_today())
+
+def load_task_history(user_id, cursor=None, limit=DASHBOARD_HISTORY_PAGE_SIZE):
+    """One page of a worker's tasks, newest first. Returns (tasks, next_cursor)."""
+    query = (
+        db.select(Task)
+        .options(joinedload(Task.inventory_item))
+        .where(Task.user_id == user_id)
+        .order_by(Task.date_assigned.desc(), Task.id.desc())
+        .limit(limit + 1)
+    )
+    position = decode_cursor(cursor) if cursor else None
+    if position and position[0] is not None:
+        query = query.where(db.tuple_(Task.date_assigned, Task.id) < db.tuple_(*keyset_position(position)))
+    
+    tasks = db.session.execute(query).scalars().all()
+    next_cursor = None
+    if len(tasks) > limit:
+        tasks = tasks[:limit]
+        next_cursor = encode_cursor(tasks[-1].date_assigned, tasks[-1].id)
+    return tasks, next_cursor
+
+# 2.6. የስታቲስቲክስ ቆጣሪዎች (Global Counters)
+# The admin dashboard numbers are kept up to date by the code paths that
+# change state, inside the same transaction (bump_stat_counters), so reading
+# them is a SUM over a handful of shard rows instead of COUNT(*) scans.
+# reconcile_stat_counters() periodically resets them to the true counts.
+
+STAT_COUNTER_SHARDS = 8
+STAT_COUNTER_RECONCILE_INTERVAL = timedelta(hours=1)
+
+STAT_COUNTER_QUERIES = {
+    'tasks_submitted': lambda: db.select(func.count(Task.id)).where(Task.status == 'SUBMITTED'),
+    'inventory_available': lambda: db.select(func.count(Inventory.id)).where(Inventory.status == 'AVAILABLE'),
+    'workers_total': lambda: db.select(func.count(User.id)).where(User.is_admin == False),
+}
+
+def bump_stat_counters(**deltas):
+    """Apply counter deltas inside the caller's transaction (the caller commits)."""
+    shard = random.randrange(STAT_COUNTER_SHARDS)
+    for name, delta in deltas.items():
+        if delta:
+            db.session.execute(
+                text("UPDATE stat_counters SET value = value + :delta WHERE name = :name AND shard = :shard"),
+                {'delta': delta, 'name': name, 'shard': shard}
+            )
+
+def reconcile_stat_counters():
+    """Reset every counter to its true COUNT(*)."""
+    now = datetime.now()
+    for name, count_query in STAT_COUNTER_QUERIES.items():
+        db.session.execute(
+            insert_ignore(StatCounter),
+            [{'name': name, 'shard': shard, 'value': 0} for shard in range(STAT_COUNTER_SHARDS)]
+        )
+        db.session.commit()
+        
+        if db.engine.dialect.name == 'postgresql':
+            # Concurrent bumps wait for us; the COUNT below then sees every
+            # transaction that bumped before we took the locks.
+            db.session.execute(
+                db.select(StatCounter.shard).where(StatCounter.name == name).with_for_update()
+            ).all()
+        true_count = db.session.execute(count_query()).scalar()
+        db.session.execute(
+            db.update(StatCounter).where(StatCounter.name == name).values(
+                value=db.case((StatCounter.shard == 0, true_count), else_=0),
+                date_reconciled=now
+            )
+        )
+        db.session.commit()
+
+def get_stat_counters():
+    """Current counter values, reconciling first if they are stale or missing."""
+    rows = db.session.execute(
+        db.select(StatCounter.name, func.sum(StatCounter.value), func.min(StatCounter.date_reconciled))
+        .group_by(StatCounter.name)
+    ).all()
+    stale_before = datetime.now() - STAT_COUNTER_RECONCILE_INTERVAL
+    if len(rows) < len(STAT_COUNTER_QUERIES) or any(r[2] is None or r[2] < stale_before for r in rows):
+        reconcile_stat_counters()
+        return get_stat_counters()
+    return {name: int(value or 0) for name, value, _ in rows}
+
+# 2.7. መለኪያዎች (Metrics, see metrics.py)
+# Scraped from /metrics with "Authorization: Bearer $METRICS_TOKEN" (or an
+# admin session when METRICS_TOKEN is not set).
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+metrics.instrument_sql(lambda: g.get('sql_stats') if has_request_context() else None)
+
+@app.before_request
+def _start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.sql_stats = [0, 0.0]
+
+@app.after_request
+def _record_request_metrics(response):
+    if 'metrics_started' in g:
+        metrics.observe_request(request.endpoint or 'unmatched', request.method, response.status_code,
+                                time.perf_counter() - g.metrics_started, g.sql_stats)
+    return response
+
+def _queue_depths():
+    status_counts = lambda model, statuses: db.select(func.count()).select_from(model).where(model.status.in_(statuses))
+    return {
+        'telegram_updates': db.session.execute(status_counts(TelegramUpdate, ['PENDING', 'PROCESSING'])).scalar(),
+        'broadcasts': db.session.execute(status_counts(Broadcast, ['QUEUED', 'RUNNING'])).scalar(),
+        'telegram_outbox': db.session.execute(status_counts(TelegramOutbox, ['PENDING', 'SENDING'])).scalar(),
+        'telegram_outbox_dead': db.session.execute(status_counts(TelegramOutbox, ['DEAD'])).scalar(),
+        'payouts_requested': db.session.execute(status_counts(Payout, ['REQUESTED'])).scalar(),
+    }
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint (all gunicorn workers aggregated)."""
+    auth = request.headers.get('Authorization', '')
+    if METRICS_TOKEN:
+        allowed = hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode())
+    else:
+        allowed = check_admin_access()
+    if not allowed:
+        return jsonify({'success': False, 'message': 'Metrics access denied'}), 403
+
+    body, content_type = metrics.render_metrics(_queue_depths(), get_stat_counters())
+    return body, 200, {'Content-Type': content_type}
+
+# 2.8. የሂሳብ መዝገብ (Balance Ledger)
+# Every change to users.pending_payout goes through credit_user() / debit_user():
+# one conditional in-place UPDATE ... RETURNING (no read-modify-write, no
+# SELECT ... FOR UPDATE) plus an append-only LedgerEntry, in the caller's
+# transaction. Call them last, right before commit, so the user's row lock is
+# held as briefly as possible.
+LEDGER_SNAPSHOT_EVERY = 200 # entries per user between two snapshots
+
+def _apply_balance_change(user_id, entries, kind, earned):
+    """One balance UPDATE for the sum of `entries` [(amount, reference)], one LedgerEntry each."""
+    amount = sum(entry_amount for entry_amount, _ in entries)
+    conditions = [User.id == user_id]
+    if amount < 0:
+        conditions.append(User.pending_payout >= -amount) # never below zero
+    values = {'pending_payout': User.pending_payout + amount}
+    if earned:
+        values['total_earned'] = User.total_earned + amount
+    row = db.session.execute(
+        db.update(User).where(*conditions).values(**values)
+        .returning(User.pending_payout, User.total_earned)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        return None
+    
+    balance = row.pending_payout - amount
+    for entry_amount, reference in entries:
+        balance += entry_amount
+        db.session.add(LedgerEntry(user_id=user_id, amount=entry_amount, kind=kind,
+                                   reference=reference, balance_after=balance))
+    # Keep an already loaded User (e.g. get_current_user()) in step with the database
+    user = db.session.identity_map.get(db.session.identity_key(User, user_id))
+    if user is not None:
+        set_committed_value(user, 'pending_payout', row.pending_payout)
+        set_committed_value(user, 'total_earned', row.total_earned)
+    return row.pending_payout
+
+def credit_user(user_id, amount, kind, reference=None, earned=True):
+    """Add to a user's balance (and total_earned unless earned=False). Returns the new balance."""
+    return _apply_balance_change(user_id, [(amount, reference)], kind, earned)
+
+def credit_user_many(user_id, entries, kind, earned=True):
+    """Several credits [(amount, reference)] to one user with a single balance UPDATE."""
+    return _apply_balance_change(user_id, entries, kind, earned)
+
+def debit_user(user_id, amount, kind, reference=None):
+    """Take from a user's balance if it covers the amount. Returns the new balance, or None."""
+    return _apply_balance_change(user_id, [(-amount, reference)], kind, earned=False)
+
+def balance_at(user_id, when):
+    """A user's balance at a point in time (0.0 before their first ledger entry).
+
+    The snapshots taken before and after `when` bound the entries read to one
+    snapshot interval (an entry still in flight while a snapshot was taken
+    can fall outside it; history, not money movement, is read here).
+    """
+    before = db.session.execute(
+        db.select(BalanceSnapshot.ledger_entry_id, BalanceSnapshot.balance)
+        .where(BalanceSnapshot.user_id == user_id, BalanceSnapshot.date_created <= when)
+        .order_by(BalanceSnapshot.ledger_entry_id.desc()).limit(1)
+    ).first()
+    after = db.session.execute(
+        db.select(BalanceSnapshot.ledger_entry_id)
+        .where(BalanceSnapshot.user_id == user_id, BalanceSnapshot.date_created > when)
+        .order_by(BalanceSnapshot.ledger_entry_id).limit(1)
+    ).scalar()
+    query = (db.select(LedgerEntry.balance_after)
+             .where(LedgerEntry.user_id == user_id, LedgerEntry.date_created <= when)
+             .order_by(LedgerEntry.id.desc()).limit(1))
+    if before is not None:
+        query = query.where(LedgerEntry.id > before.ledger_entry_id)
+    if after is not None:
+        query = query.where(LedgerEntry.id <= after)
+    balance = db.session.execute(query).scalar()
+    if balance is None and before is not None:
+        return before.balance
+    return balance or 0.0
+
+def _latest_snapshot_ids():
+    """(user_id, entry_id) of every user's latest snapshot."""
+    return (db.select(BalanceSnapshot.user_id, func.max(BalanceSnapshot.ledger_entry_id).label('entry_id'))
+            .group_by(BalanceSnapshot.user_id).subquery())
+
+def _latest_snapshots():
+    latest = _latest_snapshot_ids()
+    return db.select(BalanceSnapshot).join(
+        latest, db.and_(BalanceSnapshot.user_id == latest.c.user_id,
+                        BalanceSnapshot.ledger_entry_id == latest.c.entry_id))
+
+def _entries_since_snapshot(*columns):
+    """SELECT `columns` over the ledger entries after each user's latest snapshot.
+
+    A join on the latest snapshot ids (one aggregate, computed once) instead of
+    a correlated MAX() per entry: each user's entries are then a range on
+    ix_ledger_entries_user_id_id starting after their snapshot.
+    """
+    latest = _latest_snapshot_ids()
+    return (db.select(*columns).select_from(LedgerEntry)
+            .outerjoin(latest, latest.c.user_id == LedgerEntry.user_id)
+            .where(LedgerEntry.id > func.coalesce(latest.c.entry_id, 0)))
+
+def take_balance_snapshots():
+    """Snapshot every user with LEDGER_SNAPSHOT_EVERY or more entries since their last one."""
+    rows = db.session.execute(
+        _entries_since_snapshot(LedgerEntry.user_id, func.max(LedgerEntry.id))
+        .group_by(LedgerEntry.user_id)
+        .having(func.count() >= LEDGER_SNAPSHOT_EVERY)
+    ).all()
+    if rows:
+        balances = db.session.execute(
+            db.select(LedgerEntry.user_id, LedgerEntry.id, LedgerEntry.balance_after)
+            .where(LedgerEntry.id.in_([entry_id for _, entry_id in rows]))
+        ).all()
+        db.session.execute(db.insert(BalanceSnapshot), [
+            {'user_id': user_id, 'ledger_entry_id': entry_id, 'balance': balance}
+            for user_id, entry_id, balance in balances
+        ])
+    db.session.commit()
+    return len(rows)
+
+def verify_ledger():
+    """Users whose balance differs from (last snapshot + later entries): [(user_id, balance, ledger)]."""
+    snapshots = {s.user_id: s for s in db.session.execute(_latest_snapshots()).scalars()}
+    sums = dict(db.session.execute(
+        _entries_since_snapshot(LedgerEntry.user_id, func.sum(LedgerEntry.amount))
+        .group_by(LedgerEntry.user_id)
+    ).all())
+    mismatches = []
+    for user_id, balance in db.session.execute(db.select(User.id, User.pending_payout)).all():
+        expected = (snapshots[user_id].balance if user_id in snapshots else 0.0) + (sums.get(user_id) or 0.0)
+        if abs((balance or 0.0) - expected) > 0.005:
+            mismatches.append((user_id, balance, round(expected, 2)))
+    return mismatches
+
+# 2.9. ዕለታዊ መግቢያ (Daily Check-in)
+# One check-in is one INSERT ... ON CONFLICT DO NOTHING on (user_id, day), the
+# ledger credit and a streak upsert, all in one transaction. Days are
+# business_today() buckets. Streaks live in check_in_streaks (one row per
+# user), so reading them never scans daily_check_ins.
+
+def _record_checkin_streak(user_id, today):
+    """Extend (or restart) the user's streak for `today`. Returns the new streak."""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    continued = db.case(
+        (CheckInStreak.last_check_in_date == today - timedelta(days=1), CheckInStreak.current_streak + 1),
+        else_=1)
+    stmt = dialect.insert(CheckInStreak).values(
+        user_id=user_id, current_streak=1, longest_streak=1, last_check_in_date=today)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CheckInStreak.user_id],
+        set_={
+            'current_streak': continued,
+            'longest_streak': db.case((continued > CheckInStreak.longest_streak, continued),
+                                      else_=CheckInStreak.longest_streak),
+            'last_check_in_date': today,
+        },
+    ).returning(CheckInStreak.current_streak)
+    return db.session.execute(stmt).scalar()
+
+def effective_streak(current_streak, last_check_in_date):
+    """A stored streak is still running only if the last check-in was today or yesterday."""
+    if not last_check_in_date or last_check_in_date < business_today() - timedelta(days=1):
+        return 0
+    return current_streak
+
+def get_checkin_streaks(limit=50):
+    """Longest running streaks: [(user_id, username, current_streak, longest_streak)]."""
+    return db.session.execute(
+        db.select(CheckInStreak.user_id, User.username, CheckInStreak.current_streak, CheckInStreak.longest_streak)
+        .join(User, User.id == CheckInStreak.user_id)
+        .where(CheckInStreak.last_check_in_date >= business_today() - timedelta(days=1))
+        .order_by(CheckInStreak.current_streak.desc())
+        .limit(limit)
+    ).all()
+
+# 2.10. የማስታወቂያ ካታሎግ ካሽ (Ad Catalog Cache)
+# Each worker keeps the active ads in memory. Admin changes bump the
+# 'ad_catalog' row in cache_versions; workers compare it at most every
+# AD_CATALOG_CHECK_INTERVAL seconds and reload only when it moved. The TTL is
+# a safety net for changes made outside the admin routes.
+AD_CATALOG_CHECK_INTERVAL = 5 # seconds between version checks
+AD_CATALOG_TTL = 300 # seconds before an unconditional reload
+
+class CachedAd:
+    """Detached copy of an active Ad (safe to share between requests and threads)."""
+    def __init__(self, ad):
+        self.id = ad.id
+        self.title = ad.title
+        self.embed_url = ad.embed_url
+        self.reward_amount = ad.reward_amount
+        self.required_view_time = ad.required_view_time
+
+class AdCatalogCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ads = None # {ad_id: CachedAd}, ordered by id
+        self._version = None
+        self._loaded_at = 0.0
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        self._ads = None
+
+    def get(self):
+        """The active ads as {ad_id: CachedAd}. Usually no database access."""
+        now = time.monotonic()
+        ads = self._ads
+        if ads is not None and now - self._checked_at < AD_CATALOG_CHECK_INTERVAL:
+            return ads
+        with self._lock:
+            if self._ads is not None and now - self._checked_at < AD_CATALOG_CHECK_INTERVAL:
+                return self._ads # another thread refreshed meanwhile
+            version = _cache_version('ad_catalog')
+            if self._ads is None or version != self._version or now - self._loaded_at >= AD_CATALOG_TTL:
+                rows = db.session.execute(
+                    db.select(Ad).where(Ad.is_active == True).order_by(Ad.id)
+                ).scalars()
+                self._ads = {ad.id: CachedAd(ad) for ad in rows}
+                self._version = version
+                self._loaded_at = now
+            self._checked_at = now
+            return self._ads
+
+ad_catalog = AdCatalogCache()
+
+def _cache_version(name):
+    return db.session.execute(
+        db.select(CacheVersion.version).where(CacheVersion.name == name)
+    ).scalar() or 0
+
+def bump_cache_version(name):
+    """Mark cached data as changed, in the caller's transaction."""
+    db.session.execute(insert_ignore(CacheVersion).values(name=name, version=0))
+    db.session.execute(
+        db.update(CacheVersion).where(CacheVersion.name == name)
+        .values(version=CacheVersion.version + 1)
+    )
+
+# 2.11. የሥራ ግምገማ (Task Review)
+# Verify/reject is set-based: one conditional UPDATE ... RETURNING moves every
+# still-SUBMITTED task of the selection, so a task another admin reviewed in the
+# meantime is simply not returned (reported, never paid twice). Credits are
+# summed per worker: one balance UPDATE per worker, one ledger entry per task.
+# A rejected task lets go of its account (inventory_id NULL): the account is
+# AVAILABLE again and counts towards inventory_available.
+REVIEW_BATCH_MAX = 500
+
+def review_tasks(task_ids, action):
+    """Verify or reject SUBMITTED tasks in the caller's transaction (the caller commits).
+
+    Returns (reviewed, skipped): the ids moved by this call, and {task_id: current
+    status or 'NOT_FOUND'} for the rest (e.g. reviewed by another admin meanwhile).
+    """
+    new_status = 'VERIFIED' if action == 'verify' else 'REJECTED'
+    ids = sorted(set(task_ids))
+    rows = db.session.execute(
+        db.update(Task).where(Task.id.in_(ids), Task.status == 'SUBMITTED')
+        .values(status=new_status)
+        .returning(Task.id, Task.user_id, Task.inventory_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    
+    if rows:
+        released = db.session.execute(
+            db.update(Inventory).where(Inventory.id.in_([row.inventory_id for row in rows]))
+            .values(status='COMPLETED' if action == 'verify' else 'AVAILABLE')
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if action != 'verify':
+            # Let go of the accounts (unique inventory_id) so they can be claimed again
+            db.session.execute(
+                db.update(Task).where(Task.id.in_([row.id for row in rows]))
+                .values(inventory_id=None)
+                .execution_options(synchronize_session=False)
+            )
+        if action == 'verify':
+            bump_stat_counters(tasks_submitted=-len(rows))
+            rewards = {}
+            for row in rows:
+                rewards.setdefault(row.user_id, []).append((PAYOUT_AMOUNT_PER_TASK, f'task:{row.id}'))
+            # Users in id order: concurrent batches take the row locks in the same order
+            for user_id in sorted(rewards):
+                credit_user_many(user_id, rewards[user_id], 'TASK_REWARD')
+        else:
+            bump_stat_counters(tasks_submitted=-len(rows), inventory_available=released)
+    
+    reviewed = sorted(row.id for row in rows)
+    skipped = {}
+    if len(reviewed) < len(ids):
+        missed = set(ids).difference(reviewed)
+        current = dict(db.session.execute(
+            db.select(Task.id, Task.status).where(Task.id.in_(missed))
+        ).all())
+        skipped = {task_id: current.get(task_id, 'NOT_FOUND') for task_id in sorted(missed)}
+    return reviewed, skipped
+
+# 2.12. የአስተዳዳሪ ወረፋዎች (Admin Queues)
+# The review and payout queues are read oldest first, one keyset page at a time:
+# (date, id) > cursor on the partial indexes ix_tasks_submitted_queue and
+# ix_payouts_requested_queue, so a page costs the same with 20 or 20,000 items
+# waiting. Rows go to the templates as they come back (SQLAlchemy Rows are
+# read-only tuples with attribute access; no per-row dict copies).
+ADMIN_QUEUE_PAGE_SIZE = 50
+
+def _queue_page(query, date_column, id_column, cursor, limit):
+    """(rows, next_cursor) of `query`, whose last two columns are date_column and id_column."""
+    position = decode_cursor(cursor) if cursor else None
+    if position and position[0] is not None:
+        query = query.where(db.tuple_(date_column, id_column) > db.tuple_(*keyset_position(position)))
+    rows = db.session.execute(query.order_by(date_column, id_column).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][-2], rows[-1][-1])
+    return rows, next_cursor
+
+def load_review_queue(cursor=None, limit=ADMIN_QUEUE_PAGE_SIZE):
+    """One page of SUBMITTED tasks with worker and gmail account. Returns (rows, next_cursor)."""
+    query = (
+        db.select(Inventory.gmail_username, User.username.label('worker_username'), Task.completion_code,
+                  Task.date_completed, Task.id.label('task_id'))
+        .join(Inventory, Task.inventory_id == Inventory.id)
+        .join(User, Task.user_id == User.id)
+        .where(Task.status == 'SUBMITTED')
+    )
+    return _queue_page(query, Task.date_completed, Task.id, cursor, limit)
+
+def load_payout_queue(cursor=None, limit=ADMIN_QUEUE_PAGE_SIZE):
+    """One page of REQUESTED payouts with the worker's username. Returns (rows, next_cursor)."""
+    query = (
+        db.select(User.username.label('worker_username'), Payout.amount, Payout.recipient_name,
+                  Payout.payment_method, Payout.payment_details,
+                  Payout.date_requested, Payout.id.label('payout_id'))
+        .join(User, Payout.user_id == User.id)
+        .where(Payout.status == 'REQUESTED')
+    )
+    return _queue_page(query, Payout.date_requested, Payout.id, cursor, limit)
+
+def render_queue_page(template, rows_template, rows_name, rows, next_cursor, page_context=None):
+    """Full page, or only the rows (plus X-Next-Cursor) for the page's load-more button.
+
+    `page_context()` supplies the full page's extra template variables.
+    """
+    if request.args.get('rows'):
+        response = app.make_response(render_template(rows_template, **{rows_name: rows}))
+        response.headers['X-Next-Cursor'] = next_cursor or ''
+        return response
+    extra = page_context() if page_context else {}
+    return render_template(template, next_cursor=next_cursor, **{rows_name: rows}, **extra)
+
+# 2.13. የክፍያ ኤክስፖርት (Payout Disbursement Export)
+# An export batch freezes a set of REQUESTED payouts (export_batch_id) in one
+# UPDATE; finance then downloads one CSV per payment method in that channel's
+# bulk-upload layout. A payout is in at most one batch, so it cannot be sent
+# to the bank twice, and every row carries a GTASK-<batch>-<payout> reference
+# to reconcile against. Downloads stream: rows come through a server-side
+# cursor PAYOUT_EXPORT_CHUNK at a time and the response is a generator.
+PAYOUT_EXPORT_CHUNK = 1000
+PAYOUT_EXPORT_RECENT_BATCHES = 5
+
+def _msisdn(details):
+    """Ethiopian mobile number in international form (2519..., 2517...), else as entered."""
+    digits = ''.join(c for c in details or '' if c.isdigit())
+    if len(digits) == 10 and digits.startswith('0'):
+        return '251' + digits[1:]
+    if len(digits) == 9 and digits[0] in '79':
+        return '251' + digits
+    return digits or (details or '')
+
+def _account_number(details):
+    return ''.join(c for c in details or '' if c.isdigit()) or (details or '')
+
+# payment_method -> (header, row builder); other methods use the generic layout
+PAYOUT_EXPORT_FORMATS = {
+    'Telebirr': (('MSISDN', 'Amount', 'Beneficiary Name', 'Remark'),
+                 lambda p, ref: (_msisdn(p.payment_details), f'{p.amount:.2f}', p.recipient_name, ref)),
+    'CBE': (('Account Number', 'Beneficiary Name', 'Amount', 'Reason'),
+            lambda p, ref: (_account_number(p.payment_details), p.recipient_name, f'{p.amount:.2f}', ref)),
+    'M-Pesa': (('Phone Number', 'Amount', 'Name', 'Reference'),
+               lambda p, ref: (_msisdn(p.payment_details), f'{p.amount:.2f}', p.recipient_name, ref)),
+}
+PAYOUT_EXPORT_GENERIC_FORMAT = (
+    ('Payout ID', 'Payment Method', 'Payment Details', 'Recipient Name', 'Amount', 'Reference'),
+    lambda p, ref: (p.id, p.payment_method, p.payment_details, p.recipient_name, f'{p.amount:.2f}', ref),
+)
+
+def _csv_safe(value):
+    # Spreadsheet formula injection: user-entered text must not start a formula
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@', '\t', '\r'):
+        return "'" + value
+    return value
+
+def create_payout_export_batch(admin_id, payout_ids=None):
+    """Freeze REQUESTED payouts not yet exported (optionally only `payout_ids`). The caller commits.
+
+    Returns the batch, or None when nothing was left to export.
+    """
+    batch = PayoutExportBatch(created_by=admin_id)
+    db.session.add(batch)
+    db.session.flush()
+    conditions = [Payout.status == 'REQUESTED', Payout.export_batch_id.is_(None)]
+    if payout_ids is not None:
+        conditions.append(Payout.id.in_(payout_ids))
+    db.session.execute(
+        db.update(Payout).where(*conditions).values(export_batch_id=batch.id)
+        .execution_options(synchronize_session=False)
+    )
+    count, total = db.session.execute(
+        db.select(func.count(), func.coalesce(func.sum(Payout.amount), 0.0))
+        .where(Payout.export_batch_id == batch.id)
+    ).one()
+    if not count:
+        db.session.rollback()
+        return None
+    batch.payout_count, batch.total_amount = count, total
+    return batch
+
+def payout_export_batch_methods(batch_ids):
+    """{batch_id: {payment_method: still-REQUESTED payouts}} for the download links."""
+    methods = {batch_id: {} for batch_id in batch_ids}
+    rows = db.session.execute(
+        db.select(Payout.export_batch_id, Payout.payment_method, func.count())
+        .where(Payout.export_batch_id.in_(batch_ids), Payout.status == 'REQUESTED')
+        .group_by(Payout.export_batch_id, Payout.payment_method)
+    ).all()
+    for batch_id, method, count in rows:
+        methods[batch_id][method] = count
+    return methods
+
+def iter_payout_export_csv(batch_id, payment_method):
+    """CSV text chunks for the batch's still-REQUESTED payouts of one method."""
+    header, build_row = PAYOUT_EXPORT_FORMATS.get(payment_method, PAYOUT_EXPORT_GENERIC_FORMAT)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    result = db.session.execute(
+        db.select(Payout.id, Payout.amount, Payout.payment_method, Payout.payment_details, Payout.recipient_name)
+        .where(Payout.export_batch_id == batch_id, Payout.payment_method == payment_method,
+               Payout.status == 'REQUESTED')
+        .order_by(Payout.id)
+        .execution_options(yield_per=PAYOUT_EXPORT_CHUNK)  # server-side cursor on PostgreSQL
+    )
+    for rows in result.partitions():
+        for payout in rows:
+            writer.writerow([_csv_safe(value) for value in build_row(payout, f'GTASK-{batch_id}-{payout.id}')])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+# 2.14. የክፍያ ማጠናቀቂያ (Payout Settlement)
+# Mark paid / reject many payouts at once: one conditional UPDATE ... RETURNING
+# moves the still-REQUESTED ones (a payout settled concurrently is not returned,
+# so it is never refunded twice). Rejections are refunded per worker and payment
+# notices are written to the Telegram outbox, both in the same transaction.
+
+def settle_payouts(action, payout_ids=None, batch_id=None):
+    """Mark payouts (by id, or a whole export batch) PAID or REJECTED. The caller commits.
+
+    Returns (settled rows (id, user_id, amount), skipped {payout_id: current status
+    or 'NOT_FOUND'}); skipped is only reported for explicit ids.
+    """
+    conditions = [Payout.status == 'REQUESTED']
+    if payout_ids is not None:
+        payout_ids = sorted(set(payout_ids))
+        conditions.append(Payout.id.in_(payout_ids))
+    else:
+        conditions.append(Payout.export_batch_id == batch_id)
+    settled = db.session.execute(
+        db.update(Payout).where(*conditions)
+        .values(status='PAID' if action == 'paid' else 'REJECTED',
+                date_paid=func.now() if action == 'paid' else None)
+        .returning(Payout.id, Payout.user_id, Payout.amount)
+        .execution_options(synchronize_session=False)
+    ).all()
+    
+    if action == 'paid':
+        enqueue_payment_notifications((row.user_id, row.amount) for row in settled)
+    else:
+        refunds = {}
+        for row in settled:
+            refunds.setdefault(row.user_id, []).append((row.amount, f'payout:{row.id}'))
+        # Users in id order: concurrent settlements take the row locks in the same order
+        for user_id in sorted(refunds):
+            credit_user_many(user_id, refunds[user_id], 'PAYOUT_REFUND', earned=False)
+    
+    skipped = {}
+    if payout_ids is not None and len(settled) < len(payout_ids):
+        missed = set(payout_ids).difference(row.id for row in settled)
+        current = dict(db.session.execute(
+            db.select(Payout.id, Payout.status).where(Payout.id.in_(missed))
+        ).all())
+        skipped = {payout_id: current.get(payout_id, 'NOT_FOUND') for payout_id in sorted(missed)}
+    return settled, skipped
+
+# 2.15. የስክሪንሻት ማከማቻ (Screenshot Store, see screenshots.py)
+# Content-addressed files: Task.completion_code holds the key of the submitted
+# screenshot. Keys never change meaning, so their responses are cacheable for a year.
+SCREENSHOT_DIR = os.environ.get('SCREENSHOT_DIR', os.path.join(app.root_path, 'uploads', 'screenshots'))
+SCREENSHOT_CACHE_MAX_AGE = 365 * 24 * 3600
+
+screenshot_store = screenshots.LocalScreenshotStore(SCREENSHOT_DIR)
+app.add_template_test(screenshots.is_screenshot_key, 'screenshot_key')
+
+def _thumbnail_failed(key, error):
+    log.error('screenshot.thumbnail.failed', key=key, error=repr(error))
 
 @app.context_processor
 def inject_global_vars():
-    return dict(is_admin=check_admin_access, min_payout=MIN_PAYOUT)
+    return dict(is_admin=has_admin_role, min_payout=MIN_PAYOUT)
+
+
+# Schema and bootstrap work belongs to the deploy, not to every worker:
+#   - `flask --app main db-init` (Render pre-deploy command / Procfile release) does it
+#     once per deploy; with DB_INIT_ON_BOOT=false workers then boot without any query.
+#     DB_INIT_ON_BOOT defaults to false on a Procfile platform (DYNO is set) whose
+#     Procfile has that release process.
+#   - Otherwise it runs here on import. Under gunicorn.conf.py (preload_app) that
+#     import happens once in the master, before the workers are forked.
+#   - Never on the import made to run an app command (db-init, telegram-poll, ...):
+#     db-init does the work itself, the others expect a set-up database.
+def _release_phase_configured():
+    if not os.environ.get('DYNO'):
+        return False
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Procfile')) as procfile:
+            return any(line.startswith('release:') and 'db-init' in line for line in procfile)
+    except OSError:
+        return False
+
+def _imported_for_cli_command():
+    """True while `flask --app main <command>` loads the app to find an app command."""
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and isinstance(ctx.command, click.Group)
+
+DB_INIT_ON_BOOT = os.environ.get('DB_INIT_ON_BOOT', 'false' if _release_phase_configured() else 'true').lower() == 'true'
+
+# Runs after every helper it uses (insert_ignore, reconcile_stat_counters) is defined
+if DB_INIT_ON_BOOT and not _imported_for_cli_command():
+    _init_started = time.perf_counter()
+    init_db()
+    BOOT_TIMINGS['init_db'] = round(time.perf_counter() - _init_started, 3)
 
 
 # --- 3. WORKER ROUTES (የሰራተኛ መንገዶች) ---
@@ -348,171 +2170,103 @@ def miniapp():
         return redirect(url_for('dashboard'))
     return render_template('miniapp.html')
 
-def validate_telegram_initData(initData_string, bot_token):
-    """
-    Validate Telegram Mini App initData using HMAC-SHA256 (Telegram spec)
-    
-    Per Telegram Mini App docs:
-    - Secret key = HMAC-SHA256("WebAppData", BOT_TOKEN)
-    - Data check string = sorted fields (excluding 'hash' and 'signature')
-    - Only include: user, auth_date, query_id, start_param, chat_instance
-    
-    CRITICAL: Keep URL-ENCODED values as-is (do NOT decode)
-    """
+# Derived key cached for the process; accepted payloads cached until stale (telegram_auth.py)
+initdata_validator = InitDataValidator(BOT_TOKEN) if BOT_TOKEN else None
+
+def validate_telegram_initData(initData_string, consume=False):
+    """Signed Mini App fields (`user` decoded), or None when initData is invalid."""
+    if initdata_validator is None:
+        tg_log.warning('initdata.rejected', reason='bot token not configured')
+        return None
     try:
-        if not initData_string or not bot_token:
-            print("❌ Missing initData or bot_token")
-            return False, None
-        
-        print(f"📥 Received initData string (first 100 chars): {initData_string[:100]}")
-        
-        parts = {}
-        for item in initData_string.split('&'):
-            if '=' in item:
-                key, value = item.split('=', 1)
-                parts[key] = unquote(value)
-        
-        print(f"🔍 Parsed {len(parts)} fields from initData: {list(parts.keys())}")
-        
-        if 'hash' not in parts:
-            print("❌ No hash in initData")
-            return False, None
-        
-        received_hash = parts['hash']
-        print(f"📍 Received hash: {received_hash}")
-        
-        EXCLUDED_FIELDS = {'hash'}
-        
-        data_check_fields = []
-        for k, v in sorted(parts.items()):
-            if k not in EXCLUDED_FIELDS:
-                data_check_fields.append(f"{k}={v}")
-        
-        data_check_string = '\n'.join(data_check_fields)
-        
-        print(f"🔍 Data check string ({len(data_check_fields)} fields included):")
-        print(f"   Excluded: {EXCLUDED_FIELDS}")
-        print(f"   Included: {[f for f, _ in sorted(parts.items()) if f not in EXCLUDED_FIELDS]}")
-        print(f"   {data_check_string[:150]}...")
-        
-        # Derive secret key: HMAC-SHA256("WebAppData", BOT_TOKEN)
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
-        print(f"🔑 Secret key derived (HMAC-SHA256('WebAppData', token))")
-        
-        # Calculate hash: HMAC-SHA256(secret_key, data_check_string)
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        
-        print(f"🔐 Hash Validation:")
-        print(f"   Received:   {received_hash}")
-        print(f"   Calculated: {calculated_hash}")
-        print(f"   Match: {'✅ YES' if calculated_hash == received_hash else '❌ NO'}")
-        
-        if calculated_hash != received_hash:
-            print("❌ Hash validation FAILED!")
-            print(f"   Data string length: {len(data_check_string)} bytes")
-            return False, None
-        
-        print("✅ Hash validation SUCCESSFUL! User authenticated.")
-        return True, parts
-        
-    except Exception as e:
-        print(f"❌ Validation error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False, None
+        fields = initdata_validator.validate(initData_string, consume=consume)
+    except InvalidInitData as e:
+        tg_log.warning('initdata.rejected', reason=e.reason)
+        return None
+    tg_log.debug('initdata.accepted', fields=len(fields))
+    return fields
 
 @app.route('/miniapp_login', methods=['POST'])
 def miniapp_login():
     """Handle Telegram Mini App login with initData validation"""
     try:
         request_data = request.get_json()
-        print(f"📥 Received Mini App login data")
         
         initData = request_data.get('initData')
-        user_data = request_data.get('user', {})
-        
-        print(f"🔍 initData present: {bool(initData)}")
-        print(f"🔍 User data: {user_data}")
         
         if not initData:
-            print("❌ Missing initData")
+            log.info('miniapp.login.rejected', reason='missing initData')
             return jsonify({'success': False, 'message': 'Missing initData from Telegram'}), 400
         
-        # Validate initData using HMAC-SHA256
-        is_valid, parsed_data = validate_telegram_initData(initData, BOT_TOKEN)
+        # Validate initData using HMAC-SHA256; a login consumes it (no replays)
+        parsed_data = validate_telegram_initData(initData, consume=True)
         
-        if not is_valid:
-            print("❌ initData validation failed")
+        if parsed_data is None:
+            log.info('miniapp.login.rejected', reason='invalid initData')
             return jsonify({'success': False, 'message': 'Failed to validate Telegram authentication'}), 401
         
-        # Extract telegram_id from user data (user_data should be trusted at this point)
+        # Only the signed `user` field is trusted, never a client-supplied copy
+        user_data = parsed_data.get('user', {})
         telegram_id = str(user_data.get('id'))
         first_name = user_data.get('first_name', 'User')
         username = user_data.get('username', f"user_{telegram_id}")
         
-        print(f"👤 Authenticated user: id={telegram_id}, name={first_name}")
-        
         if not telegram_id or telegram_id == 'None':
-            print(f"❌ Invalid Telegram ID: {telegram_id}")
+            log.info('miniapp.login.rejected', reason='invalid telegram id')
             return jsonify({'success': False, 'message': 'Invalid Telegram ID'}), 400
         
         # Auto-register or get existing user
-        with app.app_context():
-            user = User.query.filter_by(telegram_id=telegram_id).first()
-            
+        user = User.query.filter_by(telegram_id=telegram_id).first()
+        
+        if not user:
+            # Auto-register new user
+            user = auto_register_telegram_user(telegram_id, first_name)
             if not user:
-                print(f"👤 New user detected, auto-registering: {first_name} (ID: {telegram_id})")
-                # Auto-register new user
-                user = auto_register_telegram_user(telegram_id, first_name)
-                if not user:
-                    print(f"❌ Auto-registration failed for {telegram_id}")
-                    return jsonify({'success': False, 'message': 'Registration failed'}), 500
-            else:
-                print(f"✅ Existing user found: {user.username}")
-            
-            # Set session
-            session['user_id'] = user.id
-            session['username'] = user.username
-            
-            print(f"✅ Mini App login successful: {user.username} (Telegram ID: {telegram_id})")
-            return jsonify({'success': True, 'message': 'Logged in successfully', 'redirect': '/dashboard'}), 200
+                return jsonify({'success': False, 'message': 'Registration failed'}), 500
+        
+        # Set session
+        session['user_id'] = user.id
+        session['username'] = user.username
+        
+        log.info('miniapp.login.ok', user_id=user.id)
+        return jsonify({'success': True, 'message': 'Logged in successfully', 'redirect': '/dashboard'}), 200
     
     except Exception as e:
-        print(f"❌ Mini App login error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception('miniapp.login.error')
         return jsonify({'success': False, 'message': f'Login failed: {str(e)}'}), 500
 
 @app.route('/logout')
 def logout():
     session.pop('user_id', None)
     session.pop('username', None)
+    invalidate_role_claim()
     flash('ከመለያዎ ወጥተዋል!', 'info')
     return redirect(url_for('index'))
 
 @app.route('/telegram_auto_login/<token>')
 def telegram_auto_login(token):
-    """Auto-login Telegram user with temporary token."""
-    with app.app_context():
-        user = User.query.filter_by(telegram_login_token=token).first()
-        
-        if not user:
-            flash('🔐 የሎግইን ቊታ ተገኝቷል! እንደገና ወደ Telegram ሂድ።', 'error')
-            return redirect(url_for('miniapp'))
-        
-        if user.telegram_token_expires and datetime.now() > user.telegram_token_expires:
+    """Auto-login Telegram user with a signed link from a bot reply."""
+    try:
+        user_id = login_links.verify(token)
+    except InvalidLoginLink as e:
+        log.info('telegram.auto_login.rejected', reason=e.reason)
+        if e.reason == 'expired':
             flash('🔐 የሎግይን ቊታ ጊዜው አልፍቷል! ወደ Telegram ወስደው ድጋሚ ሞክር።', 'error')
-            return redirect(url_for('miniapp'))
-        
-        session['user_id'] = user.id
-        session['username'] = user.username
-        
-        # Generate a fresh token for next login (user can logout and login again without /start)
-        generate_telegram_login_token(user)
-        
-        print(f"✅ Telegram auto-login successful for {user.username}")
-        flash('🎉 በTelegram ገብተዋል!', 'success')
-        return redirect(url_for('dashboard'))
+        else:
+            flash('🔐 የሎግইን ቊታ ተገኝቷል! እንደገና ወደ Telegram ሂድ።', 'error')
+        return redirect(url_for('miniapp'))
+    
+    user = db.session.get(User, user_id)
+    if not user:
+        flash('🔐 የሎግইን ቊታ ተገኝቷል! እንደገና ወደ Telegram ሂድ።', 'error')
+        return redirect(url_for('miniapp'))
+    
+    session['user_id'] = user.id
+    session['username'] = user.username
+    
+    log.info('telegram.auto_login.ok', user_id=user.id)
+    flash('🎉 በTelegram ገብተዋል!', 'success')
+    return redirect(url_for('dashboard'))
 
 @app.route('/telegram_login_check', methods=['GET'])
 def telegram_login_check():
@@ -535,7 +2289,7 @@ def telegram_login_check():
     secret_key = hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).digest()
     calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
     
-    if calculated_hash != check_hash:
+    if not hmac.compare_digest(calculated_hash, check_hash):
         flash('የተሳሳተ Telegram ማረጋገጫ!', 'error')
         return redirect(url_for('miniapp'))
     
@@ -553,77 +2307,71 @@ def telegram_login_check():
         flash('የተሳሳተ Telegram መረጃ!', 'error')
         return redirect(url_for('miniapp'))
     
-    with app.app_context():
-        user = User.query.filter_by(telegram_id=telegram_id).first()
-        
-        if not user:
-            from sqlalchemy.exc import IntegrityError
-            password_hash = generate_password_hash(f"telegram_{telegram_id}_{int(time.time())}")
-            
-            suffix_id = str(telegram_id)
-            max_suffix_length = len(suffix_id) + 5
-            max_base_length = 80 - max_suffix_length - 1
+    user = User.query.filter_by(telegram_id=telegram_id).first()
+    
+    if not user:
+        from sqlalchemy.exc import IntegrityError
+        password_hash = generate_password_hash(f"telegram_{telegram_id}_{int(time.time())}")
+        
+        suffix_id = str(telegram_id)
+        max_suffix_length = len(suffix_id) + 5
+        max_base_length = 80 - max_suffix_length - 1
+        
+        base_username = telegram_username[:max_base_length] if len(telegram_username) > max_base_length else telegram_username
+        max_attempts = 10
+        
+        for attempt in range(max_attempts):
+            if attempt == 0:
+                attempt_username = base_username
+            elif attempt == 1:
+                attempt_username = f"{base_username}_{suffix_id}"
+            else:
+                attempt_username = f"{base_username}_{suffix_id}_{attempt-1}"
             
-            base_username = telegram_username[:max_base_length] if len(telegram_username) > max_base_length else telegram_username
-            max_attempts = 10
+            attempt_username = attempt_username[:80]
             
-            for attempt in range(max_attempts):
-                if attempt == 0:
-                    attempt_username = base_username
-                elif attempt == 1:
-                    attempt_username = f"{base_username}_{suffix_id}"
-                else:
-                    attempt_username = f"{base_username}_{suffix_id}_{attempt-1}"
-                
-                attempt_username = attempt_username[:80]
-                
-                try:
-                    user = User(username=attempt_username, password_hash=password_hash, telegram_id=telegram_id)
-                    db.session.add(user)
-                    db.session.commit()
-                    flash('በ Telegram በተሳካ ሁኔታ ተመዝግበዋል!', 'success')
-                    break
-                except IntegrityError as e:
-                    db.session.rollback()
-                    if attempt == max_attempts - 1:
-                        flash('የተጠቃሚ ስም ችግር አለ። እባክዎ እንደገና ይሞክሩ።', 'error')
-                        return redirect(url_for('miniapp'))
-                except Exception as e:
-                    db.session.rollback()
-                    print(f"Telegram login error for user {telegram_id}: {str(e)}")
-                    flash(f'ስህተት ተከስቷል። እባክዎ እንደገና ይሞክሩ።', 'error')
+            try:
+                user = User(username=attempt_username, password_hash=password_hash, telegram_id=telegram_id)
+                db.session.add(user)
+                bump_stat_counters(workers_total=1)
+                db.session.commit()
+                flash('በ Telegram በተሳካ ሁኔታ ተመዝግበዋል!', 'success')
+                break
+            except IntegrityError as e:
+                db.session.rollback()
+                if attempt == max_attempts - 1:
+                    flash('የተጠቃሚ ስም ችግር አለ። እባክዎ እንደገና ይሞክሩ።', 'error')
                     return redirect(url_for('miniapp'))
-        
-        session['user_id'] = user.id
-        session['username'] = user.username
-        flash('በ Telegram በተሳካ ሁኔታ ገብተዋል!', 'success')
-        return redirect(url_for('dashboard'))
+            except Exception as e:
+                db.session.rollback()
+                log.exception('telegram.login.error', telegram_id=telegram_id)
+                flash(f'ስህተት ተከስቷል። እባክዎ እንደገና ይሞክሩ።', 'error')
+                return redirect(url_for('miniapp'))
+    
+    session['user_id'] = user.id
+    session['username'] = user.username
+    flash('በ Telegram በተሳካ ሁኔታ ገብተዋል!', 'success')
+    return redirect(url_for('dashboard'))
 
 def set_telegram_bot_commands():
-    """Set bot commands menu in Telegram"""
-    import requests
-    
-    TELEGRAM_BOT_TOKEN = BOT_TOKEN
-    if not TELEGRAM_BOT_TOKEN:
-        print("❌ BOT_TOKEN not configured!")
+    """Queue the bot commands menu (setMyCommands) in the Telegram outbox"""
+    if not BOT_TOKEN:
+        tg_log.error('telegram.commands.skipped', reason='bot token not configured')
         return False
     
     try:
-        api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setMyCommands"
         commands = [
             {"command": "balance", "description": "💰 Check your earnings"},
             {"command": "tasks", "description": "📋 View your tasks"},
             {"command": "help", "description": "❓ Show available commands"}
         ]
-        response = requests.post(api_url, json={"commands": commands})
-        if response.status_code == 200:
-            print(f"✅ Bot commands menu set successfully!")
-            return True
-        else:
-            print(f"⚠️ Failed to set bot commands: {response.text}")
-            return False
+        enqueue_telegram_call('setMyCommands', {"commands": commands})
+        db.session.commit()
+        tg_log.info('telegram.commands.queued')
+        return True
     except Exception as e:
-        print(f"❌ Error setting bot commands: {str(e)}")
+        db.session.rollback()
+        tg_log.exception('telegram.commands.failed')
         return False
 
 def auto_register_telegram_user(telegram_user_id, first_name):
@@ -651,34 +2399,30 @@ def auto_register_telegram_user(telegram_user_id, first_name):
     try:
         user = User(username=attempt_username, password_hash=password_hash, telegram_id=telegram_id)
         db.session.add(user)
+        bump_stat_counters(workers_total=1)
         db.session.commit()
-        print(f"✅ Auto-registered Telegram user: {attempt_username} (ID: {telegram_id})")
+        tg_log.info('telegram.user.registered', user_id=user.id, telegram_id=telegram_id)
         return user
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"❌ Error auto-registering user: {str(e)}")
+        tg_log.exception('telegram.user.register_failed', telegram_id=telegram_id)
         return None
 
 def process_telegram_message(update_data):
-    """Process Telegram message and send reply"""
+    """Process Telegram message and queue the reply in the outbox.
+
+    Returns False when the update is skipped (nothing to retry). Errors propagate,
+    so the update queue puts the update back for another attempt.
+    """
     TELEGRAM_BOT_TOKEN = BOT_TOKEN
     
-    print(f"\n{'='*60}")
-    print(f"🔍 PROCESS_TELEGRAM_MESSAGE called")
-    print(f"{'='*60}")
-    print(f"🔍 BOT_TOKEN value check:")
-    print(f"   - Is not None: {TELEGRAM_BOT_TOKEN is not None}")
-    print(f"   - Is not empty string: {bool(TELEGRAM_BOT_TOKEN)}")
-    print(f"   - Length: {len(TELEGRAM_BOT_TOKEN) if TELEGRAM_BOT_TOKEN else 0}")
-    print(f"   - First 20 chars: {TELEGRAM_BOT_TOKEN[:20] if TELEGRAM_BOT_TOKEN else 'N/A'}")
-    
     if not TELEGRAM_BOT_TOKEN:
-        print("❌ CRITICAL ERROR: Bot token is empty or None!")
+        tg_log.error('telegram.message.skipped', reason='bot token not configured')
         return False
     
     try:
         if not update_data or 'message' not in update_data:
-            print("⚠️ No message in update_data")
+            tg_log.debug('telegram.update.ignored', reason='no message')
             return True
         
         message = update_data['message']
@@ -688,11 +2432,12 @@ def process_telegram_message(update_data):
         telegram_user_id = str(user_info.get('id'))
         first_name = user_info.get('first_name', 'User')
         
-        print(f"📱 Telegram message received: chat_id={chat_id}, user_id={telegram_user_id}, text='{text}'")
-        print(f"🔍 DEBUG: Full message object: {message}")
+        tg_log.info('telegram.message.received', chat_id=chat_id, telegram_id=telegram_user_id,
+                    command=text if text.startswith('/') else None)
+        tg_log.debug('telegram.update.payload', message=message)
         
         if not chat_id:
-            print("❌ ERROR: chat_id is None or empty!")
+            tg_log.warning('telegram.message.skipped', reason='no chat id')
             return False
         
         message_text = None
@@ -700,7 +2445,7 @@ def process_telegram_message(update_data):
         with app.app_context():
             user = User.query.filter_by(telegram_id=telegram_user_id).first()
             
-            if text == '/start' or text == '/help':
+            if text == '/start':
                 if not user:
                     # Auto-register new user
                     user = auto_register_telegram_user(telegram_user_id, first_name)
@@ -722,24 +2467,25 @@ def process_telegram_message(update_data):
                     message_text = f"💰 የገንዘብ ሁኔታ:\n\n" \
                                   f"📊 አጠቃላይ ገቢ: ብር {user.total_earned:.2f}\n" \
                                   f"💵 ሊወጣ የሚችል: ብር {user.pending_payout:.2f}\n\n" \
-                                  f"🔐 <a href='https://g-task.onrender.com/telegram_auto_login/{generate_telegram_login_token(user)}'>ወደ ዌብሳይት ይሂዱ</a>"
+                                  f"🔐 <a href='{telegram_login_link(user)}'>ወደ ዌብሳይት ይሂዱ</a>"
                 else:
                     message_text = "🔐 መለያ አልተገናኘም! /start ለመጀመር"
             
             elif text == '/tasks':
                 if user:
-                    tasks = Task.query.filter_by(user_id=user.id).all()
-                    verified_count = len([t for t in tasks if t.status == 'VERIFIED'])
-                    pending_count = len([t for t in tasks if t.status == 'PENDING'])
+                    counts = task_status_counts(user.id)
+                    verified_count = counts.get('VERIFIED', 0)
+                    pending_count = counts.get('PENDING', 0)
                     message_text = f"📋 የሥራ ሁኔታ:\n\n" \
                                   f"✅ የተረጋገጡ: {verified_count}\n" \
                                   f"⏳ በመጠበቅ ላይ: {pending_count}\n" \
                                   f"💰 ብር {verified_count * PAYOUT_AMOUNT_PER_TASK:.2f} አገኘዋል\n\n" \
-                                  f"🔐 <a href='https://g-task.onrender.com/telegram_auto_login/{generate_telegram_login_token(user)}'>ወደ ዌብሳይት ይሂዱ</a>"
+                                  f"🔐 <a href='{telegram_login_link(user)}'>ወደ ዌብሳይት ይሂዱ</a>"
                 else:
                     message_text = "🔐 መለያ አልተገናኘም! /start ለመጀመር"
             
             elif text == '/help':
+                login_url = telegram_login_link(user) if user else "https://g-task.onrender.com/miniapp"
                 message_text = f"<b>📚 ሀልፕ እና ጥያቄዎች</b>\n\n" \
                               f"<b>ሥራ እንዴት ይሰራልሙ?</b>\n" \
                               f"✅ 'ስራ ይውሰዱ' ተወስደው ጂሜል ስም እና ይለፍ ቃል ይቀበሉ\n" \
@@ -755,31 +2501,22 @@ def process_telegram_message(update_data):
                               f"/balance - ገንዘብ ሁኔታ\n" \
                               f"/tasks - የሥራ ሁኔታ\n" \
                               f"/help - ይህ ሀልፕ\n\n" \
-                              f"🔐 <a href='https://g-task.onrender.com/telegram_auto_login/{generate_telegram_login_token(user) if user else ""}'>ወደ ዌብሳይት ይሂዱ</a>"
+                              f"🔐 <a href='{login_url}'>ወደ ዌብሳይት ይሂዱ</a>"
             
             else:
                 message_text = "❓ ያልታወቀ ትዕዛዝ። /help ለሚገቡ ትዕዛዞች"
+            
+            user_id = user.id if user else None
         
         if not message_text:
-            print("❌ ERROR: message_text is empty!")
+            tg_log.warning('telegram.message.skipped', reason='empty reply', chat_id=chat_id)
             return False
         
-        print(f"🔍 DEBUG: Prepared message for chat_id {chat_id}: {message_text[:50]}...")
-        
-        # Send message to Telegram API
-        api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        print(f"🔍 DEBUG: API URL: {api_url[:50]}...")
-        
-        payload = {
-            'chat_id': chat_id,
-            'text': message_text,
-            'parse_mode': 'HTML'
-        }
+        params = {'parse_mode': 'HTML'}
         
         # Add Inline Keyboard button for Mini App if /start or /help
         if text in ['/start', '/help']:
-            import json
-            keyboard = {
+            params['reply_markup'] = {
                 "inline_keyboard": [
                     [
                         {
@@ -791,45 +2528,22 @@ def process_telegram_message(update_data):
                     ]
                 ]
             }
-            payload['reply_markup'] = json.dumps(keyboard)
-            print(f"✅ Added web_app button to /start command")
         
-        print(f"🔍 DEBUG: Sending payload: {str(payload)[:200]}...")
-        
-        try:
-            response = requests.post(api_url, data=payload, timeout=10)
-            print(f"🔍 DEBUG: Response status: {response.status_code}")
-            print(f"🔍 DEBUG: Response text: {response.text}")
-            
-            if response.status_code == 200:
-                print(f"✅ Message sent to {telegram_user_id}")
-                return True
-            else:
-                print(f"❌ Failed to send message: {response.text}")
-                return False
-        except Exception as send_error:
-            print(f"❌ ERROR sending message: {str(send_error)}")
-            import traceback
-            traceback.print_exc()
-            return False
+        # The outbox sends it (retries, per-chat order); a failure here fails the update
+        with app.app_context():
+            enqueue_telegram_message(chat_id, message_text, user_id=user_id, **params)
+            db.session.commit()
+        tg_log.debug('telegram.message.queued', chat_id=chat_id)
+        return True
     
-    except Exception as e:
-        print(f"❌ Error processing message: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+    except Exception:
+        tg_log.warning('telegram.message.error', update_id=update_data.get('update_id'))
+        raise
 
 @app.route('/telegram/webhook', methods=['POST'])
 def telegram_webhook():
     """Telegram webhook handler (legacy route)"""
-    try:
-        update_data = request.get_json()
-        print(f"📥 Received at /telegram/webhook: {update_data}")
-        process_telegram_message(update_data)
-        return jsonify({'status': 'ok'}), 200
-    except Exception as e:
-        print(f"❌ Telegram webhook error: {str(e)}")
-        return jsonify({'status': 'error'}), 500
+    return webhook_handler()
 
 @app.route('/telegram/set-webhook', methods=['POST'])
 def set_telegram_webhook():
@@ -846,58 +2560,48 @@ def set_telegram_webhook():
         return jsonify({'status': 'error', 'message': f'Bot token: {"configured" if TELEGRAM_BOT_TOKEN else "missing"}, Webhook URL: {"configured" if WEBHOOK_URL_VAR else "missing"}'}), 400
     
     try:
-        api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook"
-        response = requests.post(api_url, data={'url': WEBHOOK_URL_VAR})
+        response = get_telegram_session().post(telegram_api_url('setWebhook'), data={'url': WEBHOOK_URL_VAR}, timeout=TELEGRAM_API_TIMEOUT)
         
         if response.status_code == 200:
             set_telegram_bot_commands()
-            print(f"✅ Telegram webhook set successfully to: {WEBHOOK_URL_VAR}")
+            tg_log.info('telegram.webhook.set', url=WEBHOOK_URL_VAR)
             return jsonify({'status': 'success', 'message': 'Webhook set successfully', 'webhook_url': WEBHOOK_URL_VAR}), 200
         else:
-            print(f"❌ Failed to set webhook: {response.text}")
+            tg_log.warning('telegram.webhook.failed', status=response.status_code, response=response.text)
             return jsonify({'status': 'error', 'message': f'Failed to set webhook: {response.text}'}), 400
     except Exception as e:
-        print(f"❌ Error setting webhook: {str(e)}")
+        tg_log.exception('telegram.webhook.failed')
         return jsonify({'status': 'error', 'message': str(e)}), 500
     
     return jsonify({'status': 'success', 'message': 'Webhook set successfully', 'webhook_url': WEBHOOK_URL_VAR}), 200
 
 @app.route('/webhook', methods=['POST'])
 def webhook_handler():
-    """Render-compatible Telegram webhook handler (MAIN ENTRY POINT)"""
-    print(f"\n{'='*60}")
-    print(f"🔔 WEBHOOK RECEIVED - POST /webhook")
-    print(f"{'='*60}")
-    
+    """Render-compatible Telegram webhook handler (MAIN ENTRY POINT)
+
+    Only persists the update; the consumer pool (section 2.3) processes it.
+    """
     try:
-        print(f"🔍 Content-Type: {request.content_type}")
-        print(f"🔍 Request method: {request.method}")
-        
-        # Try to get JSON
-        data = request.get_json()
-        
-        print(f"📥 JSON parsed successfully")
+        data = request.get_json(silent=True)
         
-        if not data:
-            print("⚠️ Empty webhook data received")
-            return jsonify({'status': 'ok'}), 200 
+        if not data or 'update_id' not in data:
+            log.warning('webhook.ignored', reason='empty' if not data else 'no update_id')
+            return jsonify({'status': 'ok'}), 200
         
-        print(f"📥 Webhook data keys: {list(data.keys())}")
-        print(f"🔍 BOT_TOKEN check: configured={bool(BOT_TOKEN)}, length={len(BOT_TOKEN) if BOT_TOKEN else 0}")
-        
-        # Process the message
-        result = process_telegram_message(data)
-        print(f"✅ Message processing result: {result}")
+        if enqueue_telegram_update(data):
+            metrics.WEBHOOK_UPDATES.labels('enqueued').inc()
+            log.debug('webhook.enqueued', update_id=data['update_id'])
+        else:
+            metrics.WEBHOOK_UPDATES.labels('duplicate').inc()
+            log.info('webhook.duplicate', update_id=data['update_id'])
         
-        # Always return 200 to Telegram
         return jsonify({'status': 'ok'}), 200
         
     except Exception as e:
-        print(f"❌ Webhook error: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        # Still return 200 to prevent Telegram from retrying
-        return jsonify({'status': 'ok'}), 200
+        db.session.rollback()
+        log.exception('webhook.error')
+        # Not persisted - let Telegram redeliver it
+        return jsonify({'status': 'error'}), 500
 
 @app.route('/dashboard')
 def dashboard():
@@ -905,24 +2609,28 @@ def dashboard():
         return redirect(url_for('miniapp'))
     
     try:
-        user = User.query.filter_by(id=session['user_id']).first()
+        header = load_dashboard_header(session['user_id'])
         
-        if user is None:
+        if header is None:
             session.pop('user_id', None)
             return redirect(url_for('miniapp'))
         
-        current_task = Task.query.filter_by(user_id=session['user_id'], status='PENDING').first()
-        available_task = Inventory.query.filter_by(status='AVAILABLE').first()
-        my_tasks = Task.query.filter_by(user_id=session['user_id']).all()
+        g.current_user = header.user
+        my_tasks, next_cursor = load_task_history(header.user.id, request.args.get('before'))
         
         return render_template('dashboard.html', 
-                             user=user, 
-                             current_task=current_task,
-                             available_task=available_task,
-                             my_tasks=my_tasks)
+                             user=header.user, 
+                             current_task=header.current_task,
+                             available_task=header.inventory_available,
+                             task_counts=header.task_counts,
+                             checkin_streak=header.checkin_streak,
+                             checked_in_today=header.checked_in_today,
+                             my_tasks=my_tasks,
+                             next_cursor=next_cursor,
+                             is_history_page=bool(request.args.get('before')))
                              
     except Exception as e:
-        print(f"CRITICAL FLASK ERROR CAUGHT: {e}")
+        log.exception('dashboard.error', user_id=session.get('user_id'))
         session.pop('user_id', None)
         return redirect(url_for('miniapp'))
 
@@ -935,57 +2643,72 @@ def take_task():
     if not is_logged_in():
         return redirect(url_for('miniapp'))
 
-    with app.app_context():
-        available_inventory = Inventory.query.filter_by(status='AVAILABLE').first()
-        
-        if not available_inventory:
-            flash('አሁን ምንም ዕንቁራታ ስራ የለም።', 'error')
-            return redirect(url_for('dashboard'))
-        
-        new_task = Task(inventory_id=available_inventory.id, user_id=session['user_id'])
-        available_inventory.status = 'ASSIGNED'
-        db.session.add(new_task)
-        db.session.commit()
-        
+    outcome, _ = claim_task_for_user(session['user_id'])
+    metrics.TASK_CLAIMS.labels(outcome).inc()
+
+    if outcome == CLAIM_OK:
         flash('ሥራውን በተሳካ ሁኔታ ወስደዋል!', 'success')
-        return redirect(url_for('dashboard'))
+    elif outcome == CLAIM_HAS_PENDING:
+        flash('ያልጨረሱት ሥራ አለዎት። መጀመሪያ እሱን ያስገቡ።', 'error')
+    elif outcome == CLAIM_BUSY:
+        flash('ብዙ ሰራተኞች በአንድ ጊዜ እየወሰዱ ነው። እባክዎ እንደገና ይሞክሩ።', 'error')
+    else:
+        flash('አሁን ምንም ዕንቁራታ ስራ የለም።', 'error')
+
+    return redirect(url_for('dashboard'))
 
 @app.route('/submit_task/<int:task_id>', methods=['POST'])
 def submit_task(task_id):
     if not is_logged_in():
         return redirect(url_for('miniapp'))
 
-    with app.app_context():
-        task = Task.query.filter_by(id=task_id, user_id=session['user_id']).first()
-        
-        if not task:
+    screenshot = request.files.get('screenshot')
+    
+    if not screenshot:
+        flash('ስክሪንሻት ያስፈልጋል።', 'error')
+        return redirect(url_for('dashboard'))
+    
+    # Stored before the transaction; a file left by a failed update is harmless
+    # (content-addressed, and reused if the same image is submitted again)
+    try:
+        screenshot_key, created = screenshots.save_upload(screenshot_store, screenshot.stream)
+    except screenshots.ScreenshotRejected as e:
+        log.info('screenshot.rejected', user_id=session['user_id'], reason=e.reason)
+        if e.reason == 'too many pixels':
+            flash(f'ስክሪንሻቱ በጣም ትልቅ ነው (ከ{screenshots.SCREENSHOT_MAX_PIXELS // 1_000_000} ሜጋፒክሰል ያልበለጠ)።', 'error')
+        else:
+            flash(f'ስክሪንሻቱ PNG፣ JPG ወይም WEBP ምስል መሆን አለበት (ከ{screenshots.SCREENSHOT_MAX_BYTES // (1024 * 1024)}MB ያልበለጠ)።', 'error')
+        return redirect(url_for('dashboard'))
+    
+    try:
+        # Only an open (PENDING) task of this worker can be submitted
+        submitted = db.session.execute(
+            db.update(Task)
+            .where(Task.id == task_id, Task.user_id == session['user_id'], Task.status == 'PENDING')
+            .values(status='SUBMITTED', date_completed=func.now(), completion_code=screenshot_key)
+        ).rowcount
+        if submitted != 1:
+            db.session.rollback()
             flash('ይህ ሥራ አልተገኘም።', 'error')
             return redirect(url_for('dashboard'))
         
-        screenshot = request.files.get('screenshot')
-        
-        if not screenshot:
-            flash('ስክሪንሻት ያስፈልጋል።', 'error')
-            return redirect(url_for('dashboard'))
-        
-        try:
-            task.status = 'SUBMITTED'
-            task.date_completed = func.now()
-            db.session.commit()
-            flash('ሥራ በተሳካ ሁኔታ ተላለወ! አድሚን ለማረጋገጥ በመጠበቅ ላይ።', 'success')
-        except Exception as e:
-            db.session.rollback()
-            flash(f'ስህተት: {str(e)}', 'error')
-        
-        return redirect(url_for('dashboard'))
+        bump_stat_counters(tasks_submitted=1)
+        db.session.commit()
+        if created:
+            screenshots.schedule_thumbnail(screenshot_store, screenshot_key, on_error=_thumbnail_failed)
+        flash('ሥራ በተሳካ ሁኔታ ተላለወ! አድሚን ለማረጋገጥ በመጠበቅ ላይ።', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'ስህተት: {str(e)}', 'error')
+    
+    return redirect(url_for('dashboard'))
 
 @app.route('/payout_request')
 def payout_request():
     if not is_logged_in():
         return redirect(url_for('miniapp'))
     
-    with app.app_context():
-        user = User.query.filter_by(id=session['user_id']).first()
+    user = get_current_user()
     
     return render_template('payout_request.html', user=user, min_payout=MIN_PAYOUT)
 
@@ -994,56 +2717,58 @@ def request_payout():
     if not is_logged_in():
         return redirect(url_for('miniapp'))
 
-    with app.app_context():
-        user = User.query.filter_by(id=session['user_id']).first()
-        amount = float(request.form.get('amount', 0))
-        
-        if amount < MIN_PAYOUT:
-            flash(f'ቢያንስ ብር {MIN_PAYOUT:.2f} ግለጹ።', 'error')
-            return redirect(url_for('payout_request'))
-        
-        if amount > user.pending_payout:
-            flash('ቀሪ ሂሳብዎ ያ መጠን የለም።', 'error')
-            return redirect(url_for('payout_request'))
-        
-        payment_method = request.form.get('payment_method')
-        recipient_name = request.form.get('recipient_name')
-        payment_details = request.form.get('payment_details')
-        
-        try:
-            payout = Payout(
-                user_id=session['user_id'], 
-                amount=amount,
-                payment_method=payment_method,
-                recipient_name=recipient_name,
-                payment_details=payment_details
-            )
-            user.pending_payout -= amount
-            db.session.add(payout)
-            db.session.commit()
-            flash('ክፍያ ጥያቄ በተሳካ ሁኔታ ተላለወ!', 'success')
-            return redirect(url_for('dashboard'))
-        except Exception as e:
+    user = get_current_user()
+    amount = float(request.form.get('amount', 0))
+    
+    if amount < MIN_PAYOUT:
+        flash(f'ቢያንስ ብር {MIN_PAYOUT:.2f} ግለጹ።', 'error')
+        return redirect(url_for('payout_request'))
+    
+    if amount > user.pending_payout:
+        flash('ቀሪ ሂሳብዎ ያ መጠን የለም።', 'error')
+        return redirect(url_for('payout_request'))
+    
+    payment_method = request.form.get('payment_method')
+    recipient_name = request.form.get('recipient_name')
+    payment_details = request.form.get('payment_details')
+    
+    try:
+        payout = Payout(
+            user_id=session['user_id'], 
+            amount=amount,
+            payment_method=payment_method,
+            recipient_name=recipient_name,
+            payment_details=payment_details
+        )
+        db.session.add(payout)
+        db.session.flush()
+        # Conditional debit: a double submit finds the balance already spent
+        if debit_user(user.id, amount, 'PAYOUT_REQUEST', f'payout:{payout.id}') is None:
             db.session.rollback()
-            flash(f'ስህተት: {str(e)}', 'error')
+            flash('ቀሪ ሂሳብዎ ያ መጠን የለም።', 'error')
             return redirect(url_for('payout_request'))
+        db.session.commit()
+        flash('ክፍያ ጥያቄ በተሳካ ሁኔታ ተላለወ!', 'success')
+        return redirect(url_for('dashboard'))
+    except Exception as e:
+        db.session.rollback()
+        flash(f'ስህተት: {str(e)}', 'error')
+        return redirect(url_for('payout_request'))
 
 @app.route('/view_ads')
 def view_ads():
     if not is_logged_in():
         return redirect(url_for('miniapp'))
     
-    with app.app_context():
-        user = User.query.filter_by(id=session['user_id']).first()
-        available_ads = Ad.query.filter_by(is_active=True).all()
-        
-        today = func.date(func.now())
-        viewed_today = db.session.query(AdView).filter(
+    available_ads = list(ad_catalog.get().values())
+    # "Rewarded today" flags: one lookup on uq_ad_views_user_ad_day
+    viewed_today = set(db.session.execute(
+        db.select(AdView.ad_id).where(
             AdView.user_id == session['user_id'],
-            AdView.status == 'REWARDED',
-            func.date(AdView.date_viewed) == today
-        ).scalars().all()
-        
+            AdView.view_day == business_today(),
+            AdView.status == 'REWARDED')
+    ).scalars())
+    
     return render_template('view_ads.html', available_ads=available_ads, viewed_today=viewed_today)
 
 
@@ -1055,41 +2780,38 @@ def register_ad_reward(ad_id):
     
     user_id = session['user_id']
     
-    with app.app_context():
-        ad = Ad.query.filter_by(id=ad_id, is_active=True).first()
-        user = User.query.filter_by(id=user_id).first()
-        
-        if not ad or not user:
-            return jsonify({'success': False, 'message': 'Ad or User not found'}), 404
+    ad = ad_catalog.get().get(ad_id)
+    
+    if not ad:
+        return jsonify({'success': False, 'message': 'Ad or User not found'}), 404
 
-        today = func.date(func.now())
-        already_rewarded = AdView.query.filter(
-            AdView.ad_id == ad_id,
-            AdView.user_id == user_id,
-            AdView.status == 'REWARDED',
-            func.date(AdView.date_viewed) == today
+    try:
+        # The unique (user_id, ad_id, view_day) key turns a repeat into a no-op
+        rewarded = db.session.execute(
+            insert_ignore(AdView)
+            .values(ad_id=ad_id, user_id=user_id, status='REWARDED',
+                    date_viewed=datetime.now(), view_day=business_today())
+            .returning(AdView.id)
         ).first()
-
-        if already_rewarded:
+        if rewarded is None:
+            db.session.rollback()
             return jsonify({'success': False, 'message': 'You have already been rewarded for this ad today.'}), 400
-            
-        try:
-            user.pending_payout += ad.reward_amount
-            user.total_earned += ad.reward_amount
-            
-            new_view = AdView(ad_id=ad_id, user_id=user_id, status='REWARDED')
-            db.session.add(new_view)
-            db.session.commit()
-            
-            return jsonify({
-                'success': True, 
-                'message': f'ብር{ad.reward_amount:.2f} ወደ ቀሪ ሂሳብዎ ተጨምሯል!',
-                'new_balance': f'{user.pending_payout:.2f}'
-            }), 200
-            
-        except Exception as e:
+        
+        new_balance = credit_user(user_id, ad.reward_amount, 'AD_REWARD', f'ad:{ad_id}')
+        if new_balance is None:
             db.session.rollback()
-            return jsonify({'success': False, 'message': 'Internal Server Error'}), 500
+            return jsonify({'success': False, 'message': 'Ad or User not found'}), 404
+        db.session.commit()
+        
+        return jsonify({
+            'success': True, 
+            'message': f'ብር{ad.reward_amount:.2f} ወደ ቀሪ ሂሳብዎ ተጨምሯል!',
+            'new_balance': f'{new_balance:.2f}'
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Internal Server Error'}), 500
 
 @app.route('/daily_checkin', methods=['POST'])
 def daily_checkin():
@@ -1098,47 +2820,43 @@ def daily_checkin():
         return jsonify({'success': False, 'message': 'Not logged in'}), 401
     
     user_id = session['user_id']
-    DAILY_CHECKIN_REWARD = 0.20
+    today = business_today()
     
-    with app.app_context():
-        user = User.query.filter_by(id=user_id).first()
-        if not user:
-            return jsonify({'success': False, 'message': 'User not found'}), 404
-        
-        today = func.current_date()
-        already_checked_in = DailyCheckIn.query.filter(
-            DailyCheckIn.user_id == user_id,
-            DailyCheckIn.check_in_date == today
+    try:
+        # Record check-in; the unique (user_id, check_in_date) key makes a second tap a no-op
+        checked_in = db.session.execute(
+            insert_ignore(DailyCheckIn)
+            .values(user_id=user_id, check_in_date=today, date_checked_in=datetime.now())
+            .returning(DailyCheckIn.id)
         ).first()
-        
-        if already_checked_in:
+        if checked_in is None:
+            db.session.rollback()
             return jsonify({
                 'success': False, 
                 'message': 'ዛሬ ቀድሞ ገብተዋል! ነገ ይሞክሩ።'
             }), 400
         
-        try:
-            # Add reward to user balance
-            user.pending_payout += DAILY_CHECKIN_REWARD
-            user.total_earned += DAILY_CHECKIN_REWARD
-            
-            # Record check-in
-            new_checkin = DailyCheckIn(user_id=user_id)
-            db.session.add(new_checkin)
-            db.session.commit()
-            
-            print(f"✅ Daily check-in for {user.username}: +ብር{DAILY_CHECKIN_REWARD}")
-            
-            return jsonify({
-                'success': True,
-                'message': f'🎉 እንኳን ደስ አልዎት! ብር {DAILY_CHECKIN_REWARD:.2f} ወደ ቀሪ ሂሳብዎ ተጨምሯል!',
-                'new_balance': f'{user.pending_payout:.2f}'
-            }), 200
-            
-        except Exception as e:
+        # Add reward to user balance
+        new_balance = credit_user(user_id, DAILY_CHECKIN_REWARD, 'CHECKIN_REWARD', f'checkin:{today.isoformat()}')
+        if new_balance is None:
             db.session.rollback()
-            print(f"❌ Daily check-in error: {str(e)}")
-            return jsonify({'success': False, 'message': 'Internal Server Error'}), 500
+            return jsonify({'success': False, 'message': 'User not found'}), 404
+        streak = _record_checkin_streak(user_id, today)
+        db.session.commit()
+        
+        log.info('checkin.ok', user_id=user_id, reward=DAILY_CHECKIN_REWARD, streak=streak)
+        
+        return jsonify({
+            'success': True,
+            'message': f'🎉 እንኳን ደስ አልዎት! ብር {DAILY_CHECKIN_REWARD:.2f} ወደ ቀሪ ሂሳብዎ ተጨምሯል! 🔥 {streak} ቀን በተከታታይ',
+            'new_balance': f'{new_balance:.2f}',
+            'streak': streak
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        log.exception('checkin.error', user_id=user_id)
+        return jsonify({'success': False, 'message': 'Internal Server Error'}), 500
 
 
 # --- 4. ADMIN ROUTES (አስተዳዳሪ መንገዶች) ---
@@ -1149,15 +2867,53 @@ def admin_dashboard():
         flash('የአስተዳዳሪ መብት የለዎትም።', 'error')
         return redirect(url_for('dashboard'))
     
-    with app.app_context():
-        pending_tasks_count = Task.query.filter_by(status='SUBMITTED').count()
-        total_inventory_count = Inventory.query.filter_by(status='AVAILABLE').count()
-        total_users_count = User.query.filter_by(is_admin=False).count()
+    counters = get_stat_counters()
 
     return render_template('admin_dashboard.html', 
-                             pending_tasks_count=pending_tasks_count,
-                             total_inventory_count=total_inventory_count,
-                             total_users_count=total_users_count)
+                             pending_tasks_count=counters['tasks_submitted'],
+                             total_inventory_count=counters['inventory_available'],
+                             total_users_count=counters['workers_total'])
+
+
+@app.route('/admin/logging', methods=['GET', 'POST'])
+def admin_logging():
+    """Show or change log levels / sample rates of the worker process serving the request.
+
+    POST JSON: {"levels": "gtask.telegram=DEBUG", "sample_rates": "webhook.enqueued=0.1"}
+    """
+    if not check_admin_access():
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            configure_logging(data.get('levels'), data.get('sample_rates'))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        log.info('logging.reconfigured', levels=data.get('levels'), sample_rates=data.get('sample_rates'))
+
+    return jsonify({'success': True, 'pid': os.getpid(), 'logging': logging_config()}), 200
+
+
+@app.route('/admin/checkin_streaks')
+def admin_checkin_streaks():
+    if not check_admin_access():
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify({'success': True, 'streaks': [
+        {'user_id': user_id, 'username': username, 'current_streak': current, 'longest_streak': longest}
+        for user_id, username, current, longest in get_checkin_streaks(limit)
+    ]}), 200
+
+
+@app.route('/admin/stats/reconcile', methods=['POST'])
+def admin_reconcile_stats():
+    if not check_admin_access():
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    reconcile_stat_counters()
+    return jsonify({'success': True, 'counters': get_stat_counters()}), 200
 
 
 @app.route('/admin/add_tasks', methods=['GET', 'POST'])
@@ -1167,92 +2923,104 @@ def admin_add_tasks():
     
     if request.method == 'POST':
         task_data = request.form.get('task_data')
+        task_file = request.files.get('task_file')
         
-        if not task_data:
+        if task_file and task_file.filename:
+            lines = io.TextIOWrapper(task_file.stream, encoding='utf-8', errors='replace')
+        elif task_data and task_data.strip():
+            lines = io.StringIO(task_data)
+        else:
             flash('እባክዎ የጂሜል መረጃውን ያስገቡ።', 'error')
             return render_template('admin_add_tasks.html')
-            
-        lines = task_data.strip().split('\n')
-        successful_inserts = 0
-        failed_tasks = []
-
-        with app.app_context():
-            for line in lines:
-                line = line.strip()
-                if not line: continue
-                
-                if ':' in line:
-                    parts = line.split(':')
-                    username = parts[0].strip() if len(parts) > 0 else None
-                    password = parts[1].strip() if len(parts) > 1 else None
-                    recovery_email = parts[2].strip() if len(parts) > 2 else None
-                    
-                    if username and password:
-                        try:
-                            new_inventory = Inventory(
-                                gmail_username=username, 
-                                gmail_password=password,
-                                recovery_email=recovery_email
-                            )
-                            db.session.add(new_inventory)
-                            db.session.commit()
-                            successful_inserts += 1
-                        except Exception:
-                            db.session.rollback()
-                            failed_tasks.append(f"Duplicate/Error: {username}")
-                    else:
-                        failed_tasks.append(f"Invalid format: {line}")
-                else:
-                    failed_tasks.append(f"Missing separator: {line}")
         
-            if successful_inserts > 0:
-                flash(f'በተሳካ ሁኔታ {successful_inserts} አዲስ ስራዎች ወደ ክምችት ገብተዋል።', 'success')
-                send_notification_to_all_telegram_users("🚀 አዲስ ስራ ተጨመረ ፍጠን አሁን ስራ ውሰድ")
-            if failed_tasks:
-                flash(f'በመግቢያ ላይ ስህተት የተፈጠረባቸው ስራዎች ({len(failed_tasks)}): ' + '; '.join(failed_tasks[:5]) + '...', 'warning')
-
-        return redirect(url_for('admin_dashboard'))
+        try:
+            report = import_inventory(lines)
+        except Exception as e:
+            log.exception('inventory.import.error')
+            flash(f'በማስገባት ላይ ስህተት ተከስቷል: {e}', 'error')
+            return render_template('admin_add_tasks.html')
+        
+        if report.inserted > 0:
+            flash(f'በተሳካ ሁኔታ {report.inserted} አዲስ ስራዎች ወደ ክምችት ገብተዋል።', 'success')
+            send_notification_to_all_telegram_users("🚀 አዲስ ስራ ተጨመረ ፍጠን አሁን ስራ ውሰድ")
+        if report.error_count:
+            flash(f'በመግቢያ ላይ ስህተት የተፈጠረባቸው ስራዎች ({report.error_count})።', 'warning')
+        
+        return render_template('admin_add_tasks.html', import_report=report)
 
     return render_template('admin_add_tasks.html')
 
 
+def _broadcast_to_dict(broadcast):
+    return {
+        'id': broadcast.id,
+        'status': broadcast.status,
+        'total': broadcast.total,
+        'sent': broadcast.sent,
+        'failed': broadcast.failed,
+        'blocked': broadcast.blocked,
+        'date_created': broadcast.date_created.isoformat() if broadcast.date_created else None,
+        'date_finished': broadcast.date_finished.isoformat() if broadcast.date_finished else None,
+    }
+
+# 4.2.1. የማሰራጫ ሁኔታ (Broadcast Status)
+@app.route('/admin/broadcasts')
+def admin_broadcasts():
+    if not check_admin_access():
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    broadcasts = Broadcast.query.order_by(Broadcast.id.desc()).limit(20).all()
+    return jsonify({'success': True, 'broadcasts': [_broadcast_to_dict(b) for b in broadcasts]}), 200
+
+@app.route('/admin/broadcasts/<int:broadcast_id>')
+def admin_broadcast_status(broadcast_id):
+    if not check_admin_access():
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    broadcast = db.session.get(Broadcast, broadcast_id)
+    if not broadcast:
+        return jsonify({'success': False, 'message': 'Broadcast not found'}), 404
+    return jsonify({'success': True, 'broadcast': _broadcast_to_dict(broadcast)}), 200
+
+
 # 4.3. ማስታወቂያዎች አስተዳደር (Manage Ads)
 @app.route('/admin/manage_ads', methods=['GET', 'POST'])
 def admin_manage_ads():
     if not check_admin_access():
         return redirect(url_for('dashboard'))
     
-    with app.app_context():
-        if request.method == 'POST':
-            title = request.form.get('title')
-            embed_url = request.form.get('embed_url')
-            
-            try:
-                reward_amount = float(request.form.get('reward_amount'))
-                view_time = int(request.form.get('view_time'))
-            except (ValueError, TypeError):
-                flash('ክፍያ እና ሰዓት በቁጥር መግባት አለባቸው!', 'error')
-                return redirect(url_for('admin_manage_ads'))
-            
-            try:
-                if 'watch?v=' in embed_url:
-                    embed_url = embed_url.replace('watch?v=', 'embed/')
-
-                new_ad = Ad(
-                    title=title, 
-                    embed_url=embed_url, 
-                    reward_amount=reward_amount, 
-                    required_view_time=view_time
-                )
-                db.session.add(new_ad)
-                db.session.commit()
-                flash(f'ማስታወቂያው "{title}" በተሳካ ሁኔታ ተጨምሯል።', 'success')
-                return redirect(url_for('admin_manage_ads'))
-            except Exception as e:
-                db.session.rollback()
-                flash(f'ማስታወቂያ በማስገባት ላይ ስህተት ተከስቷል: {e}', 'error')
+    if request.method == 'POST':
+        title = request.form.get('title')
+        embed_url = request.form.get('embed_url')
+        
+        try:
+            reward_amount = float(request.form.get('reward_amount'))
+            view_time = int(request.form.get('view_time'))
+        except (ValueError, TypeError):
+            flash('ክፍያ እና ሰዓት በቁጥር መግባት አለባቸው!', 'error')
+            return redirect(url_for('admin_manage_ads'))
+        
+        try:
+            if 'watch?v=' in embed_url:
+                embed_url = embed_url.replace('watch?v=', 'embed/')
+
+            new_ad = Ad(
+                title=title, 
+                embed_url=embed_url, 
+                reward_amount=reward_amount, 
+                required_view_time=view_time
+            )
+            db.session.add(new_ad)
+            bump_cache_version('ad_catalog')
+            db.session.commit()
+            ad_catalog.invalidate()
+            flash(f'ማስታወቂያው "{title}" በተሳካ ሁኔታ ተጨምሯል።', 'success')
+            return redirect(url_for('admin_manage_ads'))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'ማስታወቂያ በማስገባት ላይ ስህተት ተከስቷል: {e}', 'error')
 
-        ads = Ad.query.all()
+    ads = Ad.query.all()
     
     return render_template('admin_manage_ads.html', ads=ads)
 
@@ -1263,14 +3031,15 @@ def admin_toggle_ad(ad_id):
     if not check_admin_access():
         return redirect(url_for('dashboard'))
     
-    with app.app_context():
-        ad = Ad.query.filter_by(id=ad_id).first()
-        if ad:
-            ad.is_active = not ad.is_active
-            db.session.commit()
-            flash(f'የማስታወቂያው ሁኔታ ወደ {"Active" if ad.is_active else "Inactive"} ተቀይሯል።', 'info')
-        else:
-            flash('ማስታወቂያ አልተገኘም።', 'error')
+    ad = Ad.query.filter_by(id=ad_id).first()
+    if ad:
+        ad.is_active = not ad.is_active
+        bump_cache_version('ad_catalog')
+        db.session.commit()
+        ad_catalog.invalidate()
+        flash(f'የማስታወቂያው ሁኔታ ወደ {"Active" if ad.is_active else "Inactive"} ተቀይሯል።', 'info')
+    else:
+        flash('ማስታወቂያ አልተገኘም።', 'error')
     
     return redirect(url_for('admin_manage_ads'))
 
@@ -1280,101 +3049,157 @@ def admin_verify_tasks():
     if not check_admin_access():
         return redirect(url_for('dashboard'))
 
-    with app.app_context():
-        submitted_tasks_raw = db.session.execute(db.select(Task.id.label('task_id'), Task.completion_code, Task.date_completed, Inventory.gmail_username, User.username.label('worker_username'))
-            .join(Inventory, Task.inventory_id == Inventory.id)
-            .join(User, Task.user_id == User.id)
-            .filter(Task.status == 'SUBMITTED')
-            .order_by(Task.date_completed.asc())
-        ).all()
-        
-        # Convert Row objects to dictionaries for template access
-        submitted_tasks = []
-        for row in submitted_tasks_raw:
-            submitted_tasks.append({
-                'task_id': row.task_id,
-                'completion_code': row.completion_code,
-                'date_completed': row.date_completed,
-                'gmail_username': row.gmail_username,
-                'worker_username': row.worker_username
-            })
-        
-    return render_template('admin_verify_tasks.html', submitted_tasks=submitted_tasks)
+    submitted_tasks, next_cursor = load_review_queue(request.args.get('after'))
+    return render_queue_page('admin_verify_tasks.html', 'admin_verify_tasks_rows.html',
+                             'submitted_tasks', submitted_tasks, next_cursor)
+
+# 5.3.1. የስክሪንሻት ምስሎች (Screenshots: thumbnail on the review page, full size on click)
+@app.route('/admin/screenshots/<key>')
+def admin_screenshot(key):
+    if not check_admin_access() or not screenshots.is_screenshot_key(key) or not screenshot_store.exists(key):
+        return 'Not Found', 404
+    content_type = screenshots.CONTENT_TYPES[key.rsplit('.', 1)[1]]
+    response = screenshot_store.response(key, content_type, SCREENSHOT_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'private, max-age={SCREENSHOT_CACHE_MAX_AGE}, immutable'
+    return response
+
+@app.route('/admin/screenshots/<key>/thumb')
+def admin_screenshot_thumb(key):
+    if not check_admin_access() or not screenshots.is_screenshot_key(key) or not screenshot_store.exists(key):
+        return 'Not Found', 404
+    thumb = screenshots.thumbnail_key(key)
+    # Not made yet (background job pending or failed): make it now
+    if not screenshot_store.exists(thumb) and not screenshots.make_thumbnail(screenshot_store, key):
+        return admin_screenshot(key)  # no Pillow: the original
+    response = screenshot_store.response(thumb, 'image/jpeg', SCREENSHOT_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'private, max-age={SCREENSHOT_CACHE_MAX_AGE}, immutable'
+    return response
 
 # 5.4. የሥራ ማረጋገጫ እርምጃ
 @app.route('/admin/action_task/<int:task_id>/<action>', methods=['POST'])
 def admin_action_task(task_id, action):
     if not check_admin_access():
         return redirect(url_for('dashboard'))
-    
-    with app.app_context():
-        task = Task.query.filter_by(id=task_id).first()
 
-        if not task or task.status != 'SUBMITTED':
+    if action not in ('verify', 'reject'):
+        flash('ትክክለኛ ያልሆነ እርምጃ።', 'error')
+        return redirect(url_for('admin_verify_tasks'))
+
+    try:
+        reviewed, _ = review_tasks([task_id], action)
+        if not reviewed:
+            db.session.rollback()
             flash('ይህ ሥራ አልተገኘም ወይም ለመረጋገጥ ዝግጁ አይደለም።', 'error')
             return redirect(url_for('admin_verify_tasks'))
+        db.session.commit()
+        
+        if action == 'verify':
+            flash(f'ሥራው በተሳካ ሁኔታ ተረጋግጧል። ብር{PAYOUT_AMOUNT_PER_TASK:.2f} ለሰራተኛው ተጨምሯል።', 'success')
+        else:
+            flash('ሥራው አልተቀበልም። ወደ ሥራ ክምችት ተመልሷል።', 'info')
 
-        try:
-            inventory_item = Inventory.query.filter_by(id=task.inventory_id).first()
-            user = User.query.filter_by(id=task.user_id).first()
-            
-            if action == 'verify':
-                task.status = 'VERIFIED'
-                if inventory_item:
-                    inventory_item.status = 'COMPLETED'
-                
-                # ክፍያውን በሲስተሙ አማካኝነት ወደ ንፁ ባላንስ ይጨምራል
-                if user:
-                    user.pending_payout += PAYOUT_AMOUNT_PER_TASK
-                    user.total_earned += PAYOUT_AMOUNT_PER_TASK
-                
-                db.session.commit()
-                flash(f'ሥራው በተሳካ ሁኔታ ተረጋግጧል። ብር{PAYOUT_AMOUNT_PER_TASK:.2f} ለሰራተኛው ተጨምሯል።', 'success')
-
-            elif action == 'reject':
-                task.status = 'REJECTED'
-                if inventory_item:
-                    inventory_item.status = 'AVAILABLE' # ስራውን ነጻ ያደርገዋል
-                
-                db.session.commit()
-                flash('ሥራው አልተቀበልም። ወደ ሥራ ክምችት ተመልሷል።', 'info')
-                
-            else:
-                flash('ትክክለኛ ያልሆነ እርምጃ።', 'error')
-
-        except Exception as e:
-            db.session.rollback()
-            flash(f'ማረጋገጫው ላይ ስህተት ተከስቷል: {e}', 'error')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'ማረጋገጫው ላይ ስህተት ተከስቷል: {e}', 'error')
 
     return redirect(url_for('admin_verify_tasks'))
 
+# 5.4.1. የብዙ ሥራዎች ማረጋገጫ (Batch Review, JSON)
+@app.route('/admin/review_tasks', methods=['POST'])
+def admin_review_tasks():
+    """{"action": "verify"|"reject", "task_ids": [...]} -> per-id results, one transaction."""
+    if not check_admin_access():
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    try:
+        task_ids = [int(task_id) for task_id in data.get('task_ids') or []]
+    except (TypeError, ValueError):
+        task_ids = None
+    if action not in ('verify', 'reject') or not task_ids:
+        return jsonify({'success': False, 'message': 'ትክክለኛ ያልሆነ እርምጃ።'}), 400
+    if len(task_ids) > REVIEW_BATCH_MAX:
+        return jsonify({'success': False, 'message': f'በአንድ ጊዜ ቢበዛ {REVIEW_BATCH_MAX} ሥራዎች።'}), 400
+    
+    try:
+        reviewed, skipped = review_tasks(task_ids, action)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        log.exception('review.batch.failed', action=action, tasks=len(task_ids))
+        return jsonify({'success': False, 'message': f'ማረጋገጫው ላይ ስህተት ተከስቷል: {e}'}), 500
+    
+    log.info('review.batch', action=action, reviewed=len(reviewed), skipped=len(skipped))
+    message = f'{len(reviewed)} ሥራዎች {"ተረጋግጠዋል" if action == "verify" else "ውድቅ ሆነዋል"}።'
+    if skipped:
+        message += f' {len(skipped)} ሥራዎች ቀድሞ ተገምግመዋል ወይም አልተገኙም።'
+    # skipped: {task_id: its current status, or NOT_FOUND}
+    return jsonify({'success': True, 'message': message, 'reviewed': reviewed,
+                    'skipped': {str(task_id): status for task_id, status in skipped.items()}})
+
 
 @app.route('/admin/payouts')
 def admin_payouts():
     if not check_admin_access():
         return redirect(url_for('dashboard'))
 
-    with app.app_context():
-        payout_requests_raw = db.session.execute(db.select(Payout.id.label('payout_id'), Payout.amount, Payout.date_requested, Payout.recipient_name, Payout.payment_method, Payout.payment_details, User.username.label('worker_username'))
-            .join(User, Payout.user_id == User.id)
-            .filter(Payout.status == 'REQUESTED')
-            .order_by(Payout.date_requested.asc())
-        ).all()
-        
-        # Convert Row objects to dictionaries for template access
-        payout_requests = []
-        for row in payout_requests_raw:
-            payout_requests.append({
-                'payout_id': row.payout_id,
-                'amount': row.amount,
-                'date_requested': row.date_requested,
-                'recipient_name': row.recipient_name,
-                'payment_method': row.payment_method,
-                'payment_details': row.payment_details,
-                'worker_username': row.worker_username
-            })
-    
-    return render_template('admin_payouts.html', payout_requests=payout_requests)
+    payout_requests, next_cursor = load_payout_queue(request.args.get('after'))
+    
+    def export_batches():
+        batches = db.session.execute(
+            db.select(PayoutExportBatch).order_by(PayoutExportBatch.id.desc()).limit(PAYOUT_EXPORT_RECENT_BATCHES)
+        ).scalars().all()
+        return {'export_batches': batches,
+                'export_batch_methods': payout_export_batch_methods([batch.id for batch in batches])}
+    
+    return render_queue_page('admin_payouts.html', 'admin_payouts_rows.html',
+                             'payout_requests', payout_requests, next_cursor, export_batches)
+
+# 5.5.1. የክፍያ ኤክስፖርት (Payout Export: create a batch, then download one CSV per method)
+@app.route('/admin/payouts/export', methods=['POST'])
+def admin_export_payouts():
+    if not check_admin_access():
+        return redirect(url_for('dashboard'))
+    
+    try:
+        payout_ids = [int(payout_id) for payout_id in request.form.getlist('payout_ids')] or None
+    except ValueError:
+        flash('ትክክለኛ ያልሆነ ምርጫ።', 'error')
+        return redirect(url_for('admin_payouts'))
+    
+    try:
+        batch = create_payout_export_batch(session['user_id'], payout_ids)
+        if batch is None:
+            flash('ለኤክስፖርት የቀረ የክፍያ ጥያቄ የለም።', 'info')
+            return redirect(url_for('admin_payouts'))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        log.exception('payout.export.failed')
+        flash(f'ኤክስፖርቱ ላይ ስህተት ተከስቷል: {e}', 'error')
+        return redirect(url_for('admin_payouts'))
+    
+    log.info('payout.export.batch', batch_id=batch.id, payouts=batch.payout_count, total=batch.total_amount)
+    flash(f'ኤክስፖርት #{batch.id}: {batch.payout_count} ክፍያዎች (ብር {batch.total_amount:.2f})። '
+          f'ከታች ለእያንዳንዱ የክፍያ ዘዴ CSV ያውርዱ።', 'success')
+    return redirect(url_for('admin_payouts'))
+
+@app.route('/admin/payouts/export/<int:batch_id>.csv')
+def admin_export_payouts_csv(batch_id):
+    if not check_admin_access():
+        return redirect(url_for('dashboard'))
+    
+    payment_method = request.args.get('method', '')
+    if db.session.get(PayoutExportBatch, batch_id) is None:
+        return 'Not Found', 404
+    
+    filename = f"gtask-payouts-{batch_id}-{''.join(c for c in payment_method if c.isalnum()) or 'other'}.csv"
+    return app.response_class(
+        stream_with_context(iter_payout_export_csv(batch_id, payment_method)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Cache-Control': 'no-store'},
+    )
 
 
 # 5.6. የክፍያ እርምጃ
@@ -1383,48 +3208,193 @@ def admin_action_payout(payout_id, action):
     if not check_admin_access():
         return redirect(url_for('dashboard'))
     
-    with app.app_context():
-        payout = Payout.query.filter_by(id=payout_id).first()
+    if action not in ('paid', 'reject'):
+        flash('ትክክለኛ ያልሆነ እርምጃ።', 'error')
+        return redirect(url_for('admin_payouts'))
 
-        if not payout or payout.status != 'REQUESTED':
+    try:
+        # Conditional transition: a concurrent or repeated action changes nothing (no double refund)
+        settled, _ = settle_payouts(action, payout_ids=[payout_id])
+        if not settled:
+            db.session.rollback()
             flash('ጥያቄው አልተገኘም ወይም አስቀድሞ ተስተናግዷል።', 'error')
             return redirect(url_for('admin_payouts'))
-        
-        user = User.query.filter_by(id=payout.user_id).first()
+        db.session.commit()
+        amount = settled[0].amount
 
-        try:
-            if action == 'paid':
-                payout.status = 'PAID'
-                payout.date_paid = func.now()
-                db.session.commit()
-                
-                # Send Telegram payment notification to user
-                if user:
-                    send_payment_notification(user.id, payout.amount)
-                
-                flash(f'የ ብር{payout.amount:.2f} ክፍያ እንደተፈጸመ ምልክት ተደርጓል።', 'success')
-
-            elif action == 'reject':
-                payout.status = 'REJECTED'
-                
-                # ገንዘቡን ወደ pending_payout ይመልሳል
-                if user:
-                    user.pending_payout += payout.amount
-                
-                db.session.commit()
-                flash(f'የ ብር{payout.amount:.2f} ክፍያ ጥያቄ ውድቅ ተደርጓል፣ ገንዘቡ ወደ ቀሪ ሂሳብ ተመልሷል።', 'info')
-                
-            else:
-                flash('ትክክለኛ ያልሆነ እርምጃ።', 'error')
+        if action == 'paid':
+            flash(f'የ ብር{amount:.2f} ክፍያ እንደተፈጸመ ምልክት ተደርጓል።', 'success')
+        else:
+            flash(f'የ ብር{amount:.2f} ክፍያ ጥያቄ ውድቅ ተደርጓል፣ ገንዘቡ ወደ ቀሪ ሂሳብ ተመልሷል።', 'info')
 
-        except Exception as e:
-            db.session.rollback()
-            flash(f'የክፍያ እርምጃ ላይ ስህተት ተከስቷል: {e}', 'error')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'የክፍያ እርምጃ ላይ ስህተት ተከስቷል: {e}', 'error')
 
     return redirect(url_for('admin_payouts'))
 
+# 5.6.1. የብዙ ክፍያዎች ማጠናቀቂያ (Bulk Settlement: selected payouts or a whole export batch)
+@app.route('/admin/payouts/settle', methods=['POST'])
+def admin_settle_payouts():
+    if not check_admin_access():
+        return redirect(url_for('dashboard'))
+    
+    action = request.values.get('action')
+    try:
+        payout_ids = [int(payout_id) for payout_id in request.form.getlist('payout_ids')] or None
+        batch_id = int(request.form['batch_id']) if request.form.get('batch_id') else None
+    except ValueError:
+        payout_ids = batch_id = None
+    if action not in ('paid', 'reject') or (payout_ids is None) == (batch_id is None):
+        flash('ትክክለኛ ያልሆነ እርምጃ ወይም ምርጫ።', 'error')
+        return redirect(url_for('admin_payouts'))
+    
+    try:
+        settled, skipped = settle_payouts(action, payout_ids=payout_ids, batch_id=batch_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        log.exception('payout.settle.failed', action=action, batch_id=batch_id)
+        flash(f'የክፍያ እርምጃ ላይ ስህተት ተከስቷል: {e}', 'error')
+        return redirect(url_for('admin_payouts'))
+    
+    total = sum(row.amount for row in settled)
+    log.info('payout.settle', action=action, batch_id=batch_id, settled=len(settled),
+             skipped=len(skipped), total=total)
+    if action == 'paid':
+        message = f'{len(settled)} ክፍያዎች (ብር {total:.2f}) እንደተፈጸሙ ምልክት ተደርጓል።'
+    else:
+        message = f'{len(settled)} ክፍያ ጥያቄዎች ውድቅ ተደርገዋል፣ ብር {total:.2f} ወደ ቀሪ ሂሳብ ተመልሷል።'
+    if skipped:
+        message += f' {len(skipped)} ቀድሞ ተስተናግደዋል ወይም አልተገኙም።'
+    flash(message, 'success' if settled else 'info')
+    return redirect(url_for('admin_payouts'))
+
+
+# --- 5. MAINTENANCE COMMANDS (flask --app main <command>) ---
+
+@app.cli.command('db-init')
+def db_init_command():
+    """Create tables, apply migrations and create the admin account (release phase).
+
+    Exits 1 when a migration fails, so the deploy does not go ahead on a half-migrated schema.
+    """
+    try:
+        init_db(strict=True)
+    except Exception:
+        raise SystemExit(1)
+
+@app.cli.command('set-admin')
+@click.argument('username')
+@click.option('--revoke', is_flag=True, help='Take admin access away instead of granting it.')
+def set_admin_command(username, revoke):
+    """Grant (or --revoke) admin access; the user's open sessions follow on their next admin check."""
+    with app.app_context():
+        user_id = db.session.execute(db.select(User.id).where(User.username == username)).scalar()
+        if user_id is None or not set_user_admin(user_id, not revoke):
+            print(f"⚠️ No user named {username}")
+            raise SystemExit(1)
+        db.session.commit()
+    print(f"✅ {username}: admin {'revoked' if revoke else 'granted'}")
 
-# --- 5. RUN APP ---
+@app.cli.command('ledger-snapshot')
+def ledger_snapshot_command():
+    """Snapshot balances of users with many ledger entries since their last snapshot (cron)."""
+    with app.app_context():
+        print(f"Snapshots taken: {take_balance_snapshots()}")
+
+@app.cli.command('ledger-verify')
+def ledger_verify_command():
+    """Compare every balance with its ledger; exits 1 on any mismatch."""
+    with app.app_context():
+        mismatches = verify_ledger()
+    for user_id, balance, expected in mismatches:
+        print(f"⚠️ user {user_id}: balance {balance} != ledger {expected}")
+    if mismatches:
+        raise SystemExit(1)
+    print("✅ Ledger matches every balance")
+
+@app.cli.command('outbox-requeue')
+@click.option('--hours', default=24, show_default=True, help='Only calls queued within this many hours.')
+def outbox_requeue_command(hours):
+    """Send dead-lettered Telegram calls again (except to chats that blocked the bot)."""
+    with app.app_context():
+        result = db.session.execute(
+            db.update(TelegramOutbox)
+            .where(TelegramOutbox.status == 'DEAD', TelegramOutbox.last_error != 'blocked',
+                   TelegramOutbox.date_created >= datetime.now() - timedelta(hours=hours))
+            .values(status='PENDING', attempts=0, next_attempt_at=datetime.now())
+        )
+        db.session.commit()
+    print(f"Requeued: {result.rowcount}")
+
+@app.cli.command('telegram-poll')
+@click.option('--consumers', type=int, default=None, help='Update consumer threads (default: WEBHOOK_CONSUMERS).')
+def telegram_poll_command(consumers):
+    """Receive bot updates by getUpdates long polling instead of the webhook (runs until stopped)."""
+    global WEBHOOK_CONSUMERS
+    if not BOT_TOKEN:
+        raise SystemExit("BOT_TOKEN is not configured")
+    if consumers:
+        WEBHOOK_CONSUMERS = consumers
+    try:
+        run_telegram_poller()
+    except KeyboardInterrupt:
+        pass
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    with app.app_context():
+        print(f"Schema version: {run_migrations(db.engine, metadata=db.metadata)}")
+
+@app.cli.command('db-check-indexes')
+def db_check_indexes_command():
+    """EXPLAIN the hot queries and list the ones that need a sequential scan."""
+    with app.app_context():
+        results = check_hot_queries(db.engine)
+    for name, seq_scans, plan in results:
+        marker = f"⚠️ SEQ SCAN on {', '.join(seq_scans)}" if seq_scans else '✅ index'
+        print(f"{name:28} {marker}  [{plan}]")
+    if any(seq_scans for _, seq_scans, _ in results):
+        raise SystemExit(1)
+
+
+# --- 6. STARTUP ---
+
+@app.route('/health')
+def health():
+    """Liveness probe; no database access. Reports this process's boot timings."""
+    return jsonify({'success': True, 'pid': os.getpid(), 'boot': BOOT_TIMINGS})
+
+@app.before_request
+def _time_first_request():
+    if 'first_request' not in BOOT_TIMINGS and request.endpoint != 'health':
+        g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_first_request(response):
+    if 'first_request' not in BOOT_TIMINGS and 'request_started' in g:
+        BOOT_TIMINGS['first_request'] = round(time.perf_counter() - g.request_started, 3)
+        log.info('boot.first_request', pid=os.getpid(), seconds=BOOT_TIMINGS['first_request'], path=request.path)
+    return response
+
+def warm_templates():
+    """Compile every template now (and fill the bytecode cache) instead of on first use."""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+_templates_started = time.perf_counter()
+try:
+    warm_templates()
+except Exception as e:
+    print(f"⚠️ Template warm-up failed: {str(e)[:120]}")
+BOOT_TIMINGS['templates'] = round(time.perf_counter() - _templates_started, 3)
+BOOT_TIMINGS['module'] = round(time.perf_counter() - _BOOT_STARTED, 3)
+print("⏱️ Boot: " + ', '.join(f"{k}={v}s" for k, v in BOOT_TIMINGS.items()))
+
+
+# --- 7. RUN APP ---
 if __name__ == '__main__':
     # Flask-SQLAlchemy ሁልጊዜ በ app_context ውስጥ መስራት አለበት
     with app.app_context():
@@ -0,0 +1,121 @@
+# ======================================================
+# G-TASK MANAGER: METRICS (Prometheus text format, served at /metrics)
+# When PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it), every worker
+# writes its samples to files in that directory and a scrape aggregates all of
+# them, so it does not matter which worker answers. Without it, /metrics only
+# reports the process that serves it (python main.py).
+# Database state (queue depths, stat counters) is read at scrape time.
+# ======================================================
+
+import os
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+from requests.adapters import HTTPAdapter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+REQUEST_SECONDS = Histogram(
+    'gtask_http_request_duration_seconds', 'HTTP request latency by Flask endpoint',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS)
+SQL_STATEMENTS_PER_REQUEST = Histogram(
+    'gtask_sql_statements_per_request', 'SQL statements executed per HTTP request',
+    ['endpoint'], buckets=STATEMENT_BUCKETS)
+SQL_SECONDS_PER_REQUEST = Histogram(
+    'gtask_sql_seconds_per_request', 'Time spent in SQL per HTTP request',
+    ['endpoint'], buckets=LATENCY_BUCKETS)
+SQL_BACKGROUND_STATEMENTS = Counter(
+    'gtask_sql_background_statements', 'SQL statements executed outside HTTP requests')
+TELEGRAM_API_SECONDS = Histogram(
+    'gtask_telegram_api_duration_seconds', 'Telegram Bot API call latency',
+    ['method', 'status'], buckets=LATENCY_BUCKETS)
+TASK_CLAIMS = Counter('gtask_task_claims', 'take_task attempts by outcome', ['outcome'])
+INVENTORY_IMPORTED = Counter('gtask_inventory_imported', 'Inventory rows inserted by imports')
+WEBHOOK_UPDATES = Counter('gtask_webhook_updates', 'Webhook deliveries by result', ['result'])
+UPDATES_PROCESSED = Counter('gtask_telegram_updates_processed', 'Queued updates handled by consumers',
+                            ['result'])
+TELEGRAM_OUTBOX = Counter('gtask_telegram_outbox_deliveries', 'Outbox Bot API calls by outcome',
+                          ['outcome'])
+
+
+def instrument_sql(request_stats):
+    """Time every SQL statement of every engine.
+
+    `request_stats()` returns the current request's [statements, seconds]
+    accumulator, or None outside a request.
+    """
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = request_stats()
+        if stats is None:
+            SQL_BACKGROUND_STATEMENTS.inc()
+            return
+        stats[0] += 1
+        stats[1] += time.perf_counter() - context._metrics_started
+
+
+def observe_request(endpoint, method, status, seconds, sql_stats):
+    REQUEST_SECONDS.labels(endpoint, method, status).observe(seconds)
+    SQL_STATEMENTS_PER_REQUEST.labels(endpoint).observe(sql_stats[0])
+    SQL_SECONDS_PER_REQUEST.labels(endpoint).observe(sql_stats[1])
+
+
+class TelegramMetricsAdapter(HTTPAdapter):
+    """HTTPAdapter recording latency and status of every Bot API call."""
+
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().send(request, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            # /bot<token>/<method>: only the method name becomes a label
+            method = request.path_url.split('?', 1)[0].rsplit('/', 1)[-1]
+            TELEGRAM_API_SECONDS.labels(method, status).observe(time.perf_counter() - started)
+
+
+def _state_families(queue_depths, stats):
+    depth = GaugeMetricFamily('gtask_queue_depth', 'Rows waiting in each work queue', labels=['queue'])
+    for queue_name, value in queue_depths.items():
+        depth.add_metric([queue_name], value)
+    yield depth
+    for name, value in stats.items():
+        yield GaugeMetricFamily(f'gtask_{name}', f'Stat counter {name}', value=value)
+
+
+class _StateCollector:
+    def __init__(self, queue_depths, stats):
+        self.queue_depths = queue_depths
+        self.stats = stats
+
+    def collect(self):
+        return _state_families(self.queue_depths, self.stats)
+
+
+def render_metrics(queue_depths, stats):
+    """Scrape body and content type: all workers' samples plus the given state gauges."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        process_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(process_registry)
+    else:
+        process_registry = REGISTRY
+    state_registry = CollectorRegistry()
+    state_registry.register(_StateCollector(queue_depths, stats))
+    return generate_latest(process_registry) + generate_latest(state_registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """gunicorn child_exit hook: drop the live-gauge files of a dead worker."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,433 @@
+# ======================================================
+# G-TASK MANAGER: VERSIONED SCHEMA MIGRATIONS
+# Applied by init_db() right after the missing tables are created. Every
+# migration runs once, in MIGRATIONS order, and is recorded in the
+# schema_version table. Workers booting at the same time are serialized by a
+# lock (pg_advisory_lock on PostgreSQL, BEGIN IMMEDIATE on SQLite), so only one
+# of them migrates.
+#
+# Migrations are plain SQL on purpose: they describe the schema as it was at
+# that version, not the current models. Never edit a released migration -
+# append a new one.
+# ======================================================
+
+import os
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import inspect, text
+
+MIGRATION_LOCK_KEY = 74_201_101 # arbitrary, unique to this app
+
+# Same setting as main.BUSINESS_TIMEZONE (day buckets such as ad_views.view_day)
+BUSINESS_TIMEZONE = ZoneInfo(os.environ.get('BUSINESS_TIMEZONE', 'Africa/Addis_Ababa'))
+
+
+def _add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists."""
+    if column in {col['name'] for col in inspect(conn).get_columns(table)}:
+        return
+    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def _create_index(conn, name, table, columns, unique=False, where=None):
+    sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+    if where:
+        sql += f" WHERE {where}"
+    conn.execute(text(sql))
+
+
+def _as_date(value):
+    return None if value is None else date.fromisoformat(str(value)[:10])
+
+
+def _backfill_ad_view_days(conn):
+    """Set ad_views.view_day from date_viewed exactly as the app does: the naive
+    server-local timestamp converted to BUSINESS_TIMEZONE. The oldest view of each
+    (user, ad, day) keeps the bucket; later duplicates get NULL (never conflicts)."""
+    seen = set()
+    changes = []
+    rows = conn.execute(text(
+        'SELECT id, user_id, ad_id, date_viewed, view_day FROM ad_views '
+        'WHERE date_viewed IS NOT NULL ORDER BY id')).all()
+    for view_id, user_id, ad_id, viewed, current in rows:
+        viewed = datetime.fromisoformat(str(viewed)) if not isinstance(viewed, datetime) else viewed
+        day = viewed.astimezone(BUSINESS_TIMEZONE).date()
+        target = None if (user_id, ad_id, day) in seen else day
+        seen.add((user_id, ad_id, day))
+        if _as_date(current) != target:
+            changes.append({'id': view_id, 'day': target})
+    if not changes:
+        return
+    # Clear first so no intermediate state breaks uq_ad_views_user_ad_day
+    conn.execute(text('UPDATE ad_views SET view_day = NULL WHERE id = :id'), changes)
+    moved = [change for change in changes if change['day'] is not None]
+    if moved:
+        conn.execute(text('UPDATE ad_views SET view_day = :day WHERE id = :id'), moved)
+    print(f"   ad_views.view_day: {len(changes)} row(s) re-bucketed in {BUSINESS_TIMEZONE.key}")
+
+
+# --- Migrations ---
+
+def _m001_baseline_columns(conn):
+    """Columns that used to be added by the ad-hoc ALTER loop in init_db."""
+    _add_column(conn, 'users', 'telegram_login_token', 'VARCHAR(256)')
+    _add_column(conn, 'users', 'telegram_token_expires', 'TIMESTAMP')
+    _add_column(conn, 'users', 'telegram_blocked', 'BOOLEAN DEFAULT FALSE')
+    _add_column(conn, 'payouts', 'payment_method', "VARCHAR(50) DEFAULT 'Telebirr'")
+    _add_column(conn, 'payouts', 'recipient_name', "VARCHAR(255) DEFAULT ''")
+    _add_column(conn, 'payouts', 'payment_details', "VARCHAR(255) DEFAULT ''")
+    _add_column(conn, 'inventory', 'recovery_email', 'VARCHAR(120)')
+
+
+def _m002_hot_path_indexes(conn):
+    """Indexes matching the filters and orderings used by main.py."""
+    # take_task: WHERE status = 'AVAILABLE' ORDER BY date_added, id
+    _create_index(conn, 'ix_inventory_status_date_added', 'inventory', 'status, date_added, id')
+    # One open task per worker (claim engine); fails if a worker already has two
+    _create_index(conn, 'uq_tasks_one_pending_per_user', 'tasks', 'user_id',
+                  unique=True, where="status = 'PENDING'")
+    # Dashboard history: WHERE user_id = ? ORDER BY date_assigned DESC, id DESC
+    _create_index(conn, 'ix_tasks_user_date_assigned', 'tasks', 'user_id, date_assigned, id')
+    # Per-worker status counts (dashboard header, bot /tasks)
+    _create_index(conn, 'ix_tasks_user_status', 'tasks', 'user_id, status')
+    # Review queue: WHERE status = 'SUBMITTED' ORDER BY date_completed, id
+    _create_index(conn, 'ix_tasks_submitted_queue', 'tasks', 'date_completed, id',
+                  where="status = 'SUBMITTED'")
+    # Payout queue: WHERE status = 'REQUESTED' ORDER BY date_requested, id
+    _create_index(conn, 'ix_payouts_requested_queue', 'payouts', 'date_requested, id',
+                  where="status = 'REQUESTED'")
+    _create_index(conn, 'ix_payouts_user_id', 'payouts', 'user_id')
+    # "Already rewarded today" lookups
+    _create_index(conn, 'ix_ad_views_user_ad_date', 'ad_views', 'user_id, ad_id, date_viewed')
+    # telegram_auto_login token lookup
+    _create_index(conn, 'ix_users_telegram_login_token', 'users', 'telegram_login_token',
+                  where='telegram_login_token IS NOT NULL')
+    # Webhook consumers: WHERE status = 'PENDING' ORDER BY update_id
+    _create_index(conn, 'ix_telegram_updates_status_update_id', 'telegram_updates', 'status, update_id')
+
+
+def _m003_ledger_opening_balances(conn):
+    """Start the ledger of every existing user at their current balance."""
+    conn.execute(text("""
+        INSERT INTO ledger_entries (user_id, amount, kind, balance_after, date_created)
+        SELECT id, pending_payout, 'OPENING_BALANCE', pending_payout, :now
+        FROM users
+        WHERE COALESCE(pending_payout, 0) <> 0
+          AND NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.user_id = users.id)
+    """), {'now': datetime.now()})
+
+
+def _m004_checkin_streaks(conn):
+    """Build check_in_streaks from the existing daily_check_ins history."""
+    streaks = {}
+    rows = conn.execute(text(
+        'SELECT user_id, check_in_date FROM daily_check_ins ORDER BY user_id, check_in_date'))
+    for user_id, day in rows:
+        day = date.fromisoformat(str(day)[:10])
+        current, longest, last = streaks.get(user_id, (0, 0, None))
+        current = current + 1 if last and (day - last).days == 1 else 1
+        streaks[user_id] = (current, max(longest, current), day)
+    for user_id, (current, longest, last) in streaks.items():
+        conn.execute(text("""
+            INSERT INTO check_in_streaks (user_id, current_streak, longest_streak, last_check_in_date)
+            SELECT :user_id, :current, :longest, :last
+            WHERE NOT EXISTS (SELECT 1 FROM check_in_streaks WHERE user_id = :user_id)
+        """), {'user_id': user_id, 'current': current, 'longest': longest, 'last': last})
+
+
+def _m005_ad_view_day(conn):
+    """Stored day bucket for ad views, unique per user and ad."""
+    _add_column(conn, 'ad_views', 'view_day', 'DATE')
+    _backfill_ad_view_days(conn)
+    _create_index(conn, 'uq_ad_views_user_ad_day', 'ad_views', 'user_id, ad_id, view_day', unique=True)
+    # Superseded: the unique index starts with (user_id, ad_id)
+    conn.execute(text('DROP INDEX IF EXISTS ix_ad_views_user_ad_date'))
+
+
+
+def _m006_queue_dates(conn):
+    """Queue rows always have a date: keyset pages compare (date, id) and skip NULLs."""
+    conn.execute(text("""
+        UPDATE tasks SET date_completed = COALESCE(date_assigned, CURRENT_TIMESTAMP)
+        WHERE status = 'SUBMITTED' AND date_completed IS NULL
+    """))
+    conn.execute(text("""
+        UPDATE payouts SET date_requested = CURRENT_TIMESTAMP
+        WHERE status = 'REQUESTED' AND date_requested IS NULL
+    """))
+
+
+
+def _m007_payout_export_batches(conn):
+    """Payouts remember the disbursement export they were sent in."""
+    _add_column(conn, 'payouts', 'export_batch_id', 'INTEGER')
+    _create_index(conn, 'ix_payouts_export_batch_id', 'payouts', 'export_batch_id, id')
+
+
+def _m008_update_retry_backoff(conn):
+    """Failed webhook updates wait before they are claimed again."""
+    _add_column(conn, 'telegram_updates', 'next_attempt_at', 'TIMESTAMP')
+
+
+def _m009_outbox_priority(conn):
+    """Telegram outbox lanes: interactive calls are claimed before broadcast rows."""
+    _add_column(conn, 'telegram_outbox', 'priority', 'SMALLINT NOT NULL DEFAULT 0')
+    conn.execute(text('UPDATE telegram_outbox SET priority = 1 WHERE broadcast_id IS NOT NULL'))
+    conn.execute(text('DROP INDEX IF EXISTS ix_telegram_outbox_due'))
+    _create_index(conn, 'ix_telegram_outbox_due_priority', 'telegram_outbox', 'priority, next_attempt_at, id',
+                  where="status IN ('PENDING', 'SENDING')")
+
+
+def _m010_ad_view_day_timezone(conn):
+    """Re-bucket view days that migration 005 once took from DATE(date_viewed) (server day)."""
+    _backfill_ad_view_days(conn)
+
+
+def _m011_drop_login_token_index(conn):
+    """Login links are signed now: nothing looks users up by telegram_login_token."""
+    conn.execute(text('DROP INDEX IF EXISTS ix_users_telegram_login_token'))
+    # Stored tokens are no longer accepted; don't keep them around either
+    conn.execute(text(
+        'UPDATE users SET telegram_login_token = NULL, telegram_token_expires = NULL '
+        'WHERE telegram_login_token IS NOT NULL'))
+
+
+def _m012_detach_rejected_tasks(conn):
+    """tasks.inventory_id becomes nullable: a rejected task lets go of its account.
+
+    The account goes back to the inventory on reject, but the unique inventory_id
+    still tied it to the rejected task, so nobody could claim it again.
+    """
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE tasks ALTER COLUMN inventory_id DROP NOT NULL'))
+    else:
+        # SQLite cannot drop NOT NULL: rebuild the table as it is at this version
+        conn.execute(text("""
+            CREATE TABLE tasks_new (
+                id INTEGER PRIMARY KEY,
+                inventory_id INTEGER UNIQUE REFERENCES inventory (id),
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                completion_code VARCHAR(100),
+                status VARCHAR(20),
+                date_assigned DATETIME,
+                date_completed DATETIME
+            )
+        """))
+        columns = 'id, inventory_id, user_id, completion_code, status, date_assigned, date_completed'
+        conn.execute(text(f'INSERT INTO tasks_new ({columns}) SELECT {columns} FROM tasks'))
+        conn.execute(text('DROP TABLE tasks'))
+        conn.execute(text('ALTER TABLE tasks_new RENAME TO tasks'))
+        _create_index(conn, 'uq_tasks_one_pending_per_user', 'tasks', 'user_id',
+                      unique=True, where="status = 'PENDING'")
+        _create_index(conn, 'ix_tasks_user_date_assigned', 'tasks', 'user_id, date_assigned, id')
+        _create_index(conn, 'ix_tasks_user_status', 'tasks', 'user_id, status')
+        _create_index(conn, 'ix_tasks_submitted_queue', 'tasks', 'date_completed, id',
+                      where="status = 'SUBMITTED'")
+    released = conn.execute(text(
+        "UPDATE tasks SET inventory_id = NULL WHERE status = 'REJECTED' AND inventory_id IS NOT NULL")).rowcount
+    if released:
+        print(f"   Detached {released} rejected tasks from their inventory accounts")
+
+
+def _m013_user_role_version(conn):
+    """Role version carried by session role claims (a role change drops stale claims)."""
+    _add_column(conn, 'users', 'role_version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def _m014_release_duplicate_pending_tasks(conn):
+    """The old take_task could hand a worker several PENDING tasks, which makes 002
+    fail on uq_tasks_one_pending_per_user. Keep each worker's newest, drop the others
+    (never submitted, nothing to review) and put their accounts back in the inventory."""
+    extra_pending = """
+        SELECT id FROM tasks WHERE status = 'PENDING' AND id NOT IN (
+            SELECT MAX(id) FROM tasks WHERE status = 'PENDING' GROUP BY user_id)
+    """
+    conn.execute(text(f"""
+        UPDATE inventory SET status = 'AVAILABLE'
+        WHERE id IN (SELECT inventory_id FROM tasks WHERE id IN ({extra_pending}))
+    """))
+    released = conn.execute(text(f'DELETE FROM tasks WHERE id IN ({extra_pending})')).rowcount
+    if released:
+        print(f"   Released {released} duplicate PENDING tasks back to the inventory")
+
+
+# In the order they run. A migration that has to run before an older one is
+# listed ahead of it under a new number: the runner applies every version not
+# yet recorded in schema_version, in this order (not only those above the max).
+MIGRATIONS = [
+    (1, 'baseline columns', _m001_baseline_columns),
+    (14, 'release duplicate pending tasks', _m014_release_duplicate_pending_tasks), # before 002's index
+    (2, 'hot path indexes', _m002_hot_path_indexes),
+    (3, 'ledger opening balances', _m003_ledger_opening_balances),
+    (4, 'check-in streaks', _m004_checkin_streaks),
+    (5, 'ad view day buckets', _m005_ad_view_day),
+    (6, 'queue dates', _m006_queue_dates),
+    (7, 'payout export batches', _m007_payout_export_batches),
+    (8, 'update retry backoff', _m008_update_retry_backoff),
+    (9, 'telegram outbox priority', _m009_outbox_priority),
+    (10, 'ad view days in business timezone', _m010_ad_view_day_timezone),
+    (11, 'drop login token index', _m011_drop_login_token_index),
+    (12, 'detach rejected tasks from inventory', _m012_detach_rejected_tasks),
+    (13, 'user role version', _m013_user_role_version),
+]
+
+
+# --- Runner ---
+
+def _ensure_version_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description VARCHAR(200) NOT NULL,
+            applied_at TIMESTAMP NOT NULL
+        )
+    """))
+
+
+def _current_version(conn):
+    return conn.execute(text('SELECT COALESCE(MAX(version), 0) FROM schema_version')).scalar()
+
+
+def _applied_versions(conn):
+    return set(conn.execute(text('SELECT version FROM schema_version')).scalars())
+
+
+def _apply(conn, version, description, migration):
+    migration(conn)
+    conn.execute(
+        text('INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)'),
+        {'v': version, 'd': description, 't': datetime.now()}
+    )
+    print(f"✅ Applied migration {version:03d}: {description}")
+
+
+def _migrate_postgresql(engine, metadata):
+    with engine.connect() as conn:
+        conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        conn.commit()
+        try:
+            if metadata is not None:
+                metadata.create_all(conn)
+            _ensure_version_table(conn)
+            conn.commit()
+            applied = _applied_versions(conn)
+            for version, description, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                try:
+                    _apply(conn, version, description, migration)
+                    conn.commit() # one transaction per migration (PostgreSQL DDL is transactional)
+                except Exception:
+                    conn.rollback()
+                    raise
+            return _current_version(conn)
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            conn.commit()
+
+
+def _migrate_sqlite(engine, metadata):
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        # Takes the database write lock; other booting workers wait here
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+        try:
+            if metadata is not None:
+                metadata.create_all(conn)
+            _ensure_version_table(conn)
+            applied = _applied_versions(conn)
+            for version, description, migration in MIGRATIONS:
+                if version not in applied:
+                    _apply(conn, version, description, migration)
+            conn.exec_driver_sql('COMMIT')
+        except Exception:
+            conn.exec_driver_sql('ROLLBACK')
+            raise
+        return _current_version(conn)
+
+
+def run_migrations(engine, metadata=None):
+    """Apply every pending migration. Returns the schema version afterwards.
+
+    If `metadata` is given, missing tables are created first, under the same lock.
+    """
+    if engine.dialect.name == 'postgresql':
+        return _migrate_postgresql(engine, metadata)
+    return _migrate_sqlite(engine, metadata)
+
+
+# --- Index check ---
+# The queries main.py runs on every request or claim, with representative
+# parameters. check_hot_queries() reports the ones that would need a
+# sequential scan.
+
+HOT_QUERIES = {
+    'take_task claim': (
+        "SELECT id FROM inventory WHERE status = 'AVAILABLE' ORDER BY date_added, id LIMIT 1", {}),
+    'pending task of worker': (
+        "SELECT id FROM tasks WHERE user_id = :user_id AND status = 'PENDING'", {'user_id': 1}),
+    'dashboard history page': (
+        "SELECT id FROM tasks WHERE user_id = :user_id ORDER BY date_assigned DESC, id DESC LIMIT 21",
+        {'user_id': 1}),
+    'worker task counts': (
+        "SELECT status, COUNT(*) FROM tasks WHERE user_id = :user_id GROUP BY status", {'user_id': 1}),
+    'review queue': (
+        "SELECT id FROM tasks WHERE status = 'SUBMITTED' ORDER BY date_completed, id LIMIT 51", {}),
+    'review queue page': (
+        "SELECT id FROM tasks WHERE status = 'SUBMITTED' AND (date_completed, id) > (:date, :id) "
+        "ORDER BY date_completed, id LIMIT 51", {'date': '2025-01-01 00:00:00', 'id': 1}),
+    'payout queue': (
+        "SELECT id FROM payouts WHERE status = 'REQUESTED' ORDER BY date_requested, id LIMIT 51", {}),
+    'payout queue page': (
+        "SELECT id FROM payouts WHERE status = 'REQUESTED' AND (date_requested, id) > (:date, :id) "
+        "ORDER BY date_requested, id LIMIT 51", {'date': '2025-01-01 00:00:00', 'id': 1}),
+    'payout export stream': (
+        "SELECT id FROM payouts WHERE export_batch_id = :batch_id ORDER BY id", {'batch_id': 1}),
+    'ad rewarded today': (
+        "SELECT id FROM ad_views WHERE user_id = :user_id AND ad_id = :ad_id AND view_day = :day",
+        {'user_id': 1, 'ad_id': 1, 'day': date(2025, 1, 1)}),
+    'ledger balance at': (
+        "SELECT balance_after FROM ledger_entries WHERE user_id = :user_id ORDER BY id DESC LIMIT 1",
+        {'user_id': 1}),
+    'webhook queue': (
+        "SELECT update_id FROM telegram_updates WHERE status = 'PENDING' ORDER BY update_id LIMIT 1", {}),
+    'telegram outbox claim': (
+        "SELECT id FROM telegram_outbox o WHERE o.status IN ('PENDING', 'SENDING') AND o.next_attempt_at <= :now "
+        "AND NOT EXISTS (SELECT 1 FROM telegram_outbox e WHERE e.chat_id = o.chat_id "
+        "AND e.status IN ('PENDING', 'SENDING') AND e.id < o.id AND e.priority <= o.priority) "
+        "ORDER BY o.priority, o.next_attempt_at, o.id LIMIT 100",
+        {'now': '2025-01-01 00:00:00'}),
+}
+
+
+def _postgresql_seq_scans(plan, found):
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        _postgresql_seq_scans(child, found)
+    return found
+
+
+def check_hot_queries(engine):
+    """EXPLAIN every hot query. Returns [(name, seq_scanned_tables, plan_text)]."""
+    results = []
+    with engine.connect() as conn:
+        is_postgresql = engine.dialect.name == 'postgresql'
+        if is_postgresql:
+            # Make the planner use an index whenever one can serve the query, so
+            # tiny dev tables don't hide a missing index behind a cheap seq scan.
+            conn.execute(text('SET LOCAL enable_seqscan = off'))
+        for name, (sql, params) in HOT_QUERIES.items():
+            if is_postgresql:
+                plan = conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}'), params).scalar()[0]['Plan']
+                seq_scans = _postgresql_seq_scans(plan, [])
+                plan_text = plan.get('Node Type', '')
+            else:
+                rows = conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params).all()
+                details = [row[-1] for row in rows]
+                seq_scans = [d.split()[1] for d in details if d.startswith('SCAN ') and ' USING ' not in d]
+                plan_text = '; '.join(details)
+            results.append((name, seq_scans, plan_text))
+        conn.rollback()
+    return results
@@ -0,0 +1,222 @@
+# ======================================================
+# G-TASK MANAGER: SCREENSHOT STORE
+# Task screenshots are stored under content-addressed keys:
+#     <sha256 of the bytes>.<png|jpg|webp>
+# so the same image uploaded twice is stored once, and a key never changes
+# meaning (its responses can be cached "immutable").
+#
+# - Uploads are copied in chunks to a staging file while being hashed, and
+#   rejected past SCREENSHOT_MAX_BYTES or when the first bytes are not a
+#   PNG/JPEG/WebP image (the client's content type is ignored). With Pillow,
+#   the image header is read too and images over SCREENSHOT_MAX_PIXELS are
+#   rejected: a few KB of PNG can declare a gigapixel canvas.
+# - A JPEG thumbnail (<key without ext>.thumb.jpg) is made in a background
+#   thread, or on first request if that has not happened yet. Thumbnails need
+#   Pillow; without it the thumbnail URL serves the original.
+# - ScreenshotStore is the storage interface; LocalScreenshotStore keeps files
+#   in a directory. An object store implements the same methods.
+# ======================================================
+
+import abc
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import send_file
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are optional
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+SCREENSHOT_MAX_BYTES = int(os.environ.get('SCREENSHOT_MAX_BYTES', str(8 * 1024 * 1024)))
+SCREENSHOT_MAX_PIXELS = int(os.environ.get('SCREENSHOT_MAX_PIXELS', str(25_000_000)))
+THUMBNAIL_SIZE = (320, 640)  # box; phone screenshots are tall
+THUMBNAIL_QUALITY = 70
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}\.(png|jpg|webp)$')
+
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+class ScreenshotRejected(ValueError):
+    """The upload is empty, too large, too many pixels or not a supported image. `reason` says which."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def sniff_image_type(head):
+    """Extension for the magic bytes at the start of a file, or None."""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def check_image_header(path, max_pixels=SCREENSHOT_MAX_PIXELS):
+    """Read only the image header at `path` (no pixel decoding). Raises ScreenshotRejected."""
+    if Image is None:
+        return
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise ScreenshotRejected('too many pixels')
+    except (OSError, SyntaxError, ValueError):
+        raise ScreenshotRejected('not an image')
+    if width * height > max_pixels:
+        raise ScreenshotRejected('too many pixels')
+
+
+def is_screenshot_key(value):
+    return bool(value) and KEY_PATTERN.match(value) is not None
+
+
+def thumbnail_key(key):
+    return key.rsplit('.', 1)[0] + '.thumb.jpg'
+
+
+class ScreenshotStore(abc.ABC):
+    """Storage interface. Keys are flat names: no directories."""
+
+    def staging_dir(self):
+        """Directory for upload staging files (same filesystem, if any, so put() can rename)."""
+        return None
+
+    @abc.abstractmethod
+    def exists(self, key):
+        """Whether `key` is stored."""
+
+    @abc.abstractmethod
+    def put(self, key, path):
+        """Take ownership of the file at `path` and store it under `key` (no-op if present)."""
+
+    @abc.abstractmethod
+    def open(self, key):
+        """Binary file object for `key`."""
+
+    @abc.abstractmethod
+    def response(self, key, content_type, max_age):
+        """Flask response serving `key` (a file or a redirect to the object store)."""
+
+
+class LocalScreenshotStore(ScreenshotStore):
+    """Files in one directory, served by the app with send_file."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, '.staging'), exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def staging_dir(self):
+        return os.path.join(self.root, '.staging')
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put(self, key, path):
+        if self.exists(key):
+            os.unlink(path)
+        else:
+            os.chmod(path, 0o644)
+            os.replace(path, self._path(key))
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def response(self, key, content_type, max_age):
+        return send_file(self._path(key), mimetype=content_type, max_age=max_age, conditional=True, etag=key)
+
+
+def save_upload(store, stream, max_bytes=SCREENSHOT_MAX_BYTES):
+    """Copy an uploaded file stream into `store`. Returns (key, created). Raises ScreenshotRejected."""
+    digest = hashlib.sha256()
+    size = 0
+    ext = None
+    fd, staging_path = tempfile.mkstemp(dir=store.staging_dir(), suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as staging:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if ext is None:
+                    ext = sniff_image_type(chunk[:16])
+                    if ext is None:
+                        raise ScreenshotRejected('not an image')
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ScreenshotRejected('too large')
+                digest.update(chunk)
+                staging.write(chunk)
+        if size == 0:
+            raise ScreenshotRejected('empty')
+        check_image_header(staging_path)
+        key = f"{digest.hexdigest()}.{ext}"
+        created = not store.exists(key)
+        store.put(key, staging_path)
+        return key, created
+    except BaseException:
+        if os.path.exists(staging_path):
+            os.unlink(staging_path)
+        raise
+
+
+def make_thumbnail(store, key):
+    """Store the JPEG thumbnail of `key`. Returns False without Pillow or for an image
+    over SCREENSHOT_MAX_PIXELS (stored before the limit): serve the original then."""
+    if Image is None:
+        return False
+    thumb = thumbnail_key(key)
+    if store.exists(thumb):
+        return True
+    with store.open(key) as source:
+        image = Image.open(source)
+        width, height = image.size  # header only; nothing decoded yet
+        if width * height > SCREENSHOT_MAX_PIXELS:
+            return False
+        image.draft('RGB', THUMBNAIL_SIZE)  # JPEG: decode at reduced scale
+        image.thumbnail(THUMBNAIL_SIZE)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    fd, staging_path = tempfile.mkstemp(dir=store.staging_dir(), suffix='.thumb')
+    with os.fdopen(fd, 'wb') as staging:
+        staging.write(output.getvalue())
+    store.put(thumb, staging_path)
+    return True
+
+
+_thumbnail_pool = None
+_thumbnail_pool_pid = None
+_thumbnail_pool_lock = threading.Lock()
+
+
+def schedule_thumbnail(store, key, on_error=None):
+    """Make the thumbnail on a background thread (one pool per worker process)."""
+    global _thumbnail_pool, _thumbnail_pool_pid
+    if Image is None:
+        return
+    with _thumbnail_pool_lock:
+        if _thumbnail_pool_pid != os.getpid():
+            _thumbnail_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+            _thumbnail_pool_pid = os.getpid()
+    future = _thumbnail_pool.submit(make_thumbnail, store, key)
+    if on_error is not None:
+        def _report(done):
+            if done.exception() is not None:
+                on_error(key, done.exception())
+        future.add_done_callback(_report)
@@ -0,0 +1,258 @@
+# ======================================================
+# G-TASK MANAGER: TELEGRAM AUTH
+# 1. Signed auto-login links for bot replies:
+#     <kid>.<user_id>.<expires>.<nonce>.<signature>
+# The signature is HMAC-SHA256 over everything before it, keyed by the key
+# named <kid>. Nothing is stored: verifying a link is an HMAC plus the caller's
+# primary-key lookup of the user.
+#
+# Key rotation: LOGIN_LINK_KEYS="k2:new-secret,k1:old-secret". The first key
+# signs; every listed key verifies, so links already sent keep working until
+# they expire. Drop the old key once LOGIN_LINK_TTL has passed.
+#
+# 2. Mini App initData validation (Telegram spec):
+#     secret_key = HMAC-SHA256("WebAppData", BOT_TOKEN)   (derived once)
+#     hash       = HMAC-SHA256(secret_key, data_check_string)
+# data_check_string is every received field except `hash`, URL-decoded,
+# sorted by key and joined with newlines.
+#
+# Benchmarks: python -m benchmarks.telegram_auth_bench
+# ======================================================
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
+
+LOGIN_LINK_TTL = 24 * 3600
+INIT_DATA_MAX_AGE = 24 * 3600
+INIT_DATA_CLOCK_SKEW = 60
+_LINK_KEY_CONTEXT = b'gtask-login-link'
+
+
+class InvalidLoginLink(ValueError):
+    """The link is malformed, forged, expired or already used. `reason` says which."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class InvalidInitData(ValueError):
+    """initData failed validation. `reason` says why."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TTLCache:
+    """Bounded LRU whose entries also expire at their own deadline. Thread-safe."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, expires_at):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ReplayCache(TTLCache):
+    """Keys seen recently, each remembered until its own expiry.
+
+    Per process: with several workers a replay can still land on another one,
+    so this narrows replays rather than ruling them out.
+    """
+
+    def check_and_add(self, key, expires_at, now=None):
+        """True the first time `key` is seen (and records it), False on a replay."""
+        if self.max_size <= 0:
+            return True
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._entries[key] = (expires_at, True)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def parse_keys(spec):
+    """"kid:secret,..." -> [(kid, secret)] in signing order. Raises ValueError."""
+    keys = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        kid, sep, secret = item.partition(':')
+        if not sep or not kid or not secret or '.' in kid:
+            raise ValueError(f"Bad login link key entry: {kid or item[:8]}")
+        keys.append((kid, secret))
+    if not keys:
+        raise ValueError("No login link keys configured")
+    return keys
+
+
+class LoginLinkSigner:
+    """Issue and verify self-contained login tokens for one list of keys."""
+
+    def __init__(self, keys, ttl=LOGIN_LINK_TTL, replay_cache=None):
+        # Derived per purpose, so a key shared with the session cookie signer
+        # (SECRET_KEY) never signs two kinds of data.
+        self._keys = {
+            kid: hmac.new(secret.encode(), _LINK_KEY_CONTEXT, hashlib.sha256).digest()
+            for kid, secret in keys
+        }
+        self.signing_kid = keys[0][0]
+        self.ttl = ttl
+        self.replay_cache = replay_cache
+
+    def _signature(self, key, body):
+        return _b64(hmac.new(key, body.encode(), hashlib.sha256).digest())
+
+    def sign(self, user_id, now=None):
+        now = time.time() if now is None else now
+        body = f"{self.signing_kid}.{int(user_id)}.{int(now) + self.ttl}.{secrets.token_urlsafe(9)}"
+        return f"{body}.{self._signature(self._keys[self.signing_kid], body)}"
+
+    def verify(self, token, now=None):
+        """User id of a valid link. Raises InvalidLoginLink."""
+        now = time.time() if now is None else now
+        parts = token.split('.')
+        if len(parts) != 5:
+            raise InvalidLoginLink('malformed')
+        kid, user_id, expires, _nonce, signature = parts
+        key = self._keys.get(kid)
+        if key is None:
+            raise InvalidLoginLink('unknown key')
+        body = token.rsplit('.', 1)[0]
+        if not hmac.compare_digest(signature, self._signature(key, body)):
+            raise InvalidLoginLink('bad signature')
+        if not (user_id.isdigit() and expires.isdigit()):
+            raise InvalidLoginLink('malformed')
+        if int(expires) < now:
+            raise InvalidLoginLink('expired')
+        if self.replay_cache is not None and \
+                not self.replay_cache.check_and_add(signature, int(expires), now):
+            raise InvalidLoginLink('replayed')
+        return int(user_id)
+
+
+def login_link_signer_from_env(default_secret):
+    """Signer for LOGIN_LINK_KEYS (falls back to `default_secret` as key "k0")."""
+    spec = os.environ.get('LOGIN_LINK_KEYS')
+    keys = parse_keys(spec) if spec else [('k0', default_secret)]
+    replay_size = int(os.environ.get('LOGIN_LINK_REPLAY_CACHE', '1024'))
+    return LoginLinkSigner(keys, ttl=int(os.environ.get('LOGIN_LINK_TTL', LOGIN_LINK_TTL)),
+                           replay_cache=ReplayCache(replay_size) if replay_size > 0 else None)
+
+
+class _AcceptedInitData:
+    __slots__ = ('init_data', 'fields', 'consumed')
+
+    def __init__(self, init_data, fields):
+        self.init_data = init_data
+        self.fields = fields
+        self.consumed = False
+
+
+class InitDataValidator:
+    """Validate Mini App initData for one bot token.
+
+    Accepted payloads are remembered by hash until they go stale, so a repeat
+    of the same initData skips parsing and HMAC. Pass consume=True for logins:
+    a payload can be consumed once, so a captured initData cannot be replayed
+    to open a second session (per process, see ReplayCache).
+    """
+
+    def __init__(self, bot_token, max_age=INIT_DATA_MAX_AGE, cache_size=1024):
+        self._secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+        self.max_age = max_age
+        self.accepted = TTLCache(cache_size)
+        self._consume_lock = threading.Lock()
+
+    def _parse(self, init_data):
+        fields = {}
+        for item in init_data.split('&'):
+            key, sep, value = item.partition('=')
+            if sep:
+                fields[key] = unquote(value)
+        return fields
+
+    def validate(self, init_data, consume=False, now=None):
+        """Signed fields with `user` decoded to a dict. Raises InvalidInitData."""
+        now = time.time() if now is None else now
+        if not init_data:
+            raise InvalidInitData('missing initData')
+        received_hash = init_data.rpartition('hash=')[2].split('&', 1)[0]
+        cached = self.accepted.get(received_hash, now) if received_hash else None
+        if cached is not None and hmac.compare_digest(cached.init_data, init_data):
+            if consume:
+                with self._consume_lock:
+                    if cached.consumed:
+                        raise InvalidInitData('replayed')
+                    cached.consumed = True
+            return cached.fields
+
+        fields = self._parse(init_data)
+        received_hash = fields.pop('hash', None)
+        if not received_hash:
+            raise InvalidInitData('no hash')
+        data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(fields.items()))
+        calculated_hash = hmac.new(self._secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(calculated_hash, received_hash):
+            raise InvalidInitData('hash mismatch')
+
+        auth_date = fields.get('auth_date', '')
+        if not auth_date.isdigit():
+            raise InvalidInitData('no auth_date')
+        expires_at = int(auth_date) + self.max_age
+        if expires_at < now or int(auth_date) > now + INIT_DATA_CLOCK_SKEW:
+            raise InvalidInitData('stale auth_date')
+        if 'user' in fields:
+            try:
+                fields['user'] = json.loads(fields['user'])
+            except ValueError:
+                raise InvalidInitData('bad user field')
+            if not isinstance(fields['user'], dict):
+                raise InvalidInitData('bad user field')
+
+        accepted = _AcceptedInitData(init_data, fields)
+        accepted.consumed = consume
+        self.accepted.put(received_hash, accepted, expires_at)
+        return fields
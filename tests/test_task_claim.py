@@ -0,0 +1,83 @@
+# ======================================================
+# G-TASK MANAGER: TASK CLAIM ENGINE TESTS
+# Run from the repository root:
+#     python -m pytest -q tests
+# Uses a throwaway SQLite database (the generic claim path).
+# ======================================================
+
+import os
+import tempfile
+
+import pytest
+
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'claim.db')}"
+
+import main  # noqa: E402 (reads DATABASE_URL on import)
+from main import Inventory, Task, User, app, db  # noqa: E402
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+
+
+@pytest.fixture
+def session():
+    with app.app_context():
+        yield db.session
+        db.session.rollback()
+        for model in (Task, Inventory, User):
+            db.session.execute(db.delete(model))
+        db.session.commit()
+
+
+def add_workers(session, count):
+    workers = [User(username=f'worker{n}', password_hash='x') for n in range(count)]
+    session.add_all(workers)
+    session.commit()
+    return [worker.id for worker in workers]
+
+
+def add_accounts(session, count):
+    session.add_all(Inventory(gmail_username=f'account{n}@gmail.com', gmail_password='secret')
+                    for n in range(count))
+    session.commit()
+
+
+def submit(session, task_id):
+    session.execute(db.update(Task).where(Task.id == task_id).values(status='SUBMITTED'))
+    session.commit()
+
+
+def test_claim_hands_out_oldest_account_once(session):
+    first, second = add_workers(session, 2)
+    add_accounts(session, 1)
+    outcome, task_id = main.claim_task_for_user(first)
+    assert outcome == main.CLAIM_OK
+    assert main.claim_task_for_user(first) == (main.CLAIM_HAS_PENDING, None)
+    assert main.claim_task_for_user(second) == (main.CLAIM_EMPTY, None)
+
+
+def test_rejected_account_can_be_claimed_again(session):
+    first, second, third = add_workers(session, 3)
+    add_accounts(session, 1)
+    _, task_id = main.claim_task_for_user(first)
+    submit(session, task_id)
+    assert main.review_tasks([task_id], 'reject') == ([task_id], {})
+    session.commit()
+
+    outcome, new_task_id = main.claim_task_for_user(second)
+    assert outcome == main.CLAIM_OK
+    rejected, claimed = session.get(Task, task_id), session.get(Task, new_task_id)
+    assert rejected.status == 'REJECTED' and rejected.inventory_id is None
+    assert claimed.inventory_item.gmail_username == 'account0@gmail.com'
+    # Nothing left, and nobody is told they have a pending task
+    assert main.claim_task_for_user(third) == (main.CLAIM_EMPTY, None)
+
+
+def test_only_the_one_pending_index_means_has_pending(session):
+    first, second = add_workers(session, 2)
+    add_accounts(session, 1)
+    _, task_id = main.claim_task_for_user(first)
+    # An AVAILABLE account still linked to another task (the old reject bug)
+    session.execute(db.update(Task).where(Task.id == task_id).values(status='REJECTED'))
+    session.execute(db.update(Inventory).values(status='AVAILABLE'))
+    session.commit()
+    with pytest.raises(IntegrityError):
+        main.claim_task_for_user(second)